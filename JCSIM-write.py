@@ -38,7 +38,11 @@ except ImportError:
     import simplejson as json
 
 from pySim.commands import SimCardCommands
-from pySim.utils import h2b, swap_nibbles, rpad, dec_imsi, dec_iccid, format_xplmn_w_act
+from pySim.fcp import decode_fcp
+from pySim.filesystem import walk
+from pySim.profiles import Profile, ProfileWriter, DFS, PROFILE_NAME
+from pySim.profiles import save_profile as write_profile, iter_profile as iter_profile_folder
+from pySim.utils import h2b, swap_nibbles, rpad, dec_imsi, dec_iccid, format_xplmn_w_act, diff_hex
 
 
 def parse_options():
@@ -61,8 +65,34 @@ def parse_options():
                       default=None,
                       )
 
+    parser.add_option("--replay", dest="replay", metavar="TRACE",
+                      help="Instead of a card, answer with the responses from an APDU trace or log",
+                      default=None,
+                      )
+    parser.add_option("--latency", dest="latency", metavar="MODEL",
+                      type="choice", choices=["none", "recorded", "serial", "pcsc", "calypso"],
+                      help="Latency of the replayed APDUs (none, recorded, serial, pcsc, calypso) [default: %default]",
+                      default="none",
+                      )
+    parser.add_option("--virtual", dest="virtual", metavar="PROFILE",
+                      help="Instead of a card, use a simulated one with the files of a saved profile folder",
+                      default=None,
+                      )
+    parser.add_option("--diff", dest="diff", action="store_true",
+                      help="Only update what differs from the files already on the card",
+                      default=False,
+                      )
+    parser.add_option("--snapshot-dir", dest="snapshot_dir", metavar="DIR",
+                      help="Keep what was written per ICCID in DIR, and take the current contents "
+                           "of the card from there instead of reading them back (implies --diff)",
+                      default=None,
+                      )
+
     (options, args) = parser.parse_args()
 
+    if options.snapshot_dir:
+        options.diff = True
+
     if args:
         parser.error("Extraneous arguments")
 
@@ -94,127 +124,40 @@ class EF:
         self.apdu = apdu
 
 
-def lsdf(dir):
-    adf_dir = []
-    error_adf = []
-    for adf_ef in dir:
-        print("***********************************************************************")
-        adf_ef = EF(adf_ef)
-        print(adf_ef.name)
-        # scc.send_apdu(ins = 'a4',p1 = '04', p2 = '04', data = parent)
-        (fci, sw), parsed = scc.send_apdu(ins='a4', p1='00', p2='04', data=adf_ef.name)
-        adf_ef.set_fci(fci)
-
-        if sw == '6a82':
+def lsdf(tree, path):
+    """EFs directly below the DF at path in a tree found by
+    pySim.filesystem.walk(). Returns a list of EF and a list of (EF, SW)
+    of the ones which couldn't be read."""
+    ef_dir = []
+    error_ef = []
+    df = tree.find(path)
+    if df is None:
+        return ef_dir, error_ef
+    for f in df.children:
+        if f.is_df():
             continue
-        elif sw == '6982':
-            print("Access Rule Encountered")
+        ef = EF(f.fid.upper())
+        ef.set_fci(f.fci)
+        if f.sw is not None or f.type is None:
+            error_ef.append((ef, f.sw))
             continue
-            # scc.verify_chv()
-        elif sw == '9000':
-            # transparent
-            if '82' in parsed.keys() and parsed['82'].startswith('41'):
-                (data, sw) = scc.send_apdu_without_length(ins='b0', p1='00', p2='00', data=parsed['80'][2:4])
-                if sw == '6982':
-                    print("Access Rule Encountered")
-                    continue
-                assert (sw == '9000')
-                adf_ef.set_type('transparent')
-                adf_ef.set_data(data)
-
-            # linear
-            elif '82' in parsed.keys() and parsed['82'].startswith('42'):
-                record_list = []
-                num_rec = int(parsed['82'][8:], 16)
-                len_rec = parsed['82'][6:8]
-                for i in range(num_rec):
-                    i = i + 1
-                    (data, sw) = scc.send_apdu_without_length(ins='b2', p1='%02x' % (i), p2='04', data=str(len_rec))
-                    record_list.append(data)
-
-                adf_ef.set_type('linear')
-                adf_ef.set_data(record_list)
-                assert (sw == '9000')
-
-
-            # cyclic
-            elif '82' in parsed.keys() and parsed['82'].startswith('46'):
-                record_list = []
-                num_rec = int(parsed['82'][8:], 16)
-                len_rec = parsed['82'][6:8]
-                print(num_rec, len_rec)
-                for i in range(num_rec):
-                    i = i + 1
-                    (data, sw) = scc.send_apdu_without_length(ins='b2', p1='%02x' % (i), p2='04', data=str(len_rec))
-                    record_list.append(data)
-
-                assert (sw == '9000')
-                adf_ef.set_type('cyclic')
-                adf_ef.set_data(record_list)
-            else:
-                error_adf.append((adf_ef, sw))
-                continue
-            adf_dir.append(adf_ef)
-        else:
-            error_adf.append((adf_ef, sw))
-    return adf_dir, error_adf
+        ef.set_type(f.type)
+        ef.set_data(f.data)
+        ef_dir.append(ef)
+    return ef_dir, error_ef
 
 
 def save_profile(mf="", adf="", gsm="", telecom="", folder="./profile/"):
-    import pickle
-    with open(folder + "mf.profile", "wb") as f:
-        pickle.dump(mf, f)
-    with open(folder + "mf.txt", 'w') as f:
-        f.write(str(mf))
-
-    with open(folder + "adf.profile", "wb") as f:
-        pickle.dump(adf, f)
-    with open(folder + "adf.txt", 'w') as f:
-        f.write(str(adf))
-
-    with open(folder + "gsm.profile", "wb") as f:
-        pickle.dump(gsm, f)
-    with open(folder + "gsm.txt", 'w') as f:
-        f.write(str(gsm))
-
-    with open(folder + "telecom.profile", "wb") as f:
-        pickle.dump(telecom, f)
-    with open(folder + "telecom.txt", 'w') as f:
-        f.write(str(telecom))
-
-
-def load_profile_single(s):
-    # print(s)
-    l = [k.strip("]").strip(":").strip().split("\n") for k in s.split("Name")[1:]]
-    ret = []
-    for record in l:
-        ef = EF(record[0])
-        ef.tp = record[1].strip().strip("Type").strip(":").strip()
-        ef.fci = record[2].strip().strip("FCI").strip(":").strip()
-        st = record[3].strip().strip("Data").strip(":").strip()
-        print(st)
-        if ef.tp == "transparent":
-            ef.data = st
-        else:
-            ef.data = [subst.strip().strip("'") for subst in st.strip('][').split(',')]
-        ret.append(ef)
-    return ret
-
-
-def load_profile(folder="./profile/"):
-    with open(folder + "mf.txt", "r") as f:
-        mf = load_profile_single(f.read())
+    write_profile(folder + PROFILE_NAME, zip(DFS, [mf, adf, gsm, telecom]))
 
-    with open(folder + "adf.txt", "r") as f:
-        adf = load_profile_single(f.read())
 
-    with open(folder + "gsm.txt", "r") as f:
-        gsm = load_profile_single(f.read())
+def iter_profile(df, folder="./profile/"):
+    """Yield the EFs of a DF of a profile one by one, as they are decoded"""
+    return iter_profile_folder(folder, df)
 
-    with open(folder + "telecom.txt", "r") as f:
-        telecom = load_profile_single(f.read())
 
-    return mf, adf, gsm, telecom
+def load_profile(folder="./profile/"):
+    return tuple(list(iter_profile(df, folder)) for df in DFS)
 
 
 if __name__ == '__main__':
@@ -223,7 +166,17 @@ if __name__ == '__main__':
     opts = parse_options()
 
     # Init card reader driver
-    if opts.pcsc_dev is not None:
+    if opts.replay is not None:
+        print("Replaying %s (latency: %s)" % (opts.replay, opts.latency))
+        from pySim.transport.replay import ReplaySimLink
+
+        sl = ReplaySimLink(opts.replay, latency=opts.latency)
+    elif opts.virtual is not None:
+        print("Using simulated card (profile=%s)" % opts.virtual)
+        from pySim.transport.virtual import VirtualCard, VirtualCardLink
+
+        sl = VirtualCardLink(VirtualCard.from_profile(opts.virtual))
+    elif opts.pcsc_dev is not None:
         print("Using PC/SC reader (dev=%d) interface"
               % opts.pcsc_dev)
         from pySim.transport.pcsc import PcscSimLink
@@ -255,15 +208,129 @@ if __name__ == '__main__':
     scc.send_apdu(ins='a4', p1='00', p2='00', data='3F00')
 
 
+    # Where the EFs of the DFs of a profile go
+    PARENTS = {'3F00': 'mf', '7F20': 'gsm', '7F10': 'telecom', '7FFF': 'adf'}
+
+    # With --snapshot-dir, what was written to the card last time, by the
+    # ICCID on the card
+    snapshot = None
+    snapshot_writer = None
+    snapshot_iccid = None
+    if opts.snapshot_dir:
+        scc.sel_ctrl = "0004"
+        try:
+            (data, sw) = scc.read_binary(['3f00', '2fe2'])
+        except RuntimeError:
+            # Nothing written to the card yet
+            sw = None
+        if sw == '9000':
+            filename = os.path.join(opts.snapshot_dir, dec_iccid(data) + ".profile")
+            if os.path.exists(filename):
+                print("Using snapshot %s" % filename)
+                snapshot = Profile(filename)
+        scc.send_apdu(ins='a4', p1='00', p2='00', data='3F00')
+        snapshot_writer = ProfileWriter(os.path.join(opts.snapshot_dir, "writing.profile"))
+
+    # Number of UPDATE commands sent and left out in --diff mode
+    diff_stats = [0, 0]
+
+    def write_apdu(ins, p1='00', p2='00', data='', sws=('9000',), **kwargs):
+        """send_apdu() for what has to succeed for the profile to be on the
+        card, raises on any other SW than those in sws"""
+        (res, sw), parsed = scc.send_apdu(ins=ins, p1=p1, p2=p2, data=data, **kwargs)
+        if sw not in sws:
+            raise RuntimeError("SW match failed! Expected %s and got %s." % ('/'.join(sws), sw))
+        return res, parsed
+
+    def read_EF(parsed):
+        """Read the contents of the selected EF, in the layout of EF.data"""
+        if parsed['82'][0:2] == '41':
+            size = int(parsed['80'], 16)
+            data = ''
+            while len(data) < size * 2:
+                ofs = len(data) // 2
+                (chunk, sw) = scc.send_apdu_without_length(ins='b0', p1='%02x' % (ofs >> 8), p2='%02x' % (ofs & 0xff),
+                                                           data='%02x' % min(size - ofs, 255), beautiful_print=False)
+                if sw != '9000':
+                    return None
+                data += chunk
+            return data
+        records = []
+        rec_len = int(parsed['82'][4:8], 16)
+        for i in range(int(parsed['82'][8:10], 16)):
+            (data, sw) = scc.send_apdu_without_length(ins='b2', p1='%02x' % (i + 1), p2='04',
+                                                      data='%02x' % rec_len, beautiful_print=False)
+            if sw != '9000':
+                return None
+            records.append(data)
+        return records
+
+    def current_EF(ef, df):
+        """Select ef and return what the card holds in it, or None if the
+        EF doesn't exist or has a different layout"""
+        (fci, sw), parsed = scc.send_apdu(ins='a4', p1='00', p2='04', data=ef.name, beautiful_print=False)
+        if sw != '9000' or parsed is None:
+            return None
+        if snapshot is not None and ef.name in snapshot.names(df):
+            old = snapshot.get(df, ef.name)
+            if old.fci == ef.fci and old.tp == ef.tp:
+                return old.data
+        new = decode_fcp(ef.fci)
+        if new is None or [parsed.get(tag) for tag in ('80', '82')] != [new.get(tag) for tag in ('80', '82')]:
+            return None
+        # Only transparent and linear fixed EFs are read back, by their
+        # file descriptor on the card
+        if {'41': 'transparent', '42': 'linear'}.get(parsed['82'][0:2]) != ef.tp:
+            return None
+        return read_EF(parsed)
+
+    def update_EF_diff(ef, old):
+        if ef.tp == "transparent":
+            for ofs, data in diff_hex(old, ef.data):
+                # UPDATE BINARY takes at most 255 bytes
+                for i in range(0, len(data), 510):
+                    chunk_ofs = ofs + i // 2
+                    write_apdu(ins='d6', p1='%02x' % (chunk_ofs >> 8), p2='%02x' % (chunk_ofs & 0xff),
+                               data=data[i:i + 510], parse_tlv=False, beautiful_print=False)
+                    diff_stats[0] += 1
+            if old == ef.data:
+                diff_stats[1] += 1
+        if ef.tp == "linear":
+            # Same as in write_EF, records of all 'f' are left out and the
+            # others are written one after the other from record 1 on
+            records = [record for record in ef.data if set(record) != set("f")]
+            for i, old_record in enumerate(old):
+                record = records[i] if i < len(records) else 'f' * len(old_record)
+                if record.lower() == old_record.lower():
+                    diff_stats[1] += 1
+                    continue
+                write_apdu(ins='dc', p1='%02x' % (i + 1), p2='04', data=record, parse_tlv=False, beautiful_print=False)
+                diff_stats[0] += 1
+
     def write_EF(ef, parent):
+        global snapshot_iccid
         print("===============")
         print(ef)
+        old = current_EF(ef, PARENTS[parent]) if opts.diff else None
+        if old is not None:
+            update_EF_diff(ef, old)
+        else:
+            create_EF(ef)
+        # Only what made it to the card goes into the snapshot
+        if snapshot_writer is not None:
+            snapshot_writer.add(PARENTS[parent], ef)
+            if ef.name.upper() == '2FE2' and ef.data:
+                snapshot_iccid = dec_iccid(ef.data)
+
+    def create_EF(ef):
         # scc.send_apdu(ins = 'a4',p1 = '00', p2 = '00', data = '3F00')
         # scc.send_apdu(ins = 'a4',p1 = '00', p2 = '00', data = parent)
-        scc.send_apdu(ins='e0', p1='00', p2='00', data=ef.fci)
-        scc.send_apdu(ins='a4', p1='00', p2='00', data=ef.name)
+        # An EF which --diff couldn't compare (e.g. a cyclic one) is there
+        # already (6a89), it is written over below
+        write_apdu(ins='e0', p1='00', p2='00', data=ef.fci, sws=('9000', '6a89'))
+        write_apdu(ins='a4', p1='00', p2='00', data=ef.name)
         if ef.tp == "transparent":
-            scc.send_apdu(ins='d6', p1='00', p2='00', data=ef.data)
+            write_apdu(ins='d6', p1='00', p2='00', data=ef.data)
             scc.send_apdu(ins='a4', p1='00', p2='00', data=ef.name)
             sw, data = scc.send_apdu_without_length(ins='b0', p1='00', p2='00', data='0a')
             print(sw, data)
@@ -275,34 +342,55 @@ if __name__ == '__main__':
                     continue
 
                 print(item)
-                sw, data = scc.send_apdu(ins='dc', p1='%02x' % (item), p2='04', data=record)
+                sw, data = write_apdu(ins='dc', p1='%02x' % (item), p2='04', data=record)
                 sw, data = scc.send_apdu_without_length(ins='b2', p1='%02x' % (item), p2='04', data=str(26))
 
                 item += 1
 
 
-    mf, adf, gsm, telecom = load_profile()
-    # print(mf)
-
-    # master file
-    for ef in mf:
-        write_EF(ef, '3F00')
-
-    scc.send_apdu(ins='a4', p1='00', p2='00', data='3F00')
-    scc.send_apdu(ins='e0', p1='00', p2='00',
-                  data="62308202782183027f20a51683027fffcb0d00000000000000000000000000ca01828a01058b032f0601c606900100830101")
-    for ef in gsm:
-        write_EF(ef, '7F20')
-
-    scc.send_apdu(ins='a4', p1='00', p2='00', data='3F00')
-    scc.send_apdu(ins='e0', p1='00', p2='00',
-                  data='62308202782183027f10a51683027fffcb0d00000000000000000000000000ca01828a01058b032f0601c606900100830101')
-    for ef in telecom:
-        write_EF(ef, '7F10')
-
-    scc.send_apdu(ins='a4', p1='00', p2='00', data='3F00')
-    scc._tp.send_apdu(
-        '00e000005962578202782183027fff8410a0000000871002ffffffff8907090000a51683027fffcb0d00000000000000000000000000ca01808a0105ab15800101a40683010a95010880014097008001069000c609900140830101830181')
-    # scc.send_apdu(ins='e0', p1='00', p2='00', data= '62308202782183027fffa51683027fffcb0d00000000000000000000000000ca01828a01058b032f0601c606900100830101')
-    for ef in adf:
-        write_EF(ef, '7FFF')
+    # Whatever went wrong, the snapshot of the last time stays
+    try:
+        # The EFs are written as they are read from the profile
+        # master file
+        for ef in iter_profile('mf'):
+            write_EF(ef, '3F00')
+
+        scc.send_apdu(ins='a4', p1='00', p2='00', data='3F00')
+        scc.send_apdu(ins='e0', p1='00', p2='00',
+                      data="62308202782183027f20a51683027fffcb0d00000000000000000000000000ca01828a01058b032f0601c606900100830101")
+        # The DF is already there if the card was written before, so only the
+        # SELECT has to succeed
+        write_apdu(ins='a4', p1='00', p2='00', data='7F20')
+        for ef in iter_profile('gsm'):
+            write_EF(ef, '7F20')
+
+        scc.send_apdu(ins='a4', p1='00', p2='00', data='3F00')
+        scc.send_apdu(ins='e0', p1='00', p2='00',
+                      data='62308202782183027f10a51683027fffcb0d00000000000000000000000000ca01828a01058b032f0601c606900100830101')
+        # The DF is already there if the card was written before, so only the
+        # SELECT has to succeed
+        write_apdu(ins='a4', p1='00', p2='00', data='7F10')
+        for ef in iter_profile('telecom'):
+            write_EF(ef, '7F10')
+
+        scc.send_apdu(ins='a4', p1='00', p2='00', data='3F00')
+        scc._tp.send_apdu(
+            '00e000005962578202782183027fff8410a0000000871002ffffffff8907090000a51683027fffcb0d00000000000000000000000000ca01808a0105ab15800101a40683010a95010880014097008001069000c609900140830101830181')
+        write_apdu(ins='a4', p1='00', p2='00', data='7FFF')
+        # scc.send_apdu(ins='e0', p1='00', p2='00', data= '62308202782183027fffa51683027fffcb0d00000000000000000000000000ca01828a01058b032f0601c606900100830101')
+        for ef in iter_profile('adf'):
+            write_EF(ef, '7FFF')
+    except:
+        if snapshot_writer is not None:
+            snapshot_writer.abort()
+        raise
+
+    if opts.diff:
+        print("Diff mode: %d updates sent, %d left out" % tuple(diff_stats))
+    if snapshot is not None:
+        snapshot.close()
+    if snapshot_writer is not None:
+        if snapshot_iccid:
+            snapshot_writer.close(os.path.join(opts.snapshot_dir, snapshot_iccid + ".profile"))
+        else:
+            snapshot_writer.abort()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python2
+
+#
+# APDU count and latency benchmark of the card classes in pySim.cards
+#
+# Runs program() and erase() of each card class against a simulated card
+# (pySim.transport.virtual), with the parameters pySim-prog.py would use
+# for the card in tests/pysim-test.sh (pysim-testdata/<card>.data), and
+# counts the APDUs by INS, the SELECTs and the bytes on the wire. The
+# time is estimated for a T=0 link at the given baud rate.
+#
+# Call from the pySim top directory, e.g.
+#   python contrib/cards-bench.py            compare against the baseline
+#   python contrib/cards-bench.py --update   store a new baseline
+#
+# Exits with 1 if a card needs more APDUs, SELECTs or bytes than in the
+# baseline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import defaultdict
+import imp
+import json
+from optparse import OptionParser
+import os
+import sys
+from StringIO import StringIO
+
+TOP = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, TOP)
+
+from pySim.apdu import Response
+from pySim.cards import _cards_classes
+from pySim.commands import SimCardCommands
+from pySim.transport.replay import LatencyModel, RecordingLink, CARD_PROCESSING
+from pySim.transport.virtual import VirtualCard, VirtualCardLink, VirtualFile, FCP_ADF_USIM, AID_USIM
+from pySim.utils import b2h, h2b, rpad
+
+# What tests/pysim-test.sh uses unless the .data file of a card says
+# otherwise
+DEFAULT_DATA = {
+	'MCC': '001',
+	'MNC': '01',
+	'ICCID': '1122334455667788990',
+	'KI': 'FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF',
+	'OPC': 'FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF',
+	'IMSI': '001010000000001',
+	'ADM': '00000000',
+	'ADM_HEX': '',
+}
+
+AID_ISIM = 'a0000000871004ffffffff8907090000'
+
+# Layout of the EFs the card classes write to: ('transparent', size) or
+# ('linear', record length, number of records). EFs not listed are
+# transparent with DEFAULT_SIZE bytes, FIDs in DFS are DFs.
+LAYOUT = {
+	'2fe2': ('transparent', 10),		# ICCID
+	'6f07': ('transparent', 9),		# IMSI
+	'6f30': ('transparent', 24),		# PLMNsel
+	'6f46': ('transparent', 17),		# SPN
+	'6f60': ('transparent', 40),		# PLMNwAcT
+	'6f61': ('transparent', 40),		# OPLMNwAcT
+	'6f62': ('transparent', 40),		# HPLMNwAcT
+	'6f78': ('transparent', 2),		# ACC
+	'6fad': ('transparent', 4),		# AD
+	'6f42': ('linear', 52, 2),		# SMSP
+	'000c': ('linear', 0x5a, 4),		# FakeMagicSim provider records
+	'00ff': ('transparent', 16),		# SJS1 Ki
+	'00f7': ('transparent', 17),		# SJS1 OPc
+	'0001': ('transparent', 19),		# GR2 Ki
+	'ff01': ('transparent', 17),		# Fairwaves, OpenCells OP/OPc
+	'ff02': ('transparent', 16),		# Fairwaves, OpenCells Ki
+	'6f20': ('transparent', 33),		# SJA2 Ki/OPc
+	'af20': ('transparent', 33),		# SJA2 Ki/OPc in the ADFs
+}
+DEFAULT_SIZE = 32
+DFS = ('7f10', '7f20', '7f4d', '7ff0', 'a515')
+
+# Cards with a different SMSP record length, i.e. what their program()
+# writes
+SMSP_LEN = {
+	'grcardsim': 40,
+	'sysmosim-gr1': 40,
+	'sysmoSIM-GR2': 40,
+	'Fairwaves-SIM': 42,
+	'Wavemobile-SIM': 42,
+}
+
+# Numbers compared against the baseline
+METRICS = ('apdus', 'selects', 'bytes')
+
+
+def _fcp(fid, layout):
+	if fid in DFS:
+		tlvs = '82027821' + '8302' + fid
+	elif layout[0] == 'transparent':
+		tlvs = '82024121' + '8302' + fid + '8002%04x' % layout[1]
+	else:
+		tlvs = '82054221%04x%02x' % layout[1:] + '8302' + fid + '8002%04x' % (layout[1] * layout[2])
+	return '62%02x' % (len(tlvs) // 2) + tlvs
+
+
+def card_layout(kls):
+	"""The EF layout for a card class"""
+	layout = dict(LAYOUT)
+	if kls.name in SMSP_LEN:
+		layout['6f42'] = ('linear', SMSP_LEN[kls.name], 2)
+	# The magic SIMs keep one record per provider, see _MagicSimBase
+	for fid, rec_len, t in getattr(kls, '_files', {}).values():
+		layout[fid] = ('linear', rec_len, 4)
+	return layout
+
+
+def _dir_record(aid, label):
+	rec = '4f%02x' % (len(aid) // 2) + aid + '50%02x' % len(label) + b2h(label)
+	return rpad('61%02x' % (len(rec) // 2) + rec, 64)
+
+
+def blank_card():
+	"""A card with EF.DIR and the USIM and ISIM ADFs, everything else is
+	created by BenchLink as it is selected"""
+	card = VirtualCard()
+	ef_dir = card.create(card.mf, _fcp('2f00', ('linear', 32, 2)))
+	for i, (aid, label) in enumerate([(AID_USIM, 'USIM'), (AID_ISIM, 'ISIM')]):
+		ef_dir.data[i][:] = h2b(_dir_record(aid, label))
+	card.adfs.append(VirtualFile('7fff', FCP_ADF_USIM))
+	card.adfs.append(VirtualFile('7fff', FCP_ADF_USIM.replace(AID_USIM, AID_ISIM)))
+	return card
+
+
+class BenchLink(VirtualCardLink):
+	"""
+	A VirtualCardLink on which every file a card class selects exists,
+	laid out as in layout. PINs are not checked and proprietary commands
+	(e.g. for writing Ki) are accepted.
+	"""
+
+	def __init__(self, card, layout):
+		VirtualCardLink.__init__(self, card)
+		self.layout = layout
+
+	def transceive(self, apdu):
+		if apdu.ins == 0x20:
+			return Response(b'', 0x90, 0x00)
+		rsp = VirtualCardLink.transceive(self, apdu)
+		if rsp.sw == 0x6d00:
+			return Response(b'', 0x90, 0x00)
+		if rsp.sw == 0x6a82 and apdu.p1 == 0x00 and len(apdu.data) == 2:
+			fid = b2h(apdu.data.tobytes())
+			layout = self.layout.get(fid, ('transparent', DEFAULT_SIZE))
+			self.card.create(self._df, _fcp(fid, layout))
+			rsp = VirtualCardLink.transceive(self, apdu)
+		return rsp
+
+
+def read_data(filename):
+	"""The variables set in a .data file of pysim-testdata"""
+	data = dict(DEFAULT_DATA)
+	if filename is not None and os.path.exists(filename):
+		with open(filename) as f:
+			for line in f:
+				line = line.strip()
+				if '=' in line and not line.startswith('#'):
+					k, v = line.split('=', 1)
+					data[k] = v.strip('"')
+	return data
+
+
+def card_params(prog, kls, data):
+	"""The parameters pySim-prog.py generates with the command line of
+	tests/pysim-test.sh"""
+	if data['ADM_HEX']:
+		adm = ['-A', data['ADM_HEX']]
+	else:
+		adm = ['-a', data['ADM']]
+	opts = prog.parse_options(['-t', kls.name, '-o', data['OPC'], '-k', data['KI'],
+		'-x', data['MCC'], '-y', data['MNC'], '-i', data['IMSI'], '-s', data['ICCID']] + adm)
+	return prog.gen_parameters(opts)
+
+
+def run(kls, method, params, template, layout, latency):
+	"""Call program or erase of a card of class kls, return its numbers"""
+	link = RecordingLink(BenchLink(template.copy(), layout))
+	card = kls(SimCardCommands(transport=link))
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		if method == 'program':
+			card.program(params)
+		else:
+			card.erase()
+	finally:
+		sys.stdout = stdout
+
+	by_ins = defaultdict(int)
+	res = {'apdus': 0, 'bytes': 0, 'time': 0.0}
+	for t, duration, apdu, rsp in link.records:
+		by_ins['%02x' % apdu.ins] += 1
+		res['apdus'] += 1
+		# Command, response data and SW
+		res['bytes'] += len(apdu.buf) + len(rsp.data) + 2
+		res['time'] += latency.delay(apdu, rsp)
+	res['selects'] = by_ins.get('a4', 0)
+	res['time'] = round(res['time'], 6)
+	res['ins'] = dict(by_ins)
+	return res
+
+
+def compare(name, res, base):
+	"""Print one result line, return whether it regressed"""
+	line = "%-28s %6d %7d %8d %9.3f" % (name, res['apdus'], res['selects'], res['bytes'], res['time'])
+	regressed = False
+	if base is not None:
+		worse = [m for m in METRICS if res[m] > base[m]]
+		better = [m for m in METRICS if res[m] < base[m]]
+		if worse:
+			regressed = True
+			line += "  REGRESSION: " + ", ".join("%s %d -> %d" % (m, base[m], res[m]) for m in worse)
+		elif better:
+			line += "  improved: " + ", ".join("%s %d -> %d" % (m, base[m], res[m]) for m in better)
+	print(line)
+	return regressed
+
+
+if __name__ == '__main__':
+	parser = OptionParser(usage="usage: %prog [options]")
+	parser.add_option("-b", "--baud", dest="baudrate", type="int", metavar="BAUD",
+			help="Baudrate to estimate the time for [default: %default]",
+			default=9600,
+		)
+	parser.add_option("-t", "--type", dest="types", action="append", metavar="TYPE",
+			help="Only benchmark this card type, may be given several times",
+			default=None,
+		)
+	parser.add_option("--data-dir", dest="data_dir", metavar="DIR",
+			help="Where the .data files are [default: %default]",
+			default=os.path.join(TOP, 'pysim-testdata'),
+		)
+	parser.add_option("--baseline", dest="baseline", metavar="FILE",
+			help="Baseline to compare against [default: %default]",
+			default=os.path.join(TOP, 'contrib', 'cards-bench.json'),
+		)
+	parser.add_option("--update", dest="update", action="store_true",
+			help="Store the results as new baseline",
+			default=False,
+		)
+	parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
+			help="Also show the APDUs by INS",
+			default=False,
+		)
+	(opts, args) = parser.parse_args()
+	if args:
+		parser.error("Extraneous arguments")
+
+	prog = imp.load_source('pysim_prog', os.path.join(TOP, 'pySim-prog.py'))
+	latency = LatencyModel(0.0, 12.0 / opts.baudrate, CARD_PROCESSING)
+	baseline = {}
+	if not opts.update and os.path.exists(opts.baseline):
+		with open(opts.baseline) as f:
+			baseline = json.load(f)
+
+	print("%-28s %6s %7s %8s %9s" % ("card", "APDUs", "SELECTs", "bytes", "time (s)"))
+	results = {}
+	regressed = False
+	template = blank_card()
+	for kls in _cards_classes:
+		if opts.types and kls.name not in opts.types:
+			continue
+		data = read_data(os.path.join(opts.data_dir, kls.name + '.data'))
+		params = card_params(prog, kls, data)
+		layout = card_layout(kls)
+		for method in ('program', 'erase'):
+			if not hasattr(kls, method):
+				continue
+			name = '%s.%s' % (kls.name, method)
+			try:
+				res = run(kls, method, params, template, layout, latency)
+			except Exception as e:
+				print("%-28s failed: %s" % (name, e))
+				regressed = True
+				continue
+			results[name] = res
+			if compare(name, res, baseline.get(name)):
+				regressed = True
+			if opts.verbose and res['ins']:
+				print("    " + " ".join("%s:%d" % i for i in sorted(res['ins'].items())))
+
+	if opts.update:
+		with open(opts.baseline, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True, separators=(',', ': '))
+			f.write('\n')
+		print("Baseline written to %s" % opts.baseline)
+	elif regressed:
+		sys.exit(1)
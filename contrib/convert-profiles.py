@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+
+#
+# Convert profile folders written by older versions of the read scripts
+# (one DF.txt per DF) into a single binary profile file, see
+# pySim/profiles.py
+#
+# Call from the pySim top directory, e.g.
+#   python contrib/convert-profiles.py profile profile2
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from optparse import OptionParser
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pySim.profiles import DFS, PROFILE_NAME, parse_text_profile, save_profile
+
+
+def convert(folder, force):
+	filename = os.path.join(folder, PROFILE_NAME)
+	if os.path.exists(filename) and not force:
+		print("%s: already converted" % folder)
+		return
+	dfs = []
+	for df in DFS:
+		with open(os.path.join(folder, df + ".txt"), "r") as f:
+			dfs.append((df, parse_text_profile(f.read())))
+	save_profile(filename, dfs)
+	print("%s: %d EFs" % (folder, sum([len(efs) for df, efs in dfs])))
+
+
+if __name__ == '__main__':
+	parser = OptionParser(usage="usage: %prog [options] FOLDER...")
+	parser.add_option("-f", "--force", dest="force", action="store_true",
+			help="Convert again if there already is a binary profile",
+			default=False,
+		)
+	(opts, args) = parser.parse_args()
+
+	if not args:
+		parser.error("No profile folder given")
+
+	for folder in args:
+		convert(folder, opts.force)
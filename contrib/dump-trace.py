@@ -0,0 +1,53 @@
+#!/usr/bin/env python2
+
+#
+# Print an APDU trace written by pySim/trace.py, one APDU per line:
+#   time  duration(ms)  APDU  response-data  SW
+#
+# Call from the pySim top directory, e.g.
+#   PYSIM_TRACE=/tmp/apdu.trace ./pySim-read.py -p 0
+#   python contrib/dump-trace.py /tmp/apdu.trace
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pySim.trace import read_trace
+
+
+if __name__ == '__main__':
+	parser = OptionParser(usage="usage: %prog [options] TRACE...")
+	parser.add_option("-r", "--raw", dest="raw", action="store_true",
+			help="Only print the APDUs, like /tmp/pdu.txt used to",
+			default=False,
+		)
+	(opts, args) = parser.parse_args()
+
+	if not args:
+		parser.error("No trace file given")
+
+	for filename in args:
+		for t, duration, apdu, rsp in read_trace(filename):
+			if opts.raw:
+				print(apdu.hex())
+				continue
+			data, sw = rsp
+			print("%s.%03d %7.1f %s %s %s" % (time.strftime("%H:%M:%S", time.localtime(t)),
+				int(t * 1000) % 1000, duration * 1000, apdu.hex(), data or '-', sw or '----'))
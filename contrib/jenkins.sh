@@ -14,6 +14,9 @@ virtualenv -p python2 venv --system-site-packages
 pip install pytlv
 pip install pyyaml
 
+# APDU counts of the card classes against the simulated card
+python contrib/cards-bench.py
+
 cd pysim-testdata
 ../tests/pysim-test.sh
 
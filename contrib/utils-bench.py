@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+
+#
+# Micro benchmarks for the helpers in pySim.utils
+#
+# Call from the pySim top directory, e.g. python contrib/utils-bench.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from optparse import OptionParser
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pySim.utils import *
+
+
+def bench(name, fn, number):
+	t = min(timeit.repeat(fn, number=number, repeat=3))
+	print("%-40s %10.2f us" % (name, t / number * 1e6))
+	return t
+
+
+# The character by character codecs pySim.utils used to have, kept here
+# to compare against
+def h2b_ref(s):
+	return ''.join([chr((int(x,16)<<4)+int(y,16)) for x,y in zip(s[0::2], s[1::2])])
+
+def b2h_ref(s):
+	return ''.join(['%02x'%ord(x) for x in s])
+
+def h2i_ref(s):
+	return [(int(x,16)<<4)+int(y,16) for x,y in zip(s[0::2], s[1::2])]
+
+def i2h_ref(s):
+	return ''.join(['%02x'%(x) for x in s])
+
+
+# APDU header, SELECT, full short APDU, typical and large transparent EF
+CODEC_SIZES = [5, 7, 26, 255, 1024, 4096]
+
+def bench_codecs(opts):
+	print("Hex codecs, %d calls each:" % opts.calls)
+	for size in CODEC_SIZES:
+		b = os.urandom(size)
+		h = b2h(b)
+		i = h2i(h)
+		for name, ref, new, arg in [
+				('h2b', h2b_ref, h2b, h),
+				('b2h', b2h_ref, b2h, b),
+				('h2i', h2i_ref, h2i, h),
+				('i2h', i2h_ref, i2h, i),
+			]:
+			t1 = bench("%s_ref %d bytes" % (name, size),
+				lambda: ref(arg), opts.calls)
+			t2 = bench("%s %d bytes" % (name, size),
+				lambda: new(arg), opts.calls)
+			print("%-40s %10.1fx" % ("speedup", t1 / t2))
+
+
+def bench_milenage(opts):
+	print("Milenage OPC derivation for %d cards:" % opts.cards)
+	kis = os.urandom(16 * opts.cards)
+	ki_hex = [b2h(kis[i:i+16]) for i in range(0, len(kis), 16)]
+	op = os.urandom(16)
+	op_hex = b2h(op)
+
+	t1 = bench("derive_milenage_opc (per card, hex)",
+		lambda: [derive_milenage_opc(ki, op_hex) for ki in ki_hex], 1)
+	t2 = bench("derive_milenage_opcs (batch, bytes)",
+		lambda: derive_milenage_opcs(kis, op), 1)
+	print("%-40s %10.1fx" % ("speedup", t1 / t2))
+
+
+if __name__ == '__main__':
+	parser = OptionParser(usage="usage: %prog [options]")
+	parser.add_option("-n", "--cards", dest="cards", type="int",
+			help="Number of cards for the batch benchmarks [default: %default]",
+			default=10000,
+		)
+	parser.add_option("-c", "--calls", dest="calls", type="int",
+			help="Number of calls for the codec benchmarks [default: %default]",
+			default=1000,
+		)
+	(opts, args) = parser.parse_args()
+
+	bench_codecs(opts)
+	bench_milenage(opts)
@@ -24,12 +24,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import atexit
+import binascii
+import copy
 import hashlib
 from optparse import OptionParser
 import os
 import random
 import re
 import sys
+import threading
+import time
 import traceback
 
 try:
@@ -45,26 +50,56 @@ from pySim.ts_51_011 import EF
 from pySim.card_handler import *
 from pySim.utils import *
 
-def parse_options():
+def parse_options(argv=None):
 
 	parser = OptionParser(usage="usage: %prog [options]")
 
 	parser.add_option("-d", "--device", dest="device", metavar="DEV",
-			help="Serial Device for SIM access [default: %default]",
+			help="Serial Device for SIM access, give several devices separated by ',' to program cards in parallel (batch mode only) [default: %default]",
 			default="/dev/ttyUSB0",
 		)
 	parser.add_option("-b", "--baud", dest="baudrate", type="int", metavar="BAUD",
 			help="Baudrate used for SIM access [default: %default]",
 			default=9600,
 		)
+	parser.add_option("--presence", dest="presence", metavar="LINE",
+			type="choice", choices=["cd", "-cd", "dsr", "-dsr", "cts", "-cts", "ri", "-ri"],
+			help="Modem line of the serial reader telling whether a card is in (cd, dsr, cts, ri, '-' if low with a card)",
+			default=None,
+		)
 	parser.add_option("-p", "--pcsc-device", dest="pcsc_dev", type='int', metavar="PCSC",
 			help="Which PC/SC reader number for SIM access",
 			default=None,
 		)
+	parser.add_option("--pcsc-all", dest="pcsc_all", action="store_true",
+			help="Program cards in parallel on all PC/SC readers (batch mode only)",
+			default=False,
+		)
+	parser.add_option("--pcsc-exclusive", dest="pcsc_exclusive", action="store_true",
+			help="Don't let other applications use the cards in the PC/SC readers meanwhile",
+			default=False,
+		)
+	parser.add_option("--pcsc-cold-reset", dest="pcsc_cold_reset", action="store_true",
+			help="Reset cards in PC/SC readers by powering them down, not by a warm reset",
+			default=False,
+		)
 	parser.add_option("--osmocon", dest="osmocon_sock", metavar="PATH",
 			help="Socket path for Calypso (e.g. Motorola C1XX) based reader (via OsmocomBB)",
 			default=None,
 		)
+	parser.add_option("--replay", dest="replay", metavar="TRACE",
+			help="Instead of a card, answer with the responses from an APDU trace or log",
+			default=None,
+		)
+	parser.add_option("--latency", dest="latency", metavar="MODEL",
+			type="choice", choices=["none", "recorded", "serial", "pcsc", "calypso"],
+			help="Latency of the replayed APDUs (none, recorded, serial, pcsc, calypso) [default: %default]",
+			default="none",
+		)
+	parser.add_option("--virtual", dest="virtual", metavar="PROFILE",
+			help="Instead of a card, use a simulated one with the files of a saved profile folder",
+			default=None,
+		)
 	parser.add_option("-t", "--type", dest="type",
 			help="Card type (user -t list to view) [default: %default]",
 			default="auto",
@@ -150,6 +185,9 @@ def parse_options():
 	parser.add_option("--batch-state", dest="batch_state", metavar="FILE",
 			help="Optional batch state file",
 		)
+	parser.add_option("--bulk-gen", dest="bulk_gen", type="int", metavar="N",
+			help="Don't program any card, only generate the parameters for N cards into the --write-csv file",
+		)
 
 	# if mode is "csv"
 	parser.add_option("--read-csv", dest="read_csv", metavar="FILE",
@@ -159,9 +197,33 @@ def parse_options():
 	parser.add_option("--write-csv", dest="write_csv", metavar="FILE",
 			help="Append generated parameters in CSV file",
 		)
+	parser.add_option("--csv-flush-rows", dest="csv_flush_rows", type="int", metavar="N",
+			help="Flush the output CSV file after N cards, with --batch-state after every card anyway [default: %default]",
+			default=1,
+		)
+	parser.add_option("--csv-flush-interval", dest="csv_flush_interval", type="float", metavar="SEC",
+			help="Flush the output CSV file at the latest SEC seconds after a card was added [default: %default]",
+			default=10.0,
+		)
+	parser.add_option("--csv-fsync", dest="csv_fsync", action="store_true",
+			help="fsync() the output CSV file on every flush",
+			default=False,
+		)
+	parser.add_option("--csv-max-size", dest="csv_max_size", type="int", metavar="BYTES",
+			help="Rotate the output CSV file to FILE.1, FILE.2, ... once it reaches BYTES (0 = never) [default: %default]",
+			default=0,
+		)
 	parser.add_option("--write-hlr", dest="write_hlr", metavar="FILE",
 			help="Append generated parameters to OpenBSC HLR sqlite3",
 		)
+	parser.add_option("--hlr-batch", dest="hlr_batch", type="int", metavar="N",
+			help="Number of cards written to the HLR per transaction, with --batch-state after every card anyway [default: %default]",
+			default=1,
+		)
+	parser.add_option("--hlr-dry-run", dest="hlr_dry_run", action="store_true",
+			help="Only validate the parameters for the HLR, don't write them",
+			default=False,
+		)
 	parser.add_option("--dry-run", dest="dry_run",
 			help="Perform a 'dry run', don't actually program the card",
 			default=False, action="store_true")
@@ -169,7 +231,10 @@ def parse_options():
 	parser.add_option("--card_handler", dest="card_handler", metavar="FILE",
 			help="Use automatic card handling machine")
 
-	(options, args) = parser.parse_args()
+	# Numbers given back by failed cards, kept in the batch state
+	parser.set_defaults(free=[])
+
+	(options, args) = parser.parse_args(argv)
 
 	if options.type == 'list':
 		for kls in _cards_classes:
@@ -179,6 +244,16 @@ def parse_options():
 	if options.probe:
 		return options
 
+	if options.bulk_gen is not None:
+		if options.source != 'cmdline':
+			parser.error("Bulk generation only works with source `cmdline'")
+		if options.write_csv is None:
+			parser.error("Bulk generation requires a CSV output file")
+		if (options.imsi is not None) or (options.iccid is not None) or (options.ki is not None):
+			parser.error("Can't give ICCID/IMSI/Ki for bulk generation")
+		if options.num is None:
+			options.num = 0
+
 	if options.source == 'csv':
 		if (options.imsi is None) and (options.batch_mode is False) and (options.read_imsi is False) and (options.read_iccid is False):
 			parser.error("CSV mode needs either an IMSI, --read-imsi, --read-iccid or batch mode")
@@ -200,6 +275,12 @@ def parse_options():
 		if (options.imsi is not None) or (options.iccid is not None):
 			parser.error("Can't give ICCID/IMSI for batch mode, need to use automatic parameters ! see --num and --secret for more informations")
 
+	if (options.pcsc_all) or (',' in options.device):
+		if not options.batch_mode:
+			parser.error("Programming on several readers requires batch mode")
+		if options.card_handler:
+			parser.error("Programming on several readers doesn't work with a card handler")
+
 	if args:
 		parser.error("Extraneous arguments")
 
@@ -211,6 +292,28 @@ def _digits(secret, usage, len, num):
 	d = ''.join(['%02d'%ord(x) for x in s.digest()])
 	return d[0:len]
 
+def _digits_bulk(secret, usage, len, nums):
+	"""Same as _digits() for each of nums, but only hashes the common
+	part of the input once"""
+	h = hashlib.sha1(secret + usage)
+	fmt = '%02d' * h.digest_size
+	for num in nums:
+		s = h.copy()
+		s.update('%d' % num)
+		yield (fmt % tuple(bytearray(s.digest())))[0:len]
+
+_LUHN_PLAIN = dict([('%d' % d, d) for d in range(10)])
+_LUHN_DOUBLE = dict([('%d' % d, sum(divmod(d * 2, 10))) for d in range(10)])
+
+def _luhn_bulk(prefix, bodies):
+	"""Same as calculate_luhn(prefix + body) for each of bodies"""
+	for body in bodies:
+		# Every other digit is doubled, starting with the last one
+		digits = prefix + body
+		total = sum(map(_LUHN_DOUBLE.__getitem__, digits[::-2])) + \
+			sum(map(_LUHN_PLAIN.__getitem__, digits[-2::-2]))
+		yield (10 - total % 10) % 10
+
 def _mcc_mnc_digits(mcc, mnc):
 	return ('%03d%03d' if mnc > 100 else '%03d%02d') % (mcc, mnc)
 
@@ -225,38 +328,6 @@ def _ishex(s, l=-1):
 	return all([x in hc for x in s.lower()]) and ((l== -1) or (len(s) == l))
 
 
-def _dbi_binary_quote(s):
-	# Count usage of each char
-	cnt = {}
-	for c in s:
-		cnt[c] = cnt.get(c, 0) + 1
-
-	# Find best offset
-	e = 0
-	m = len(s)
-	for i in range(1, 256):
-		if i == 39:
-			continue
-		sum_ = cnt.get(i, 0) + cnt.get((i+1)&0xff, 0) + cnt.get((i+39)&0xff, 0)
-		if sum_ < m:
-			m = sum_
-			e = i
-			if m == 0:	# No overhead ? use this !
-				break;
-
-	# Generate output
-	out = []
-	out.append( chr(e) )	# Offset
-	for c in s:
-		x = (256 + ord(c) - e) % 256
-		if x in (0, 1, 39):
-			out.append('\x01')
-			out.append(chr(x+1))
-		else:
-			out.append(chr(x))
-
-	return ''.join(out)
-
 def gen_parameters(opts):
 	"""Generates Name, ICCID, MCC, MNC, IMSI, SMSP, Ki, PIN-ADM from the
 	options given by the user"""
@@ -425,6 +496,53 @@ def gen_parameters(opts):
 	}
 
 
+def gen_parameters_bulk(opts, count, chunk=4096):
+	"""Generates the parameters for count cards, starting at card number
+	opts.num. ICCID and IMSI are the same as gen_parameters() gives for
+	each number, so the result is reproducible for a given --secret. Ki
+	and OPC are taken from os.urandom() for a whole chunk of cards at once"""
+
+	# Let gen_parameters() check the options and do all that is the
+	# same for every card
+	p = gen_parameters(opts)
+	plmn_digits = _mcc_mnc_digits(p['mcc'], p['mnc'])
+	iccid_prefix = '89' + _cc_digits(opts.country) + plmn_digits
+	iccid_len = 18 - len(iccid_prefix)
+	msin_len = 15 - len(plmn_digits)
+
+	for start in range(opts.num, opts.num + count, chunk):
+		nums = range(start, min(start + chunk, opts.num + count))
+
+		if opts.secret is None:
+			iccids = [('%%0%dd' % iccid_len) % num for num in nums]
+			msins = [('%%0%dd' % msin_len) % num for num in nums]
+		else:
+			iccids = list(_digits_bulk(opts.secret, 'ccid', iccid_len, nums))
+			msins = list(_digits_bulk(opts.secret, 'imsi', msin_len, nums))
+		luhns = _luhn_bulk(iccid_prefix, iccids)
+
+		# Ki, and OPC unless it is given or derived
+		rnd = os.urandom(32 * len(nums))
+		rnd_hex = binascii.hexlify(rnd)
+		if opts.opc is None and opts.op is not None:
+			opcs = derive_milenage_opcs([rnd[32*i:32*i + 16] for i in range(len(nums))], h2b(opts.op))
+
+		for i in range(len(nums)):
+			ki = rnd_hex[64*i:64*i + 32]
+			if opts.opc is not None:
+				opc = p['opc']
+			elif opts.op is not None:
+				opc = b2h(opcs[i])
+			else:
+				opc = rnd_hex[64*i + 32:64*i + 64]
+			q = p.copy()
+			q['iccid'] = iccid_prefix + iccids[i] + ('%1d' % next(luhns))
+			q['imsi'] = plmn_digits + msins[i]
+			q['ki'] = ki
+			q['opc'] = opc
+			yield q
+
+
 def print_parameters(params):
 
 	s = ["Generated card parameters :"]
@@ -443,43 +561,189 @@ def print_parameters(params):
 	print("\n".join(s) % params)
 
 
+class CsvWriter(object):
+	"""Appends the parameters of programmed cards to the output CSV file.
+	The file is kept open and flushed every flush_rows cards, or at the
+	latest flush_interval seconds after a card was added, and optionally
+	fsync()ed on each flush. Without flush_rows and flush_interval, it is
+	flushed only by flush(), close() and when rotating. Once the file
+	reaches max_size bytes it is renamed to the next free FILE.<n> and a
+	new file is started."""
+
+	FIELDS = ['name', 'iccid', 'mcc', 'mnc', 'imsi', 'smsp', 'ki', 'opc']
+
+	def __init__(self, filename, flush_rows=100, flush_interval=10.0, fsync=False, max_size=0):
+		self._filename = filename
+		self._flush_rows = max(flush_rows, 1) if flush_rows is not None else None
+		self._flush_interval = flush_interval
+		self._fsync = fsync
+		self._max_size = max_size
+		self._lock = threading.Lock()
+		self._f = None
+		self._pending = 0
+		self._timer = None
+
+	def _open(self):
+		import csv
+		self._f = open(self._filename, 'a', 65536)
+		self._cw = csv.writer(self._f)
+		if self._max_size and os.fstat(self._f.fileno()).st_size >= self._max_size:
+			self._rotate()
+
+	def _rotate(self):
+		self._flush()
+		self._f.close()
+		n = 1
+		while os.path.exists('%s.%d' % (self._filename, n)):
+			n += 1
+		os.rename(self._filename, '%s.%d' % (self._filename, n))
+		self._open()
+
+	def write(self, params):
+		with self._lock:
+			if self._f is None:
+				self._open()
+			self._cw.writerow([params[x] for x in self.FIELDS])
+			self._pending += 1
+			if self._flush_rows is not None and self._pending >= self._flush_rows:
+				self._flush()
+			elif self._flush_interval is not None and self._timer is None:
+				# Rows of programmed cards don't wait for the next card
+				# to be written out
+				self._timer = threading.Timer(self._flush_interval, self.flush)
+				self._timer.daemon = True
+				self._timer.start()
+			if self._max_size and self._f.tell() >= self._max_size:
+				self._rotate()
+
+	def _flush(self):
+		if self._timer is not None:
+			self._timer.cancel()
+			self._timer = None
+		if self._f is None:
+			return
+		self._f.flush()
+		if self._fsync:
+			os.fsync(self._f.fileno())
+		self._pending = 0
+
+	def flush(self):
+		with self._lock:
+			self._flush()
+
+	def close(self):
+		with self._lock:
+			timer = self._timer
+			self._flush()
+			if self._f is not None:
+				self._f.close()
+				self._f = None
+		# Outside the lock, the timer may be waiting for it
+		if timer is not None:
+			timer.join()
+
+_csv_writer = None
+
 def write_params_csv(opts, params):
 	# csv
+	global _csv_writer
 	if opts.write_csv:
+		if _csv_writer is None:
+			_csv_writer = CsvWriter(opts.write_csv, opts.csv_flush_rows,
+					opts.csv_flush_interval, opts.csv_fsync, opts.csv_max_size)
+		_csv_writer.write(params)
+
+class CsvIndex(object):
+	"""Index of the rows of the CSV input file by row number, ICCID and
+	IMSI. Only the file offset of each row is kept in memory, the row
+	itself is parsed when it is looked up. The index is rebuilt whenever
+	the file changes."""
+
+	def __init__(self, filename):
+		self._filename = filename
+		self._lock = threading.Lock()
+		self._f = None
+		self._stamp = None
+
+	def _build(self):
+		import csv
+
+		if self._f is not None:
+			self._f.close()
+		self._f = f = open(self._filename, 'r')
+
+		# Keep track of the offset of each line that the csv module
+		# consumes, the start of a row is where the previous row ended.
+		pos = [0]
+		def lines():
+			while True:
+				line = f.readline()
+				if not line:
+					return
+				pos[0] += len(line)
+				yield line
+		cr = csv.reader(lines())
+
+		# Lower-case fieldnames
+		self._fieldnames = [ field.lower() for field in next(cr, []) ]
+		if not 'iccid' in self._fieldnames:
+			raise Exception("CSV file in wrong format!")
+		iccid_col = self._fieldnames.index('iccid')
+		imsi_col = self._fieldnames.index('imsi') if 'imsi' in self._fieldnames else None
+
+		self._offsets = []
+		self._iccids = {}
+		self._imsis = {}
+		start = pos[0]
+		for row in cr:
+			# Like csv.DictReader, skip empty rows
+			if row:
+				i = len(self._offsets)
+				self._offsets.append(start)
+				if len(row) > iccid_col:
+					self._iccids.setdefault(row[iccid_col], i)
+				if imsi_col is not None and len(row) > imsi_col:
+					self._imsis.setdefault(row[imsi_col], i)
+			start = pos[0]
+
+	def lookup(self, num=None, iccid=None, imsi=None):
+		"""Find the first row which is either row number num, or matches
+		the ICCID or IMSI given"""
 		import csv
-		row = ['name', 'iccid', 'mcc', 'mnc', 'imsi', 'smsp', 'ki', 'opc']
-		f = open(opts.write_csv, 'a')
-		cw = csv.writer(f)
-		cw.writerow([params[x] for x in row])
-		f.close()
+
+		with self._lock:
+			st = os.stat(self._filename)
+			stamp = (st.st_ino, st.st_size, st.st_mtime)
+			if stamp != self._stamp:
+				self._build()
+				self._stamp = stamp
+
+			rows = []
+			if num is not None and num < len(self._offsets):
+				rows.append(num)
+			if iccid in self._iccids:
+				rows.append(self._iccids[iccid])
+			if imsi in self._imsis:
+				rows.append(self._imsis[imsi])
+			if not rows:
+				return None
+
+			self._f.seek(self._offsets[min(rows)])
+			return next(csv.DictReader(self._f, fieldnames=self._fieldnames))
+
+_csv_indexes = {}
+_csv_indexes_lock = threading.Lock()
 
 def _read_params_csv(opts, iccid=None, imsi=None):
-	import csv
-	f = open(opts.read_csv, 'r')
-	cr = csv.DictReader(f)
-
-	# Lower-case fieldnames
-	cr.fieldnames = [ field.lower() for field in cr.fieldnames ]
-
-	i = 0
-	if not 'iccid' in cr.fieldnames:
-		raise Exception("CSV file in wrong format!")
-	for row in cr:
-		if opts.num is not None and opts.read_iccid is False and opts.read_imsi is False:
-			if opts.num == i:
-				f.close()
-				return row;
-			i += 1
-		if row['iccid'] == iccid:
-			f.close()
-			return row;
-
-		if row['imsi'] == imsi:
-			f.close()
-			return row;
-
-	f.close()
-	return None
+	with _csv_indexes_lock:
+		if opts.read_csv not in _csv_indexes:
+			_csv_indexes[opts.read_csv] = CsvIndex(opts.read_csv)
+		index = _csv_indexes[opts.read_csv]
+
+	num = None
+	if opts.num is not None and opts.read_iccid is False and opts.read_imsi is False:
+		num = opts.num
+	return index.lookup(num=num, iccid=iccid, imsi=imsi)
 
 def read_params_csv(opts, imsi=None, iccid=None):
 	row = _read_params_csv(opts, iccid=iccid, imsi=imsi)
@@ -514,43 +778,43 @@ def read_params_csv(opts, imsi=None, iccid=None):
 	return row
 
 
+_hlr_writer = None
+
 def write_params_hlr(opts, params):
 	# SQLite3 OpenBSC HLR
+	global _hlr_writer
+	if opts.write_hlr:
+		if _hlr_writer is None:
+			from pySim.hlr import HlrWriter
+			_hlr_writer = HlrWriter(opts.write_hlr, opts.hlr_batch, opts.hlr_dry_run)
+		_hlr_writer.write(params)
+
+def validate_parameters(opts, params):
+	"""Raise ValueError if params can't be written where the options say,
+	to be checked before a card is programmed with them"""
 	if opts.write_hlr:
-		import sqlite3
-		conn = sqlite3.connect(opts.write_hlr)
-
-		c = conn.execute(
-			'INSERT INTO Subscriber ' +
-			'(imsi, name, extension, authorized, created, updated) ' +
-			'VALUES ' +
-			'(?,?,?,1,datetime(\'now\'),datetime(\'now\'));',
-			[
-				params['imsi'],
-				params['name'],
-				'9' + params['iccid'][-5:-1]
-			],
-		)
-		sub_id = c.lastrowid
-		c.close()
-
-		c = conn.execute(
-			'INSERT INTO AuthKeys ' +
-			'(subscriber_id, algorithm_id, a3a8_ki)' +
-			'VALUES ' +
-			'(?,?,?)',
-			[ sub_id, 2, sqlite3.Binary(_dbi_binary_quote(h2b(params['ki']))) ],
-		)
-
-		conn.commit()
-		conn.close()
+		from pySim.hlr import HlrWriter
+		HlrWriter.validate(params)
 
 def write_parameters(opts, params):
 	write_params_csv(opts, params)
 	write_params_hlr(opts, params)
 
+def flush_parameters():
+	"""Make sure everything written so far ends up on disk"""
+	if _csv_writer is not None:
+		_csv_writer.flush()
+	if _hlr_writer is not None:
+		_hlr_writer.flush()
 
-BATCH_STATE = [ 'name', 'country', 'mcc', 'mnc', 'smsp', 'secret', 'num' ]
+def close_parameters():
+	if _csv_writer is not None:
+		_csv_writer.close()
+	if _hlr_writer is not None:
+		_hlr_writer.close()
+
+
+BATCH_STATE = [ 'name', 'country', 'mcc', 'mnc', 'smsp', 'secret', 'num', 'free' ]
 BATCH_INCOMPATIBLE = ['iccid', 'imsi', 'ki']
 
 def init_batch(opts):
@@ -591,6 +855,83 @@ def save_batch(opts):
 	fh.close()
 
 
+class BatchStopped(Exception):
+	"""No more cards are to be programmed"""
+	pass
+
+
+class BatchCounter(object):
+	"""Hands out card numbers to the workers programming cards in
+	parallel, and serializes writing the parameters and the batch state.
+	The numbers given back by failed cards are kept in the batch state
+	too (as opts.free), so a restart reuses them."""
+
+	def __init__(self, opts):
+		self._opts = opts
+		self._lock = threading.Lock()
+		self._idle = threading.Condition(self._lock)
+		self._free = sorted(opts.free or [])
+		opts.free = self._free
+		self._busy = 0
+		self._stopped = False
+
+	def get(self):
+		"""Allocate the number for the next card, raises BatchStopped
+		after stop()"""
+		with self._lock:
+			if self._stopped:
+				raise BatchStopped()
+			self._busy += 1
+			if self._free:
+				return self._free.pop(0)
+			num = self._opts.num
+			if num is not None:
+				self._opts.num += 1
+			return num
+
+	def put(self, num):
+		"""Give back the number of a card that failed, so it is reused"""
+		with self._lock:
+			self._release()
+			if num is None:
+				return
+			self._free.append(num)
+			self._free.sort()
+			save_batch(self._opts)
+
+	def stop(self, wait=True):
+		"""Hand out no more numbers and, with wait, wait for the cards that
+		got one to be done. Returns with the counter locked, so no card is
+		recorded any more while we exit."""
+		self._lock.acquire()
+		self._stopped = True
+		while wait and self._busy:
+			# With a timeout, so that Ctrl-C gets through on Python 2
+			self._idle.wait(1.0)
+
+	def _release(self):
+		self._busy -= 1
+		self._idle.notify_all()
+
+	def done(self, opts, params):
+		"""Write the parameters of a successfully programmed card, which
+		uses up its number whether that works or not. The batch state never
+		goes back to a number that may have been handed out already, so a
+		restart can leave gaps but never duplicates"""
+		with self._lock:
+			try:
+				write_parameters(opts, params)
+				# On disk before the batch state moves on, or a crash
+				# would lose the keys of the card for good
+				if opts.batch_mode and opts.batch_state:
+					flush_parameters()
+			finally:
+				# Also if they couldn't be written: the card has the
+				# number, so it must not be handed out again
+				save_batch(self._opts)
+				self._release()
+
+
 def card_detect(opts, scc):
 
 	# Detect type if needed
@@ -621,28 +962,68 @@ def card_detect(opts, scc):
 	return card
 
 
-def process_card(opts, first, card_handler):
+def process_card(opts, first, card_handler, scc, counter):
+
+	card = None
 
 	if opts.dry_run is False:
 		# Connect transport
 		card_handler.get(first)
+		# There may be a different card in the reader now
+		scc.clear_select_cache()
 
 	if opts.dry_run is False:
-		# Get card
-		card = card_detect(opts, scc)
-		if card is None:
-			print "No card detected!"
-			return -1
+		with scc.transaction():
+			# Get card
+			card = card_detect(opts, scc)
+			if card is None:
+				print "No card detected!"
+				return -1
+
+			# Probe only
+			if opts.probe:
+				return 0
+
+			# Erase if requested
+			if opts.erase:
+				print "Formatting ..."
+				card.erase()
+				card.reset()
+
+	# Each card gets its own number, and its own copy of the options
+	num = counter.get()
+	return _process_card_params(copy.copy(opts), num, card, card_handler, scc, counter)
 
-		# Probe only
-		if opts.probe:
-			return 0
 
-		# Erase if requested
-		if opts.erase:
-			print "Formatting ..."
-			card.erase()
-			card.reset()
+def _process_card_params(opts, num, card, card_handler, scc, counter):
+	opts.num = num
+
+	# Until the card is programmed, its number can go to the next card
+	try:
+		cp = _program_card(opts, card, card_handler, scc)
+	except:
+		counter.put(num)
+		raise
+	if cp is None:
+		counter.put(num)
+		return 2
+
+	# Write parameters permanently, batch mode state update and save. The
+	# number is used up now even if this fails, or it would end up on two
+	# cards.
+	try:
+		counter.done(opts, cp)
+	except:
+		print "Recording the parameters of the programmed card failed!"
+		raise
+
+	card_handler.done()
+	return 0
+
+
+def _program_card(opts, card, card_handler, scc):
+	"""Generate the parameters for the card and program it, returns them
+	or None if there are none to use"""
 
 	# Generate parameters
 	if opts.source == 'cmdline':
@@ -667,75 +1048,46 @@ def process_card(opts, first, card_handler):
 		cp = read_params_csv(opts, imsi=imsi, iccid=iccid)
 	if cp is None:
 		print "Error reading parameters from CSV file!\n"
-		return 2
+		return None
 	print_parameters(cp)
 
+	# Once they are on the card it's too late
+	try:
+		validate_parameters(opts, cp)
+	except ValueError as e:
+		print "Invalid parameters: %s\n" % e
+		return None
+
 	if opts.dry_run is False:
 		# Program the card
 		print "Programming ..."
-		card.program(cp)
+		with scc.transaction():
+			card.program(cp)
 	else:
 		print "Dry Run: NOT PROGRAMMING!"
 
-	# Write parameters permanently
-	write_parameters(opts, cp)
-
-	# Batch mode state update and save
-	if opts.num is not None:
-		opts.num += 1
-	save_batch(opts)
-
-	card_handler.done()
-	return 0
+	return cp
 
 
-if __name__ == '__main__':
-
-	# Parse options
-	opts = parse_options()
-
-	# Init card reader driver
-	if opts.pcsc_dev is not None:
-		print("Using PC/SC reader (dev=%d) interface"
-			% opts.pcsc_dev)
-		from pySim.transport.pcsc import PcscSimLink
-		sl = PcscSimLink(opts.pcsc_dev)
-	elif opts.osmocon_sock is not None:
-		print("Using Calypso-based (OsmocomBB, sock=%s) reader interface"
-			% opts.osmocon_sock)
-		from pySim.transport.calypso import CalypsoSimLink
-		sl = CalypsoSimLink(sock_path=opts.osmocon_sock)
-	else: # Serial reader is default
-		print("Using serial reader (port=%s, baudrate=%d) interface"
-			% (opts.device, opts.baudrate))
-		from pySim.transport.serial import SerialSimLink
-		sl = SerialSimLink(device=opts.device, baudrate=opts.baudrate)
+def process_cards(opts, sl, counter):
+	"""Program cards using the reader behind sl until we are done"""
 
 	# Create command layer
 	scc = SimCardCommands(transport=sl)
 
-	# If we use a CSV file as data input, check if the CSV file exists.
-	if opts.source == 'csv':
-		print "Using CSV file as data input: " + str(opts.read_csv)
-		if not os.path.isfile(opts.read_csv):
-			print "CSV file not found!"
-			sys.exit(1)
-
-	# Batch mode init
-	init_batch(opts)
-
 	if opts.card_handler:
-		card_handler = card_handler_auto(sl, opts.card_handler)
+		ch = card_handler_auto(sl, opts.card_handler)
 	else:
-		card_handler = card_handler(sl)
+		ch = card_handler(sl)
 
 	# Iterate
 	first = True
-	card = None
 
 	while 1:
 		try:
-			rc = process_card(opts, first, card_handler)
+			rc = process_card(opts, first, ch, scc, counter)
+		except (BatchStopped):
+			return 0
 		except (KeyboardInterrupt):
 			print ""
 			print "Terminated by user!"
@@ -752,13 +1104,127 @@ if __name__ == '__main__':
 			rc = -1
 
 		# Something did not work as well as expected, however, lets
-		# make sure the card is pulled from the reader.
+		# make sure the card is pulled from the reader. Also don't
+		# leave the cards programmed so far unrecorded.
 		if rc != 0:
-			card_handler.error()
+			ch.error()
+			flush_parameters()
 
 		# If we are not in batch mode we are done in any case, so lets
 		# exit here.
 		if not opts.batch_mode:
-			sys.exit(rc)
+			return rc
 
 		first = False
+
+
+def init_links(opts):
+	"""Open the card reader(s) given by the options"""
+	if opts.replay is not None:
+		print("Replaying %s (latency: %s)" % (opts.replay, opts.latency))
+		from pySim.transport.replay import ReplaySimLink
+		return [ReplaySimLink(opts.replay, latency=opts.latency)]
+	elif opts.virtual is not None:
+		print("Using simulated card (profile=%s)" % opts.virtual)
+		from pySim.transport.virtual import VirtualCard, VirtualCardLink
+		return [VirtualCardLink(VirtualCard.from_profile(opts.virtual))]
+	elif opts.pcsc_all:
+		from smartcard.System import readers
+		from pySim.transport.pcsc import PcscSimLink
+		n = len(readers())
+		print("Using all %d PC/SC readers" % n)
+		return [PcscSimLink(i, exclusive=opts.pcsc_exclusive, cold_reset=opts.pcsc_cold_reset)
+			for i in range(n)]
+	elif opts.pcsc_dev is not None:
+		print("Using PC/SC reader (dev=%d) interface"
+			% opts.pcsc_dev)
+		from pySim.transport.pcsc import PcscSimLink
+		return [PcscSimLink(opts.pcsc_dev, exclusive=opts.pcsc_exclusive,
+			cold_reset=opts.pcsc_cold_reset)]
+	elif opts.osmocon_sock is not None:
+		print("Using Calypso-based (OsmocomBB, sock=%s) reader interface"
+			% opts.osmocon_sock)
+		from pySim.transport.calypso import CalypsoSimLink
+		return [CalypsoSimLink(sock_path=opts.osmocon_sock)]
+	else: # Serial reader is default
+		from pySim.transport.serial import SerialSimLink
+		links = []
+		for device in opts.device.split(','):
+			print("Using serial reader (port=%s, baudrate=%d) interface"
+				% (device, opts.baudrate))
+			links.append(SerialSimLink(device=device, baudrate=opts.baudrate, presence=opts.presence))
+		return links
+
+
+if __name__ == '__main__':
+
+	# Parse options
+	opts = parse_options()
+
+	# Only generate parameters ?
+	if opts.bulk_gen is not None:
+		init_batch(opts)
+		print "Generating parameters for %d cards ..." % opts.bulk_gen
+		# No card is programmed with them yet, so the file is written out
+		# (and fsync()ed with --csv-fsync) once at the end, not per row
+		_csv_writer = CsvWriter(opts.write_csv, flush_rows=None, flush_interval=None,
+				fsync=opts.csv_fsync, max_size=opts.csv_max_size)
+		for cp in gen_parameters_bulk(opts, opts.bulk_gen):
+			_csv_writer.write(cp)
+		close_parameters()
+		opts.num += opts.bulk_gen
+		save_batch(opts)
+		sys.exit(0)
+
+	# Init card reader driver(s)
+	links = init_links(opts)
+
+	# If we use a CSV file as data input, check if the CSV file exists.
+	if opts.source == 'csv':
+		print "Using CSV file as data input: " + str(opts.read_csv)
+		if not os.path.isfile(opts.read_csv):
+			print "CSV file not found!"
+			sys.exit(1)
+
+	# Batch mode init
+	init_batch(opts)
+	counter = BatchCounter(opts)
+
+	# Whatever way we leave, write out the pending parameters
+	atexit.register(close_parameters)
+
+	# One worker per reader, they run until the user terminates us. The
+	# main thread only waits for them, so Ctrl-C can't hit a worker while
+	# it records a card.
+	results = {}
+	def worker(sl):
+		results[sl] = process_cards(opts, sl, counter)
+
+	workers = []
+	for sl in links:
+		t = threading.Thread(target=worker, args=(sl,))
+		t.daemon = True
+		t.start()
+		workers.append(t)
+
+	try:
+		while any([t.is_alive() for t in workers]):
+			time.sleep(0.5)
+	except (KeyboardInterrupt):
+		print ""
+		print "Terminated by user, finishing the cards being programmed (Ctrl-C again to quit now) ..."
+		# Workers waiting for a card would never return, so rather than
+		# joining them wait for the cards that got a number. Either way no
+		# card is recorded half way once stop() returns.
+		try:
+			counter.stop()
+		except (KeyboardInterrupt):
+			counter.stop(wait=False)
+		sys.exit(0)
+
+	# The first reader that failed, if any, gives the exit code
+	for sl in links:
+		rc = results.get(sl, -1)
+		if rc != 0:
+			sys.exit(rc)
+	sys.exit(0)
@@ -37,6 +37,9 @@ except ImportError:
 	import simplejson as json
 
 from pySim.commands import SimCardCommands
+from pySim.filesystem import walk, EF_TYPES
+from pySim.profiles import DFS, PROFILE_NAME
+from pySim.profiles import save_profile as write_profile
 from pySim.utils import h2b, swap_nibbles, rpad, dec_imsi, dec_iccid, format_xplmn_w_act
 
 USE_RECORD = False
@@ -61,6 +64,19 @@ def parse_options():
 			help="Socket path for Calypso (e.g. Motorola C1XX) based reader (via OsmocomBB)",
 			default=None,
 		)
+	parser.add_option("--replay", dest="replay", metavar="TRACE",
+			help="Instead of a card, answer with the responses from an APDU trace or log",
+			default=None,
+		)
+	parser.add_option("--latency", dest="latency", metavar="MODEL",
+			type="choice", choices=["none", "recorded", "serial", "pcsc", "calypso"],
+			help="Latency of the replayed APDUs (none, recorded, serial, pcsc, calypso) [default: %default]",
+			default="none",
+		)
+	parser.add_option("--virtual", dest="virtual", metavar="PROFILE",
+			help="Instead of a card, use a simulated one with the files of a saved profile folder",
+			default=None,
+		)
 
 	(options, args) = parser.parse_args()
 
@@ -95,92 +111,31 @@ class EF:
         def set_apdu(self, apdu):
                 self.apdu = apdu
                 
-def lsdf(dir):
-        adf_dir = []
-        error_adf = []
-        for adf_ef in dir:
-                print("***********************************************************************")
-                adf_ef = EF(adf_ef)
-                print(adf_ef.name)
-                #scc.send_apdu(ins = 'a4',p1 = '04', p2 = '04', data = parent)
-                (fci, sw), parsed = scc.send_apdu(ins = 'a4',p1 = '00', p2 = '04', data = adf_ef.name)
-                adf_ef.set_fci(fci)
-
-                if sw == '6a82':
+def lsdf(tree, path):
+        """EFs directly below the DF at path in a tree found by
+        pySim.filesystem.walk(). Returns a list of EF and a list of (EF, SW)
+        of the ones which couldn't be read."""
+        ef_dir = []
+        error_ef = []
+        df = tree.find(path)
+        if df is None:
+                return ef_dir, error_ef
+        for f in df.children:
+                if f.is_df():
                         continue
-                elif sw == '6982':
-                        print("Access Rule Encountered")
+                ef = EF(f.fid.upper())
+                ef.set_fci(f.fci)
+                if f.sw is not None or f.type is None or (f.type == 'cyclic' and not USE_RECORD):
+                        error_ef.append((ef, f.sw))
                         continue
-                        #scc.verify_chv()
-                elif sw == '9000':
-                        #transparent 
-                        if '82' in parsed.keys() and parsed['82'].startswith('41'): 
-                                (data, sw) = scc.send_apdu_without_length(ins = 'b0',p1 = '00', p2 = '00', data = parsed['80'][2:4])
-                                if sw == '6982':
-                                        print("Access Rule Encountered")
-                                        continue
-                                assert(sw == '9000')
-                                adf_ef.set_type('transparent')
-                                adf_ef.set_data(data)
-
-                        #linear
-                        elif '82' in parsed.keys() and parsed['82'].startswith('42'):
-                                record_list = []
-                                num_rec = int(parsed['82'][8:], 16)
-                                len_rec = parsed['82'][6:8]
-                                for i in range(num_rec):
-                                        i = i + 1
-                                        (data ,sw) = scc.send_apdu_without_length(ins = 'b2',p1 = '%02x'%(i), p2 = '04', data = str(len_rec))
-                                        record_list.append(data)
-
-                                adf_ef.set_type('linear')
-                                adf_ef.set_data(record_list)
-                                #assert(sw == '9000')
-
+                ef.set_type(f.type)
+                ef.set_data(f.data)
+                ef_dir.append(ef)
+        return ef_dir, error_ef
 
-                        #cyclic 
-                        elif USE_RECORD and '82' in parsed.keys() and parsed['82'].startswith('46'):
-                                record_list = []
-                                num_rec = int(parsed['82'][8:], 16)
-                                len_rec = parsed['82'][6:8]
-                                print(num_rec, len_rec)
-                                for i in range(num_rec):
-                                        i = i + 1
-                                        (data ,sw) = scc.send_apdu_without_length(ins = 'b2',p1 = '%02x'%(i), p2 = '04', data = str(len_rec))
-                                        record_list.append(data)
-                                
-                                #assert(sw == '9000')
-                                adf_ef.set_type('cyclic')
-                                adf_ef.set_data(record_list)
-                        else:
-                                error_adf.append((adf_ef, sw))
-                                continue
-                        adf_dir.append(adf_ef)
-                else:
-                        error_adf.append((adf_ef, sw))
-        return adf_dir, error_adf
 
 def save_profile(mf="", adf="", gsm="", telecom="", folder = "./profile/"):
-        import cPickle as pickle
-        with open(folder + "mf.profile", "w") as f:
-                pickle.dumps(mf)
-        with open(folder + "mf.txt", 'w') as f:
-                f.write(str(mf))
-                
-        with open(folder + "adf.profile", "wb") as f:
-                pickle.dump(adf, f)
-        with open(folder + "adf.txt", 'w') as f:
-                f.write(str(adf))
-
-        with open(folder + "gsm.profile", "wb") as f:
-                pickle.dump(gsm, f)
-        with open(folder + "gsm.txt", 'w') as f:
-                f.write(str(gsm))
-
-        with open(folder + "telecom.profile", "wb") as f:
-                pickle.dump(telecom, f)                
-        with open(folder + "telecom.txt", 'w') as f:
-                f.write(str(telecom))
+        write_profile(folder + PROFILE_NAME, zip(DFS, [mf, adf, gsm, telecom]))
 
 
 
@@ -190,7 +145,15 @@ if __name__ == '__main__':
 	opts = parse_options()
 
 	# Init card reader driver
-	if opts.pcsc_dev is not None:
+	if opts.replay is not None:
+		print("Replaying %s (latency: %s)" % (opts.replay, opts.latency))
+		from pySim.transport.replay import ReplaySimLink
+		sl = ReplaySimLink(opts.replay, latency=opts.latency)
+	elif opts.virtual is not None:
+		print("Using simulated card (profile=%s)" % opts.virtual)
+		from pySim.transport.virtual import VirtualCard, VirtualCardLink
+		sl = VirtualCardLink(VirtualCard.from_profile(opts.virtual))
+	elif opts.pcsc_dev is not None:
 		print("Using PC/SC reader (dev=%d) interface"
 			% opts.pcsc_dev)
 		from pySim.transport.pcsc import PcscSimLink
@@ -215,39 +178,18 @@ if __name__ == '__main__':
 	# Program the card
 	print("Reading ...")
 
-        scc.send_apdu(ins = 'a4',p1 = '00', p2 = '04', data = '3F00')
+        scc.sel_ctrl = "0004"
+        with scc.transaction():
+                # Cyclic EFs are only kept with USE_RECORD, see lsdf()
+                tree = walk(scc, read_types=EF_TYPES if USE_RECORD else ('transparent', 'linear'))
 
-        #mf
-        mf_list = ['2F00', '2F05', '2F06', '2FE2', '2F08']
-        
-        mf_dir, error_mf = lsdf(mf_list)
+        mf_dir, error_mf = lsdf(tree, ['3F00'])
         print(mf_dir)
         print(error_mf)
 
-        
-        #adf
-        scc.send_apdu(ins = 'a4',p1 = '00', p2 = '04', data = '2F00')
-        scc.send_apdu_without_length(ins = 'b2',p1 = '01', p2 = '04', data = '26')
-        scc.send_apdu(ins = 'a4',p1 = '04', p2 = '04', data = 'a0000000871002ffffffff8907090000')
-        #scc.send_apdu(ins = 'a4',p1 = '00', p2 = '04', data = '6F07')
-        
-        adf_list = ['6F05', '6F06','6F07','6F08','6F09','6F2C','6F31','6F32','6F37','6F38','6F39','6F3B','6F3C','6F3E','6F3F','6F40','6F41','6F42','6F43','6F45','6F46','6F47','6F48','6F49','6F4B','6F4C','6F4D','6F4E','6F4F','6F50','6F55','6F56','6F57','6F58','6F5B','6F5C','6F5C','6F60','6F61','6F62','6F73','6F78','6F7B','6F7E','6F80','6F81','6F82','6F83','6FAD','6FB1','6FB2','6FB3','6FB4','6FB5','6FB6','6FB7','6FC3','6FC4','6FC5','6FC6','6FC7','6FC8','6FC9','6FCA','6FCB','6FCC','6FCD','6FCE','6FCF','6FD0','6FD1','6FD2','6FD3','6FD4','6FD5','6FD6','6FD7','6FD8','6FD9','6FDA','6FDB','6FDC','6FDD','6FDE','6FDF','6FE2','6FE3','6FE4','6FE6','6FE7','6FE8','6FEC','6FED','6FEE','6FEF','6FF0','6FF1','6FF2','6FF3','6FF4']
-
-        adf_dir, error_adf = lsdf(adf_list)
-        #print(adf_dir)
-        #print(error_adf)
-        
-        scc.send_apdu(ins = 'a4',p1 = '00', p2 = '04', data = '3F00')
-        scc.send_apdu(ins = 'a4',p1 = '00', p2 = '04', data = '7F20')
-        gsm_list = ['6F05', '6F07', '6F20','6F2C','6F30','6F31','6F32','6F37','6F38','6F39','6F3E','6F3F','6F41','6F45','6F46','6F48','6F74','6F78','6F7B','6F7E','6FAD','6FAE','6FB1','6FB2','6FB3','6FB4','6FB5','6FB6','6FB7','6F50','6F51','6F52','6F53','6F54','6F60','6F61','6F62','6F63','6F64','6FC5','6FC6','6FC7','6FC8','6FC9','6FCA','6FCB','6FCC']
-        gsm_dir, error_gsm = lsdf(gsm_list)
-        #print(gsm_dir)
-        #print(error_gsm)
-
-        scc.send_apdu(ins = 'a4',p1 = '00', p2 = '04', data = '3F00')
-        scc.send_apdu(ins = 'a4',p1 = '00', p2 = '04', data = '7F10')
-        telecom_list = ['6F06', '6F3A', '6F3B', '6F3C', '6F40', '6F42', '6F43', '6F44', '6F47', '6F49', '6F4A', '6F4B', '6F4C', '6F4D', '6F4E', '6F4F', '6F53', '6F54', '6FE0', '6FE1', '6FE5']
-        telecom_dir, error_telecom = lsdf(telecom_list)
+        adf_dir, error_adf = lsdf(tree, ['7FFF'])
+        gsm_dir, error_gsm = lsdf(tree, ['3F00', '7F20'])
+        telecom_dir, error_telecom = lsdf(tree, ['3F00', '7F10'])
 
         print(error_mf, error_adf, error_gsm, error_telecom)
 
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Command and response APDUs
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import struct
+
+from pySim.utils import h2b, b2h
+
+# APDUs travel from SimCardCommands down to the wire as bytes. Hex strings
+# are what callers of SimCardCommands and LinkBase see, they are only made
+# where somebody asks for them.
+
+
+def _to_bytes(buf):
+	if isinstance(buf, memoryview):
+		return buf.tobytes()
+	return bytes(buf)
+
+
+class Apdu(object):
+	"""A command APDU (ISO 7816-4, chapter 5.1), kept as bytes"""
+
+	__slots__ = ('buf',)
+
+	def __init__(self, buf):
+		self.buf = _to_bytes(buf)
+
+	@classmethod
+	def from_hex(cls, pdu):
+		return cls(h2b(pdu))
+
+	@classmethod
+	def build(cls, cla, ins, p1, p2, data=b'', le=None):
+		"""
+		Encode an APDU from its header bytes (ints), data (bytes) and Le
+		(number of bytes expected, None for none). Extended length fields
+		are used if data or Le don't fit into short ones.
+		"""
+		hdr = struct.pack('BBBB', cla, ins, p1, p2)
+		data = _to_bytes(data)
+		if len(data) > 255 or (le is not None and le > 256):
+			if data:
+				hdr += struct.pack('>BH', 0, len(data)) + data
+				if le is not None:
+					hdr += struct.pack('>H', le & 0xffff)
+			elif le is not None:
+				hdr += struct.pack('>BH', 0, le & 0xffff)
+			return cls(hdr)
+		if data:
+			hdr += struct.pack('B', len(data)) + data
+		if le is not None:
+			hdr += struct.pack('B', le & 0xff)
+		return cls(hdr)
+
+	def __len__(self):
+		return len(self.buf)
+
+	def __eq__(self, other):
+		if isinstance(other, Apdu):
+			return self.buf == other.buf
+		if isinstance(other, str):
+			return self.hex() == other.lower()
+		return NotImplemented
+
+	def __ne__(self, other):
+		res = self.__eq__(other)
+		return res if res is NotImplemented else not res
+
+	def __repr__(self):
+		return "Apdu(%s)" % self.hex()
+
+	def __str__(self):
+		return self.hex()
+
+	def hex(self):
+		return b2h(self.buf)
+
+	@property
+	def cla(self):
+		return struct.unpack_from('B', self.buf, 0)[0]
+
+	@property
+	def ins(self):
+		return struct.unpack_from('B', self.buf, 1)[0]
+
+	@property
+	def p1(self):
+		return struct.unpack_from('B', self.buf, 2)[0]
+
+	@property
+	def p2(self):
+		return struct.unpack_from('B', self.buf, 3)[0]
+
+	# Tell the offset and length of the data field and Le from the body
+	# of the APDU, see ISO 7816-3, chapter 12.1.3 Decoding conventions.
+	# Anything not following them is taken as data without Le.
+	def __body(self):
+		body = bytearray(self.buf[4:])
+		n = len(body)
+		if n == 0:
+			return 4, 0, None
+		if n == 1:
+			return 4, 0, body[0] or 256
+		if body[0]:
+			if n == 1 + body[0]:
+				return 5, body[0], None
+			if n == 2 + body[0]:
+				return 5, body[0], body[-1] or 256
+		elif n == 3:
+			return 4, 0, (body[1] << 8 | body[2]) or 65536
+		else:
+			lc = body[1] << 8 | body[2]
+			if n == 3 + lc:
+				return 7, lc, None
+			if n == 5 + lc:
+				return 7, lc, (body[-2] << 8 | body[-1]) or 65536
+		return 5, n - 1, None
+
+	@property
+	def data(self):
+		"""The data field, as memoryview into the APDU"""
+		ofs, lc, le = self.__body()
+		return memoryview(self.buf)[ofs:ofs + lc]
+
+	@property
+	def le(self):
+		return self.__body()[2]
+
+
+class Response(object):
+	"""
+	A response APDU: data (bytes) and the status word. For the callers of
+	LinkBase.send_apdu() it is still a tuple of hex strings (data, sw), be
+	it by unpacking or by indexing.
+	"""
+
+	__slots__ = ('data', 'sw1', 'sw2')
+
+	def __init__(self, data, sw1, sw2):
+		self.data = _to_bytes(data)
+		self.sw1 = sw1
+		self.sw2 = sw2
+
+	@classmethod
+	def from_hex(cls, data, sw):
+		if sw is None:
+			return cls(b'', None, None)
+		return cls(h2b(data or ''), int(sw[0:2], 16), int(sw[2:4], 16))
+
+	@classmethod
+	def from_bytes(cls, rsp):
+		"""Split what the card sent into data and SW"""
+		if len(rsp) < 2:
+			return cls(b'', None, None)
+		sw1, sw2 = struct.unpack_from('BB', rsp, len(rsp) - 2)
+		return cls(rsp[:-2], sw1, sw2)
+
+	@property
+	def sw(self):
+		if self.sw1 is None:
+			return None
+		return self.sw1 << 8 | self.sw2
+
+	def data_hex(self):
+		if self.sw1 is None:
+			return None
+		return b2h(self.data)
+
+	def sw_hex(self):
+		if self.sw1 is None:
+			return None
+		return '%02x%02x' % (self.sw1, self.sw2)
+
+	def __iter__(self):
+		yield self.data_hex()
+		yield self.sw_hex()
+
+	def __len__(self):
+		return 2
+
+	def __getitem__(self, i):
+		return (self.data_hex, self.sw_hex)[i]()
+
+	def __eq__(self, other):
+		if isinstance(other, Response):
+			return (self.data, self.sw1, self.sw2) == (other.data, other.sw1, other.sw2)
+		if isinstance(other, tuple):
+			return tuple(self) == other
+		return NotImplemented
+
+	def __ne__(self, other):
+		res = self.__eq__(other)
+		return res if res is NotImplemented else not res
+
+	def __repr__(self):
+		return repr(tuple(self))
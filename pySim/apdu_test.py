@@ -0,0 +1,50 @@
+#!/usr/bin/pyton
+
+import unittest
+
+from pySim.apdu import Apdu, Response
+from pySim.utils import h2b
+
+class ApduTestCase(unittest.TestCase):
+
+	def testBuild(self):
+		self.assertEqual(Apdu.build(0xa0, 0xa4, 0, 0, h2b('3f00')).hex(), 'a0a40000023f00')
+		self.assertEqual(Apdu.build(0x00, 0xb0, 1, 2, le=256).hex(), '00b0010200')
+		self.assertEqual(Apdu.build(0x00, 0xb0, 0, 0, le=0x400).hex(), '00b00000000400')
+		self.assertEqual(Apdu.build(0x00, 0xd6, 0, 0, b'\x11' * 256).hex(), '00d60000000100' + '11' * 256)
+		self.assertEqual(Apdu.build(0x00, 0x70, 0, 0).hex(), '00700000')
+
+	def testHeader(self):
+		apdu = Apdu.from_hex('A0DC0204031122330a')
+		self.assertEqual((apdu.cla, apdu.ins, apdu.p1, apdu.p2), (0xa0, 0xdc, 0x02, 0x04))
+		self.assertEqual(apdu, 'a0dc0204031122330a')
+		self.assertEqual(apdu, Apdu(h2b('a0dc0204031122330a')))
+
+	def testBody(self):
+		apdu = Apdu.from_hex('a0dc0204031122330a')
+		self.assertEqual(apdu.data.tobytes(), h2b('112233'))
+		self.assertEqual(apdu.le, 10)
+		self.assertEqual(Apdu.from_hex('00b0000000').le, 256)
+		self.assertEqual(Apdu.from_hex('00b00000000000').le, 65536)
+		apdu = Apdu.build(0x00, 0xd6, 0, 0, b'\x11' * 300)
+		self.assertEqual(apdu.data.tobytes(), b'\x11' * 300)
+		self.assertEqual(apdu.le, None)
+
+
+class ResponseTestCase(unittest.TestCase):
+
+	def testHex(self):
+		rsp = Response.from_bytes(h2b('0102039000'))
+		data, sw = rsp
+		self.assertEqual((data, sw), ('010203', '9000'))
+		self.assertEqual((rsp[0], rsp[1]), ('010203', '9000'))
+		self.assertEqual(rsp, ('010203', '9000'))
+		self.assertEqual(rsp.sw, 0x9000)
+		self.assertEqual(Response.from_hex('010203', '9000'), rsp)
+
+	def testNoResponse(self):
+		self.assertEqual(tuple(Response.from_bytes(b'')), (None, None))
+		self.assertEqual(Response.from_hex(None, None).sw, None)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Decoding of the Answer To Reset (ISO 7816-3)
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pySim.utils import h2i
+
+# Clock rate conversion factor Fi and baud rate adjustment factor Di by
+# their codes in TA1, see ISO 7816-3, chapter 8.3, tables 7 and 8. The
+# default values Fd and Dd are 372 and 1, code 1 each.
+FI = {0x0: 372, 0x1: 372, 0x2: 558, 0x3: 744, 0x4: 1116, 0x5: 1488, 0x6: 1860,
+	0x9: 512, 0xa: 768, 0xb: 1024, 0xc: 1536, 0xd: 2048}
+DI = {0x1: 1, 0x2: 2, 0x3: 4, 0x4: 8, 0x5: 16, 0x6: 32, 0x7: 64, 0x8: 12, 0x9: 20}
+
+
+class Atr(object):
+	"""The parts of an ATR, see ISO 7816-3, chapter 8.2"""
+
+	def __init__(self, atr):
+		if isinstance(atr, str):
+			atr = h2i(atr)
+		self.atr = list(atr)
+		self.interface = {}	# e.g. 'TA1' -> 0x96
+		self.protocols = []	# T=x offered by the TDi
+		self.historical = []
+		self.__parse()
+
+	def __parse(self):
+		atr = self.atr
+		if len(atr) < 2:
+			raise ValueError('ATR too short')
+		y, k = atr[1] >> 4, atr[1] & 0x0f
+		i, n = 2, 1
+		while True:
+			for bit, name in ((0x1, 'TA'), (0x2, 'TB'), (0x4, 'TC'), (0x8, 'TD')):
+				if y & bit:
+					if i >= len(atr):
+						raise ValueError('ATR truncated in the interface bytes')
+					self.interface['%s%d' % (name, n)] = atr[i]
+					i += 1
+			td = self.interface.get('TD%d' % n)
+			if td is None:
+				break
+			y = td >> 4
+			self.protocols.append(td & 0x0f)
+			n += 1
+		if i + k > len(atr):
+			raise ValueError('ATR truncated in the historical bytes')
+		self.historical = atr[i:i + k]
+
+	def fi_di(self):
+		"""The codes of Fi and Di the card offers in TA1, (1, 1) if none"""
+		ta1 = self.interface.get('TA1', 0x11)
+		return ta1 >> 4, ta1 & 0x0f
+
+	def specific_mode(self):
+		"""Whether the card is in specific mode, i.e. does no PPS (TA2
+		present, ISO 7816-3, chapter 6.3.1)"""
+		return 'TA2' in self.interface
+
+	def protocol(self):
+		"""The first protocol T the card offers, T=15 is none"""
+		for t in self.protocols:
+			if t != 15:
+				return t
+		return 0
+
+	def compact_tlv(self):
+		"""
+		Return the COMPACT-TLV data objects of the historical bytes as a
+		dict of tag number (e.g. 0x7 for the card capabilities) to a list
+		of the value bytes, see ISO 7816-4, chapter 8.1.1.
+		"""
+		hist = self.historical
+		if not hist:
+			return {}
+		if hist[0] == 0x80:
+			objs = hist[1:]
+		elif hist[0] == 0x00:
+			# The last three bytes are status indicator bytes
+			objs = hist[1:-3]
+		else:
+			return {}
+		res = {}
+		i = 0
+		while i < len(objs):
+			tag, l = objs[i] >> 4, objs[i] & 0x0f
+			res[tag] = objs[i + 1:i + 1 + l]
+			i += 1 + l
+		return res
+
+	def ext_apdu(self):
+		"""Tell whether the card supports extended Lc and Le fields"""
+		# Third software function table of the card capabilities, ISO
+		# 7816-4, chapter 8.1.1.2.7
+		caps = self.compact_tlv().get(0x7, [])
+		return len(caps) >= 3 and bool(caps[2] & 0x40)
+
+
+def ext_apdu_supported(atr):
+	"""Tell from an ATR (list of ints or hex string) whether the card
+	supports extended length APDUs. False if it can't tell."""
+	if not atr:
+		return False
+	try:
+		return Atr(atr).ext_apdu()
+	except ValueError:
+		return False
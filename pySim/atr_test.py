@@ -0,0 +1,39 @@
+#!/usr/bin/pyton
+
+import unittest
+
+from pySim.atr import Atr, ext_apdu_supported, FI, DI
+
+# sysmoUSIM-SJS1
+ATR_SJS1 = '3b9f96801fc78031a073be21136743200718000001a5'
+
+class AtrTestCase(unittest.TestCase):
+
+	def testParse(self):
+		atr = Atr(ATR_SJS1)
+		self.assertEqual(atr.interface, {'TA1': 0x96, 'TD1': 0x80, 'TD2': 0x1f, 'TA3': 0xc7})
+		self.assertEqual(atr.protocols, [0, 15])
+		self.assertEqual(len(atr.historical), 15)
+		self.assertEqual(atr.compact_tlv(), {0x3: [0xa0], 0x7: [0xbe, 0x21, 0x13],
+			0x6: [0x43, 0x20, 0x07, 0x18, 0x00, 0x00, 0x01]})
+
+	def testExtApdu(self):
+		self.assertFalse(ext_apdu_supported(ATR_SJS1))
+		self.assertTrue(ext_apdu_supported('3b8580018073c0216076'))
+		self.assertTrue(ext_apdu_supported([0x3b, 0x85, 0x80, 0x01, 0x80, 0x73, 0xc0, 0x21, 0x60, 0x76]))
+		self.assertFalse(ext_apdu_supported(None))
+		self.assertFalse(ext_apdu_supported('3b8f'))
+
+	def testRate(self):
+		atr = Atr(ATR_SJS1)
+		self.assertEqual(atr.fi_di(), (0x9, 0x6))
+		self.assertEqual((FI[0x9], DI[0x6]), (512, 32))
+		self.assertEqual(atr.protocol(), 0)
+		self.assertFalse(atr.specific_mode())
+		self.assertEqual(Atr('3b00').fi_di(), (1, 1))
+
+	def testTruncated(self):
+		self.assertRaises(ValueError, Atr, '3b9f96')
+
+if __name__ == "__main__":
+	unittest.main()
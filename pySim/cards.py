@@ -157,11 +157,9 @@ class Card(object):
 		else:
 			aid = aid_usim
 
-		# Find out how many records the EF.DIR has, then go through
-		# all records and try to find the AID we are looking for
-		aid_record_count = self._scc.record_count(['2F00'])
-		for i in range(0, aid_record_count):
-			record = self._scc.read_record(['2F00'], i + 1)
+		# Go through all records of EF.DIR and try to find the AID we
+		# are looking for
+		for record in self._scc.read_records(['2F00']):
 			if aid in record[0]:
 				aid_len = int(record[0][6:8], 16)
 				return record[0][8:8 + aid_len * 2]
@@ -283,9 +281,9 @@ class _MagicSimBase(Card):
 			df[v[0]] = (fv, ofs)
 
 		# Write
-		for n in range(0,self._get_count()):
-			for k, (msg, ofs) in df.iteritems():
-				self._scc.update_record(['3f00', '7f4d', k], n + ofs, msg)
+		count = self._get_count()
+		for k, (msg, ofs) in df.iteritems():
+			self._scc.update_records(['3f00', '7f4d', k], dict((n + ofs, msg) for n in range(count)))
 
 
 class SuperSim(_MagicSimBase):
@@ -377,8 +375,7 @@ class FakeMagicSim(Card):
 
 		# Erase all entries
 		entry = 'ff' * rec_len
-		for i in range(0, rec_cnt):
-			self._scc.update_record('000c', 1+i, entry)
+		self._scc.update_records('000c', dict((1+i, entry) for i in range(0, rec_cnt)))
 
 
 class GrcardSim(Card):
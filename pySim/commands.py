@@ -22,48 +22,54 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from pySim.utils import rpad, b2h
+from pySim.apdu import Apdu
+from pySim.atr import ext_apdu_supported
+from pySim.fcp import decode_fcp, fcp_is_df, fcp_file_size, fcp_record_len
+from pySim.utils import rpad, b2h, h2b
 import time
 
+# Files which are selected the same from everywhere: the MF and the
+# current ADF (ETSI TS 102 221, chapter 8.3)
+ROOT_FIDS = ('3f00', '7fff')
+
+# Most data a short APDU carries: Lc is at most 255, Le '00' means 256
+SHORT_LC_MAX = 255
+SHORT_LE_MAX = 256
+
+# The offset of READ/UPDATE BINARY is coded on 15 bits, see ISO 7816-4,
+# chapter 7.2.2
+BINARY_OFFSET_MAX = 0x7fff
+
 class SimCardCommands(object):
     def __init__(self, transport):
         self._tp = transport
-        self._cla_byte = "00"
+        self._fcp_cache = {}
+        self._fcp_decoded = {}
+        self._cur_df = None
+        self._cur_ef = None
+        self.cla_byte = "00"
         self.sel_ctrl = "0000"
-
-    # Extract a single FCP item from TLV
+        # Extended length APDUs for READ/UPDATE BINARY: None to use them if
+        # both reader and card (by its ATR) support them, or True/False
+        self.ext_apdu = None
+        self._ext_apdu = None
+        # Most data per extended length APDU, cards and readers often
+        # have smaller buffers than the 64k the APDU could carry
+        self.ext_apdu_max = 4096
+
+    # Decode the FCP template of a SELECT response, see also: ETSI TS
+    # 102 221, chapter 11.1.1.3.1 Response for MF, DF or ADF. Decoded
+    # templates are cached by the path of the file they belong to.
     def __parse_fcp(self, fcp):
-        # see also: ETSI TS 102 221, chapter 11.1.1.3.1 Response for MF,
-        # DF or ADF
-        from pytlv.TLV import TLV
-        tlvparser = TLV(['82', '83', '84', 'a5', '8a', '8b', '8c', '80', 'ab', 'c6', '81', '88'])
-
-        # pytlv is case sensitive!
-        fcp = fcp.lower()
-
-        if fcp[0:2] != '62':
-            return None
-        # raise ValueError('Tag of the FCP template does not match, expected 62 but got %s'%fcp[0:2])
-
-        # Unfortunately the spec is not very clear if the FCP length is
-        # coded as one or two byte vale, so we have to try it out by
-        # checking if the length of the remaining TLV string matches
-        # what we get in the length field.
-        # See also ETSI TS 102 221, chapter 11.1.1.3.0 Base coding.
-        exp_tlv_len = int(fcp[2:4], 16)
-        if len(fcp[4:]) / 2 == exp_tlv_len:
-            skip = 4
-        else:
-            exp_tlv_len = int(fcp[2:6], 16)
-            if len(fcp[4:]) / 2 == exp_tlv_len:
-                skip = 6
-
-        # Skip FCP tag and length
-        tlv = fcp[skip:]
-
-        parsed_result = tlvparser.parse(tlv)
-        print(parsed_result)
-        return parsed_result
+        path = self.__cur_path() if self._cur_df is not None else None
+        if path is not None:
+            cached = self._fcp_decoded.get(path)
+            if cached is not None and cached[0] == fcp:
+                return cached[1]
+        parsed = decode_fcp(fcp)
+        if path is not None:
+            self._fcp_decoded[path] = (fcp, parsed)
+        return parsed
 
     # Tell the length of a record by the card response
     # USIMs respond with an FCP template, which is different
@@ -72,10 +78,7 @@ class SimCardCommands(object):
     # SIM: GSM 11.11, chapter 9.2.1 SELECT
     def __record_len(self, r):
         if self.sel_ctrl == "0004":
-            tlv_parsed = self.__parse_fcp(r[-1])
-            file_descriptor = tlv_parsed['82']
-            # See also ETSI TS 102 221, chapter 11.1.1.4.3 File Descriptor
-            return int(file_descriptor[4:8], 16)
+            return fcp_record_len(self.__parse_fcp(r[-1]))
         else:
             return int(r[-1][28:30], 16)
 
@@ -83,8 +86,7 @@ class SimCardCommands(object):
     # above.
     def __len(self, r):
         if self.sel_ctrl == "0004":
-            tlv_parsed = self.__parse_fcp(r[-1])
-            return int(tlv_parsed['80'], 16)
+            return fcp_file_size(self.__parse_fcp(r[-1]))
         else:
             return int(r[-1][4:8], 16)
 
@@ -98,6 +100,8 @@ class SimCardCommands(object):
     @cla_byte.setter
     def cla_byte(self, value):
         self._cla_byte = value
+        self._cla = int(value, 16)
+        self.clear_select_cache()
 
     @property
     def sel_ctrl(self):
@@ -106,20 +110,189 @@ class SimCardCommands(object):
     @sel_ctrl.setter
     def sel_ctrl(self, value):
         self._sel_ctrl = value
+        self._sel_p1p2 = (int(value[0:2], 16), int(value[2:4], 16))
+        self.clear_select_cache()
+
+    def clear_select_cache(self):
+        """Forget the current path and all cached SELECT responses. Must be
+        called whenever the card may have been swapped or reset behind our
+        back (e.g. by calling wait_for_card() on the transport)"""
+        self._fcp_cache = {}
+        self._fcp_decoded = {}
+        self.__forget_path()
+
+    def __forget_path(self):
+        self._cur_df = None
+        self._cur_ef = None
+
+    # Tell whether a SELECT response describes a DF (or the MF). USIMs
+    # respond with an FCP template (ETSI TS 102 221, chapter 11.1.1.4.3),
+    # SIMs code the type of file in byte 7 (GSM 11.11, chapter 9.2.1). If
+    # the card does not tell us, fall back to the FID ranges used by the
+    # specs.
+    def __is_df(self, fid, data, fcp):
+        if fcp is not None and '82' in fcp:
+            return fcp_is_df(fcp)
+        elif data and data[0:2] != '62' and len(data) >= 14:
+            return data[12:14] in ('01', '02')
+        return fid == '3f00' or fid[0:2] in ('7f', '5f')
+
+    # Follow the selection state of the card after a successful SELECT.
+    # child tells that the caller addressed fid as a child of the current
+    # DF, otherwise a DF could also be a sibling of the current DF.
+    def __track_select(self, fid, data, child=False):
+        fcp = None
+        if data[0:2] == '62':
+            try:
+                fcp = decode_fcp(data)
+            except ValueError:
+                pass
+        if not self.__is_df(fid, data, fcp):
+            if self._cur_df is not None:
+                self._cur_ef = fid
+        else:
+            self._cur_ef = None
+            if fid in ROOT_FIDS:
+                self._cur_df = [fid]
+            elif self._cur_df is None or fid == self._cur_df[-1]:
+                pass
+            elif len(self._cur_df) > 1 and fid == self._cur_df[-2]:
+                self._cur_df = self._cur_df[:-1]
+            elif child or len(self._cur_df) == 1:
+                self._cur_df = self._cur_df + [fid]
+            else:
+                self._cur_df = None
+        if self._cur_df is not None:
+            path = self.__cur_path()
+            self._fcp_cache[path] = data
+            if fcp is not None:
+                self._fcp_decoded[path] = (data, fcp)
+
+    def __cur_path(self):
+        if self._cur_ef is None:
+            return tuple(self._cur_df)
+        return tuple(self._cur_df + [self._cur_ef])
+
+    # Find out which part of dir_list still needs to be selected. Returns
+    # the number of leading entries of dir_list that can be served from the
+    # cache, or 0 if we can't tell where dir_list leads to.
+    def __cached_len(self, dir_list):
+        if self._cur_df is None:
+            return 0
+        if dir_list[0] in ROOT_FIDS:
+            path = dir_list
+        elif any(fid in ROOT_FIDS for fid in dir_list):
+            return 0
+        else:
+            path = self._cur_df + dir_list
+        cur = self.__cur_path()
+        if tuple(path) == cur or path == self._cur_df:
+            skip = len(path)
+        elif path[:len(self._cur_df)] == self._cur_df:
+            skip = len(self._cur_df)
+        else:
+            return 0
+        skip -= len(path) - len(dir_list)
+        for i in range(len(path) - len(dir_list), len(path) - len(dir_list) + skip):
+            if tuple(path[:i + 1]) not in self._fcp_cache:
+                return 0
+        return skip
 
     def select_file(self, dir_list):
+        rv, sw = self.__select_path(dir_list)
+        if sw != '9000':
+            raise RuntimeError("SW match failed! Expected 9000 and got %s." % sw)
+        return rv
+
+    def try_select_file(self, dir_list):
+        """Like select_file(), but instead of raising an exception return a
+        tuple of the responses and the SW of the last SELECT sent. Meant for
+        probing files which may not exist on the card."""
+        return self.__select_path(dir_list)
+
+    def __select_path(self, dir_list):
         rv = []
-        print("Current directory list: " + str(dir_list))
-        for i in dir_list:
-            data, sw = self._tp.send_apdu_checksw(self.cla_byte + "a4" + self.sel_ctrl + "02" + i)
+        dir_list = [fid.lower() for fid in dir_list]
+
+        # Serve whatever is already selected from the cache
+        skip = self.__cached_len(dir_list)
+        if skip:
+            if dir_list[0] in ROOT_FIDS:
+                path = []
+            else:
+                path = list(self._cur_df)
+            for fid in dir_list[:skip]:
+                path.append(fid)
+                rv.append(self._fcp_cache[tuple(path)])
+            if skip == len(dir_list) and len(path) == len(self._cur_df):
+                self._cur_ef = None
+
+        child = skip > 0
+        for fid in dir_list[skip:]:
+            data, sw = self._tp.send_apdu(Apdu.build(self._cla, 0xa4, self._sel_p1p2[0], self._sel_p1p2[1], h2b(fid)))
+            if sw != '9000':
+                # A file which is not found leaves the current file as it
+                # was (ISO 7816-4, chapter 7.1.1), anything else may not
+                if sw != '6a82':
+                    self.__forget_path()
+                return rv, sw
+            self.__track_select(fid, data, child)
+            # Everything following the MF or ADF is addressed as a child
+            child = child or fid in ROOT_FIDS
             rv.append(data)
-        return rv
+        return rv, '9000'
 
     def select_adf(self, aid):
-        aidlen = ("0" + format(len(aid) / 2, 'x'))[-2:]
-        return self._tp.send_apdu_checksw(self.cla_byte + "a4" + "0404" + aidlen + aid)
+        self.__forget_path()
+        data, sw = self.__send_apdu_checksw(Apdu.build(self._cla, 0xa4, 0x04, 0x04, h2b(aid)))
+        # From now on, 7fff refers to this ADF
+        for cache in (self._fcp_cache, self._fcp_decoded):
+            for path in [path for path in cache if path[0] == '7fff']:
+                del cache[path]
+        self.__track_select('7fff', data)
+        return data, sw
+
+    # Sends an APDU, any SW error leaves the selection state of the card
+    # in doubt. Returns a pySim.apdu.Response.
+    def __send_apdu(self, pdu):
+        rsp = self._tp.send_apdu(pdu)
+        if rsp.sw1 not in (0x90, 0x91):
+            self.__forget_path()
+        return rsp
+
+    def __send_apdu_checksw(self, pdu):
+        try:
+            return self._tp.send_apdu_checksw(pdu)
+        except RuntimeError:
+            self.__forget_path()
+            raise
+
+    def __use_ext_apdu(self):
+        if self.ext_apdu is not None:
+            return self.ext_apdu
+        if self._ext_apdu is None:
+            self._ext_apdu = bool(self._tp.ext_apdu) and ext_apdu_supported(self._tp.get_atr())
+        return self._ext_apdu
+
+    # Split length bytes starting at offset into as few READ/UPDATE BINARY
+    # commands as possible. Yields (offset, length) of each of them.
+    def __chunks(self, offset, length, short_max):
+        chunk = short_max
+        if length > short_max and self.__use_ext_apdu():
+            chunk = max(self.ext_apdu_max, short_max)
+        end = offset + length
+        while offset < end:
+            if offset > BINARY_OFFSET_MAX:
+                raise ValueError('Offset %d out of range of READ/UPDATE BINARY' % offset)
+            n = min(chunk, end - offset)
+            yield offset, n
+            offset += n
 
     def read_binary(self, ef, length=None, offset=0):
+        """Read length bytes (default: up to the end of the file) of a
+        transparent EF, in as many READ BINARY commands as needed. Returns
+        the data and the SW of the last command sent, if that failed the
+        data read so far."""
         if not hasattr(type(ef), '__iter__'):
             ef = [ef]
         r = self.select_file(ef)
@@ -127,36 +300,79 @@ class SimCardCommands(object):
             return (None, None)
         if length is None:
             length = self.__len(r) - offset
-        pdu = self.cla_byte + 'b0%04x%02x' % (offset, (min(256, length) & 0xff))
-        return self._tp.send_apdu(pdu)
+        chunks = []
+        sw = '9000'
+        for ofs, n in self.__chunks(offset, length, SHORT_LE_MAX):
+            rsp = self.__send_apdu(Apdu.build(self._cla, 0xb0, ofs >> 8, ofs & 0xff, le=n))
+            if rsp.sw != 0x9000:
+                sw = rsp.sw_hex()
+                break
+            chunks.append(rsp.data)
+        return b2h(b''.join(chunks)), sw
 
     def update_binary(self, ef, data, offset=0):
+        """Write data to a transparent EF starting at offset, in as many
+        UPDATE BINARY commands as needed. Raises a RuntimeError if any of
+        them fails."""
         if not hasattr(type(ef), '__iter__'):
             ef = [ef]
         self.select_file(ef)
-        pdu = self.cla_byte + 'd6%04x%02x' % (offset, len(data) / 2) + data
-        return self._tp.send_apdu_checksw(pdu)
+        data = memoryview(h2b(data))
+        rv = None
+        for ofs, n in self.__chunks(offset, len(data), SHORT_LC_MAX):
+            chunk = data[ofs - offset:ofs - offset + n]
+            rv = self.__send_apdu_checksw(Apdu.build(self._cla, 0xd6, ofs >> 8, ofs & 0xff, chunk))
+        if rv is None:
+            # Nothing to write
+            return ('', '9000')
+        return tuple(rv)
 
     def read_record(self, ef, rec_no):
+        return self.read_records(ef, [rec_no])[0]
+
+    def read_records(self, ef, rec_nos=None):
+        """Read the records rec_nos (default: all of them) of a linear fixed
+        or cyclic EF. The EF is selected and its record length looked up
+        only once. Returns a list of (data, sw) per record, which ends with
+        the first record that could not be read."""
         if not hasattr(type(ef), '__iter__'):
             ef = [ef]
         r = self.select_file(ef)
         rec_length = self.__record_len(r)
-        pdu = self.cla_byte + 'b2%02x04%02x' % (rec_no, rec_length)
-        return self._tp.send_apdu(pdu)
+        if rec_nos is None:
+            rec_nos = range(1, self.__len(r) // rec_length + 1)
+        res = []
+        for rec_no in rec_nos:
+            # Absolute mode, NEXT/PREVIOUS (P2 '02'/'03') would take the
+            # same number of APDUs but depend on the record pointer
+            rsp = self.__send_apdu(Apdu.build(self._cla, 0xb2, rec_no, 0x04, le=rec_length))
+            res.append(tuple(rsp))
+            if rsp.sw != 0x9000:
+                break
+        return res
 
     def update_record(self, ef, rec_no, data, force_len=False):
+        return self.update_records(ef, {rec_no: data}, force_len)[0]
+
+    def update_records(self, ef, records, force_len=False):
+        """Write the records given as dict of record number to data to a
+        linear fixed or cyclic EF, in order of their numbers. The EF is
+        selected and its record length looked up only once, the length of
+        all records is checked before anything is written (unless
+        force_len is set). Returns a list of (data, sw) per record, raises
+        a RuntimeError if writing one of them fails."""
         if not hasattr(type(ef), '__iter__'):
             ef = [ef]
         r = self.select_file(ef)
         if not force_len:
             rec_length = self.__record_len(r)
-            if (len(data) / 2 != rec_length):
-                raise ValueError('Invalid data length (expected %d, got %d)' % (rec_length, len(data) / 2))
-        else:
-            rec_length = len(data) / 2
-        pdu = (self.cla_byte + 'dc%02x04%02x' % (rec_no, rec_length)) + data
-        return self._tp.send_apdu_checksw(pdu)
+            for data in records.values():
+                if (len(data) / 2 != rec_length):
+                    raise ValueError('Invalid data length (expected %d, got %d)' % (rec_length, len(data) / 2))
+        res = []
+        for rec_no, data in sorted(records.items()):
+            res.append(tuple(self.__send_apdu_checksw(Apdu.build(self._cla, 0xdc, rec_no, 0x04, h2b(data)))))
+        return res
 
     def record_size(self, ef):
         r = self.select_file(ef)
@@ -170,36 +386,48 @@ class SimCardCommands(object):
         if len(rand) != 32:
             raise ValueError('Invalid rand')
         self.select_file(['3f00', '7f20'])
-        return self._tp.send_apdu(self.cla_byte + '88000010' + rand)
+        return tuple(self.__send_apdu(Apdu.build(self._cla, 0x88, 0x00, 0x00, h2b(rand))))
 
     def reset_card(self):
+        self.clear_select_cache()
+        self._ext_apdu = None
         return self._tp.reset_card()
 
+    def transaction(self):
+        """Context manager keeping the card to ourselves for a batch of
+        commands, see LinkBase.transaction()"""
+        return self._tp.transaction()
+
     def verify_chv(self, chv_no, code):
         fc = rpad(b2h(code), 16)
-        return self._tp.send_apdu_checksw(self.cla_byte + '2000' + ('%02X' % chv_no) + '08' + fc)
+        return tuple(self.__send_apdu_checksw(Apdu.build(self._cla, 0x20, 0x00, chv_no, h2b(fc))))
 
     def send_apdu(self, ins, p1='00', p2='00', data="", parse_tlv=True, beautiful_print=True):
         # time.sleep(0.5)
-        ret = self._tp.send_apdu(self.cla_byte + ins + p1 + p2 + '%02x' % (len(data) / 2) + data)
+        # We can't tell what a raw command does to the selection state
+        self.__forget_path()
+        ret = tuple(self._tp.send_apdu(self.cla_byte + ins + p1 + p2 + '%02x' % (len(data) / 2) + data))
         if beautiful_print:
             print(self._tp.apdu_to_string())
             print("============================")
         if ret[1] == '6a82':
             parse_tlv = False
         if parse_tlv:
-            print(ret[0])
-            parsed = self.__parse_fcp(ret[0])
+            parsed = decode_fcp(ret[0])
+            if beautiful_print:
+                print(ret[0])
+                print(parsed)
             return ret, parsed
 
         return ret, None
 
     def send_apdu_without_length(self, ins, p1='00', p2='00', data="", parse_tlv=False, beautiful_print=True):
-        ret = self._tp.send_apdu(self.cla_byte + ins + p1 + p2 + data)
+        self.__forget_path()
+        ret = tuple(self._tp.send_apdu(self.cla_byte + ins + p1 + p2 + data))
         if beautiful_print:
             print(self._tp.apdu_to_string())
             print("============================")
-        if parse_tlv:
-            self.__parse_fcp(ret[0])
+        if parse_tlv and beautiful_print:
+            print(decode_fcp(ret[0]))
 
         return ret
@@ -0,0 +1,226 @@
+#!/usr/bin/pyton
+
+import unittest
+
+from pySim.commands import SimCardCommands
+from pySim.transport import LinkBase
+
+# Files of a small SIM, size and record length are taken from the FID
+FILES = {
+	('3f00',): '01',
+	('3f00', '2fe2'): '04',
+	('3f00', '6fc4'): '04',
+	('3f00', '7f10'): '02',
+	('3f00', '7f10', '6f42'): '04',
+	('3f00', '7f20'): '02',
+	('3f00', '7f20', '6f07'): '04',
+	('3f00', '7f20', '6f30'): '04',
+}
+
+class FakeSimLink(LinkBase):
+	"""Minimal GSM 11.11 card which only knows SELECT, READ and UPDATE"""
+
+	def __init__(self):
+		self.apdus = []
+		self.fail_sw = None
+		self.reset_card()
+
+	def reset_card(self):
+		self.df = ('3f00',)
+
+	def send_apdu_raw(self, pdu):
+		self.apdus.append(pdu)
+		ins = pdu[2:4]
+		if ins != 'a4':
+			return '', '9000'
+		if self.fail_sw:
+			return '', self.fail_sw
+		fid = pdu[10:14].lower()
+		for path in [('3f00',) if fid == '3f00' else None,
+			     self.df + (fid,), self.df[:-1], self.df[:-1] + (fid,)]:
+			if path and path[-1] == fid and path in FILES:
+				break
+		else:
+			return '', '6a82'
+		if FILES[path] != '04':
+			self.df = path
+		return '0000' + '00' + fid[2:4] + fid + FILES[path] + '00' * 7 + '0a', '9000'
+
+	def selects(self):
+		return [pdu[10:14] for pdu in self.apdus if pdu[2:4] == 'a4']
+
+
+class SelectCacheTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tp = FakeSimLink()
+		self.scc = SimCardCommands(self.tp)
+		self.scc.cla_byte = 'a0'
+
+	def testSameFileIsSelectedOnce(self):
+		self.scc.read_binary(['3f00', '7f20', '6f07'])
+		self.scc.update_binary(['3f00', '7f20', '6f07'], '00' * 7)
+		self.scc.update_binary('6f07', '00' * 7)
+		self.assertEqual(self.tp.selects(), ['3f00', '7f20', '6f07'])
+
+	def testOnlyRelativeSelectsAreSent(self):
+		self.scc.read_binary(['3f00', '7f20', '6f07'])
+		self.scc.read_binary(['3f00', '7f20', '6f30'])
+		self.scc.read_binary(['3f00', '7f10', '6f42'])
+		self.assertEqual(self.tp.selects(),
+			['3f00', '7f20', '6f07', '6f30', '3f00', '7f10', '6f42'])
+
+	def testCachedResponsesAreReturned(self):
+		r1 = self.scc.select_file(['3f00', '7f20', '6f30'])
+		r2 = self.scc.select_file(['3f00', '7f20', '6f30'])
+		self.assertEqual(r1, r2)
+		self.assertEqual(int(r2[-1][4:8], 16), 0x30)
+
+	def testSiblingDfIsNotTrusted(self):
+		self.scc.select_file(['3f00', '7f20'])
+		self.scc.select_file(['7f10'])
+		self.scc.select_file(['3f00', '7f20'])
+		self.assertEqual(self.tp.selects(), ['3f00', '7f20', '7f10', '3f00', '7f20'])
+
+	def testResetInvalidates(self):
+		self.scc.select_file(['3f00', '7f20'])
+		self.scc.reset_card()
+		self.scc.select_file(['3f00', '7f20'])
+		self.assertEqual(self.tp.selects(), ['3f00', '7f20', '3f00', '7f20'])
+
+	def testFileNotFoundKeepsPath(self):
+		self.scc.select_file(['3f00', '7f20'])
+		self.assertRaises(RuntimeError, self.scc.select_file, ['3f00', '7f20', '6fff'])
+		self.scc.select_file(['3f00', '7f20', '6f07'])
+		self.assertEqual(self.tp.selects(), ['3f00', '7f20', '6fff', '6f07'])
+
+	def testSwErrorInvalidates(self):
+		self.scc.select_file(['3f00', '7f20'])
+		self.tp.fail_sw = '6f00'
+		self.assertRaises(RuntimeError, self.scc.select_file, ['3f00', '7f20', '6f07'])
+		self.tp.fail_sw = None
+		self.scc.select_file(['3f00', '7f20'])
+		self.assertEqual(self.tp.selects(), ['3f00', '7f20', '6f07', '3f00', '7f20'])
+
+	def testTrySelect(self):
+		rv, sw = self.scc.try_select_file(['3f00', '7f20', '6fff'])
+		self.assertEqual(sw, '6a82')
+		self.assertEqual(len(rv), 2)
+
+
+class RecordTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tp = FakeSimLink()
+		self.scc = SimCardCommands(self.tp)
+		self.scc.cla_byte = 'a0'
+
+	def records(self, ins):
+		return [pdu[4:6] for pdu in self.tp.apdus if pdu[2:4] == ins]
+
+	def testReadAll(self):
+		# 0x42 bytes in records of 10 bytes
+		res = self.scc.read_records(['3f00', '7f10', '6f42'])
+		self.assertEqual(res, [('', '9000')] * 6)
+		self.assertEqual(self.records('b2'), ['01', '02', '03', '04', '05', '06'])
+		self.assertEqual(self.tp.selects(), ['3f00', '7f10', '6f42'])
+
+	def testReadSome(self):
+		self.scc.read_records(['3f00', '7f10', '6f42'], [3, 1])
+		self.scc.read_record(['3f00', '7f10', '6f42'], 2)
+		self.assertEqual(self.records('b2'), ['03', '01', '02'])
+		self.assertEqual(self.tp.selects(), ['3f00', '7f10', '6f42'])
+
+	def testUpdate(self):
+		self.scc.update_records(['3f00', '7f10', '6f42'], {5: '55' * 10, 2: '22' * 10})
+		self.assertEqual(self.records('dc'), ['02', '05'])
+		self.assertEqual(self.tp.selects(), ['3f00', '7f10', '6f42'])
+
+	def testUpdateChecksAllLengths(self):
+		self.assertRaises(ValueError, self.scc.update_records, ['3f00', '7f10', '6f42'],
+			{1: '11' * 10, 2: '22' * 9})
+		self.assertEqual(self.records('dc'), [])
+
+# ATR of a card offering extended length APDUs in its card capabilities
+ATR_EXT = '3b8580018073c0216076'
+
+class BigEfLink(FakeSimLink):
+	"""FakeSimLink with a transparent EF 6fc4 of 1000 bytes"""
+
+	size = 1000
+
+	def __init__(self):
+		FakeSimLink.__init__(self)
+		self.atr = None
+		self.body = '00' * self.size
+
+	def get_atr(self):
+		return self.atr
+
+	def send_apdu_raw(self, pdu):
+		ins = pdu[2:4]
+		if ins == 'a4':
+			data, sw = FakeSimLink.send_apdu_raw(self, pdu)
+			if pdu[10:14] == '6fc4':
+				data = data[0:4] + '%04x' % self.size + data[8:]
+			return data, sw
+		self.apdus.append(pdu)
+		ofs = int(pdu[4:8], 16) * 2
+		if pdu[8:10] == '00' and len(pdu) > 10:
+			n, data = int(pdu[10:14], 16) or 0x10000, pdu[14:]
+		else:
+			n, data = int(pdu[8:10], 16) or 0x100, pdu[10:]
+		if ins == 'b0':
+			return self.body[ofs:ofs + n * 2], '9000'
+		if ins == 'd6':
+			assert len(data) == n * 2
+			self.body = self.body[:ofs] + data + self.body[ofs + len(data):]
+			return '', '9000'
+		return '', '6d00'
+
+	def binary_apdus(self):
+		return [pdu[2:4] for pdu in self.apdus if pdu[2:4] in ('b0', 'd6')]
+
+
+class ChunkTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tp = BigEfLink()
+		self.scc = SimCardCommands(self.tp)
+		self.scc.cla_byte = 'a0'
+		self.data = ''.join('%02x' % (i & 0xff) for i in range(self.tp.size))
+
+	def testShortApdus(self):
+		self.scc.update_binary('6fc4', self.data)
+		self.assertEqual(self.tp.body, self.data)
+		self.assertEqual(self.scc.read_binary('6fc4'), (self.data, '9000'))
+		# 1000 bytes are 4 UPDATEs of up to 255 and 4 READs of up to 256 bytes
+		self.assertEqual(self.tp.binary_apdus(), ['d6'] * 4 + ['b0'] * 4)
+
+	def testOffset(self):
+		self.scc.update_binary('6fc4', 'ab' * 300, offset=600)
+		self.assertEqual(self.tp.body, '00' * 600 + 'ab' * 300 + '00' * 100)
+		self.assertEqual(self.scc.read_binary('6fc4', length=310, offset=595),
+			('00' * 5 + 'ab' * 300 + '00' * 5, '9000'))
+
+	def testExtendedApdus(self):
+		self.tp.ext_apdu = True
+		self.tp.atr = ATR_EXT
+		self.scc.update_binary('6fc4', self.data)
+		self.assertEqual(self.scc.read_binary('6fc4'), (self.data, '9000'))
+		self.assertEqual(self.tp.binary_apdus(), ['d6', 'b0'])
+		# Small amounts still go in short APDUs
+		self.scc.read_binary('6fc4', length=10)
+		self.assertEqual(len(self.tp.apdus[-1]), 10)
+
+	def testExtendedNeedsCardAndReader(self):
+		self.tp.atr = ATR_EXT
+		self.scc.read_binary('6fc4')
+		self.tp.ext_apdu = True
+		self.tp.atr = None
+		self.scc.reset_card()
+		self.scc.read_binary('6fc4')
+		self.assertEqual(self.tp.binary_apdus(), ['b0'] * 8)
+
+if __name__ == "__main__":
+	unittest.main()
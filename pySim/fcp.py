@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Decoding of the FCP template returned by SELECT on a UICC
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+
+from pySim.utils import h2b, b2h
+
+# See also: ETSI TS 102 221, chapter 11.1.1.3 Response Data
+FCP_TAGS = {
+	'80': 'File size',
+	'81': 'Total file size',
+	'82': 'File descriptor',
+	'83': 'File identifier',
+	'84': 'DF name (AID)',
+	'88': 'Short file identifier',
+	'8a': 'Life cycle status integer',
+	'8b': 'Security attributes (referenced)',
+	'8c': 'Security attributes (compact)',
+	'a5': 'Proprietary information',
+	'ab': 'Security attributes (expanded)',
+	'c6': 'PIN status template DO',
+}
+
+# Constructed data objects found in an FCP, their value is a list of
+# TLVs again. Tags may repeat inside of them (e.g. in 'ab'), so they are
+# decoded into a list of (tag, value) tuples instead of a dict.
+TEMPLATE_TAGS = ('a5', 'ab', 'c6')
+
+
+def iter_tlv(buf, ofs=0, end=None):
+	"""
+	Walk the BER-TLV objects in buf[ofs:end], buf must be a bytearray.
+	Yields (tag, value_offset, value_end) without copying anything.
+	Tags are returned as lower case hex, lengths may be coded on one byte
+	or in the '81 xx' / '82 xx xx' forms (ETSI TS 102 221, chapter
+	11.1.1.3.0 Base coding).
+	"""
+	if end is None:
+		end = len(buf)
+	while ofs < end:
+		tag_ofs = ofs
+		# Skip padding between data objects, see ISO 7816-4
+		if buf[ofs] in (0x00, 0xff):
+			ofs += 1
+			continue
+		if buf[ofs] & 0x1f == 0x1f:
+			ofs += 1
+			while ofs < end and buf[ofs] & 0x80:
+				ofs += 1
+		ofs += 1
+		if ofs >= end:
+			raise ValueError('Truncated TLV at offset %d' % tag_ofs)
+		tag = b2h(buf[tag_ofs:ofs])
+		l = buf[ofs]
+		ofs += 1
+		if l == 0x81:
+			if ofs + 1 > end:
+				raise ValueError('Truncated TLV length at offset %d' % tag_ofs)
+			l = buf[ofs]
+			ofs += 1
+		elif l == 0x82:
+			if ofs + 2 > end:
+				raise ValueError('Truncated TLV length at offset %d' % tag_ofs)
+			l = (buf[ofs] << 8) | buf[ofs + 1]
+			ofs += 2
+		elif l & 0x80:
+			raise ValueError('Unsupported TLV length 0x%02x at offset %d' % (l, tag_ofs))
+		if ofs + l > end:
+			raise ValueError('TLV %s at offset %d exceeds its template' % (tag, tag_ofs))
+		yield tag, ofs, ofs + l
+		ofs += l
+
+
+def _decode(buf, ofs, end, nested, as_list):
+	res = [] if as_list else OrderedDict()
+	for tag, start, stop in iter_tlv(buf, ofs, end):
+		if nested and tag in TEMPLATE_TAGS:
+			value = _decode(buf, start, stop, nested, True)
+		else:
+			value = b2h(buf[start:stop])
+		if as_list:
+			res.append((tag, value))
+		else:
+			res[tag] = value
+	return res
+
+
+def decode_tlv(data, nested=False):
+	"""
+	Decode a list of BER-TLV objects given as hex string or bytes into a
+	dict of lower case hex tag to lower case hex value. If nested is set,
+	the value of templates is decoded into a list of (tag, value) tuples.
+	"""
+	buf = _to_buf(data)
+	return _decode(buf, 0, len(buf), nested, False)
+
+
+def decode_fcp(fcp, nested=False):
+	"""
+	Decode the FCP template (tag '62') of a SELECT response, given as hex
+	string or bytes. Returns a dict of lower case hex tag to lower case hex
+	value of the data objects in the template (see decode_tlv), or None if
+	the response is no FCP template. Raises ValueError if the template is
+	malformed.
+	"""
+	buf = _to_buf(fcp)
+	if len(buf) < 2 or buf[0] != 0x62:
+		return None
+	for tag, start, stop in iter_tlv(buf):
+		# Only the first data object is the FCP template, anything behind
+		# it is not part of the response
+		return _decode(buf, start, stop, nested, False)
+
+
+def _to_buf(data):
+	# Responses are passed around as hex strings all over pySim, binary
+	# data (e.g. straight from a file) is accepted as bytearray or
+	# memoryview, or as bytes on Python 3
+	if isinstance(data, bytearray):
+		return data
+	if isinstance(data, memoryview) or (bytes is not str and isinstance(data, bytes)):
+		return bytearray(data)
+	return bytearray(h2b(data))
+
+
+def fcp_is_df(fcp):
+	"""Tell from a decoded FCP whether the file is a DF or an ADF"""
+	fd = fcp.get('82')
+	if not fd:
+		return False
+	return (int(fd[0:2], 16) & 0x38) == 0x38
+
+
+def fcp_file_size(fcp):
+	"""Size of the body of an EF from a decoded FCP"""
+	return int(fcp['80'], 16)
+
+
+def fcp_record_len(fcp):
+	"""Record length of a linear fixed or cyclic EF from a decoded FCP"""
+	# See also ETSI TS 102 221, chapter 11.1.1.4.3 File Descriptor
+	return int(fcp['82'][4:8], 16)
+
+
+def fcp_record_count(fcp):
+	"""Number of records of a linear fixed or cyclic EF from a decoded FCP"""
+	return int(fcp['82'][8:10], 16)
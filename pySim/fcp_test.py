@@ -0,0 +1,60 @@
+#!/usr/bin/pyton
+
+import unittest
+
+from pySim.fcp import *
+
+# EF.DIR, linear fixed with records of 0x26 bytes
+FCP_EF_DIR = "62228205422100260283022f00a506c00100ca01808a01058b032f06048002004c8801f0"
+# MF, with a PIN status template
+FCP_MF = "622d8202782183023f00a50ac00100ca0180cb02000f8a01058b032f0601c60f90017083010183018183010a83010b"
+
+class DecodeFcpTestCase(unittest.TestCase):
+
+	def testEf(self):
+		fcp = decode_fcp(FCP_EF_DIR)
+		self.assertEqual(list(fcp.keys()), ['82', '83', 'a5', '8a', '8b', '80', '88'])
+		self.assertEqual(fcp['82'], '4221002602')
+		self.assertEqual(fcp['83'], '2f00')
+		self.assertEqual(fcp['a5'], 'c00100ca0180')
+		self.assertEqual(fcp_record_len(fcp), 0x26)
+		self.assertEqual(fcp_record_count(fcp), 2)
+		self.assertEqual(fcp_file_size(fcp), 0x4c)
+		self.assertFalse(fcp_is_df(fcp))
+
+	def testDf(self):
+		fcp = decode_fcp(FCP_MF)
+		self.assertTrue(fcp_is_df(fcp))
+		self.assertEqual(fcp['c6'], '90017083010183018183010a83010b')
+
+	def testNested(self):
+		fcp = decode_fcp(FCP_MF, nested=True)
+		self.assertEqual(fcp['a5'], [('c0', '00'), ('ca', '80'), ('cb', '000f')])
+		self.assertEqual(fcp['c6'], [('90', '70'), ('83', '01'), ('83', '81'), ('83', '0a'), ('83', '0b')])
+
+	def testUpperCase(self):
+		self.assertEqual(decode_fcp(FCP_EF_DIR.upper()), decode_fcp(FCP_EF_DIR))
+
+	def testBinary(self):
+		self.assertEqual(decode_fcp(bytearray(h2b(FCP_EF_DIR))), decode_fcp(FCP_EF_DIR))
+
+	def testTwoByteLength(self):
+		body = "8001ff" + "c0" + "8181" + "00" * 0x81
+		fcp = decode_fcp("6281%02x" % (len(body) // 2) + body)
+		self.assertEqual(fcp['80'], 'ff')
+		self.assertEqual(fcp['c0'], '00' * 0x81)
+		fcp = decode_fcp("628200%02x" % (len(body) // 2) + body)
+		self.assertEqual(fcp['c0'], '00' * 0x81)
+
+	def testNoFcp(self):
+		self.assertEqual(decode_fcp(""), None)
+		self.assertEqual(decode_fcp("0000002f00040011"), None)
+
+	def testTruncated(self):
+		self.assertRaises(ValueError, decode_fcp, FCP_EF_DIR[:-2])
+
+	def testDecodeTlv(self):
+		self.assertEqual(decode_tlv("8001008301ff"), {'80': '00', '83': 'ff'})
+
+if __name__ == "__main__":
+	unittest.main()
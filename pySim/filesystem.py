@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Walking the file system of a SIM/UICC
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+
+from pySim.fcp import decode_fcp, decode_tlv
+from pySim import ts_51_011, ts_102_221, ts_31_102
+
+
+def _build_tree(files):
+	# files is a list of (name, path), returns a dict of the path of a DF
+	# (tuple of lower case FIDs) to an OrderedDict of FID -> name of the
+	# files to look for in it. Several names for the same FID are fine,
+	# the first one in alphabetical order wins.
+	tree = {}
+	for name, path in sorted(files, reverse=True):
+		path = tuple(fid.lower() for fid in path)
+		tree.setdefault(path[:-1], {})[path[-1]] = name
+	return dict((df, OrderedDict(sorted(efs.items()))) for df, efs in tree.items())
+
+# Files below the MF, as defined by the specs
+MF_TREE = _build_tree(
+	list(ts_51_011.DF.items()) + list(ts_51_011.EF.items()) + list(ts_102_221.EF.items()) +
+	[(name, ts_51_011.DF['TELECOM'] + [fid]) for name, fid in ts_31_102.EF_TELECOM_map.items()])
+
+# Files below an ADF, by the AID prefix of the application
+ADF_TREES = {
+	ts_31_102.AID_USIM: _build_tree(
+		[(name, [ts_102_221.ADF_num, fid]) for name, fid in ts_31_102.EF_USIM_ADF_map.items()]),
+}
+
+
+class CardFile(object):
+	"""A DF or EF found on the card by walk()"""
+
+	def __init__(self, fid, name, path, fci):
+		self.fid = fid
+		self.name = name
+		self.path = path
+		self.fci = fci		# SELECT response, hex string
+		self.aid = None		# ADFs only
+		self.type = None	# mf, df, adf, transparent, linear, cyclic
+		self.size = None
+		self.rec_len = None
+		self.rec_count = None
+		self.children = []
+		self.data = None	# hex string, or list of records
+		self.sw = None		# SW if reading the contents failed
+		self.__describe(fci)
+
+	def __repr__(self):
+		return "CardFile(%s, %s, %s)" % ('/'.join(self.path), self.name, self.type)
+
+	def __iter__(self):
+		"""Iterate over this file and everything below it, depth first"""
+		yield self
+		for child in self.children:
+			for f in child:
+				yield f
+
+	def is_df(self):
+		return self.type in ('mf', 'df', 'adf')
+
+	def find(self, path):
+		"""Look up a file by its path, e.g. ['3f00', '7f20', '6f07']"""
+		path = [fid.lower() for fid in path]
+		for f in self:
+			if f.path == path:
+				return f
+		return None
+
+	# Get type and size of the file from the SELECT response. USIMs respond
+	# with an FCP template (ETSI TS 102 221, chapter 11.1.1.4), SIMs as
+	# described in GSM 11.11, chapter 9.2.1
+	def __describe(self, fci):
+		fcp = decode_fcp(fci) if fci[0:2] == '62' else None
+		if fcp is not None:
+			fd = fcp.get('82', '')
+			if not fd:
+				return
+			fd_byte = int(fd[0:2], 16)
+			if fd_byte & 0x38 == 0x38:
+				self.type = 'mf' if self.fid == '3f00' else 'df'
+				if 'a5' in fcp and '84' in fcp:
+					self.type = 'adf'
+				return
+			self.type = {1: 'transparent', 2: 'linear', 6: 'cyclic'}.get(fd_byte & 0x07)
+			if len(fd) >= 10:
+				self.rec_len = int(fd[4:8], 16)
+				self.rec_count = int(fd[8:10], 16)
+			if '80' in fcp:
+				self.size = int(fcp['80'], 16)
+		elif len(fci) >= 30:
+			self.type = {'01': 'mf', '02': 'df'}.get(fci[12:14])
+			if self.type is not None:
+				return
+			self.type = {'00': 'transparent', '01': 'linear', '03': 'cyclic'}.get(fci[26:28])
+			self.size = int(fci[4:8], 16)
+			if self.type != 'transparent':
+				self.rec_len = int(fci[28:30], 16)
+				if self.rec_len:
+					self.rec_count = self.size // self.rec_len
+
+
+def _read(scc, f):
+	if f.type == 'transparent':
+		if not f.size:
+			f.data = ''
+			return
+		data, sw = scc.read_binary(f.path)
+		if sw != '9000':
+			f.sw = sw
+			return
+		f.data = data
+	elif f.type in ('linear', 'cyclic'):
+		records = []
+		for data, sw in scc.read_records(f.path, range(1, (f.rec_count or 0) + 1)):
+			if sw != '9000':
+				f.sw = sw
+				return
+			records.append(data)
+		f.data = records
+
+
+def _walk_df(scc, df, tree, read_types):
+	files = tree.get(tuple(df.path), {}).items()
+	found = {}
+	# The files with nothing below them first: once back from a DF, the
+	# next file takes selecting its whole path from the MF again
+	for fid, name in sorted(files, key=lambda item: tuple(df.path + [item[0]]) in tree):
+		path = df.path + [fid]
+		rv, sw = scc.try_select_file(path)
+		if sw != '9000':
+			# Not on the card, nothing below it either
+			continue
+		f = CardFile(fid, name, path, rv[-1])
+		found[fid] = f
+		if f.is_df():
+			_walk_df(scc, f, tree, read_types)
+		elif f.type in read_types:
+			_read(scc, f)
+	df.children.extend(found[fid] for fid, name in files if fid in found)
+
+
+def _aids(ef_dir):
+	# Application templates in the records of EF.DIR, see also ETSI TS
+	# 102 221, chapter 13.1
+	aids = []
+	for rec in ef_dir.data or []:
+		try:
+			aid = decode_tlv(decode_tlv(rec).get('61', '')).get('4f')
+		except ValueError:
+			continue
+		if aid:
+			aids.append(aid)
+	return aids
+
+
+EF_TYPES = ('transparent', 'linear', 'cyclic')
+
+def walk(scc, read_data=True, mf_tree=MF_TREE, adf_trees=ADF_TREES, read_types=EF_TYPES):
+	"""
+	Find all files of the card below the MF and below the applications
+	listed in EF.DIR. Only the files named in mf_tree / adf_trees are
+	looked for, and nothing below a DF which is not on the card. The type
+	and size of each file is taken from its SELECT response. If read_data
+	is set, the contents of the EFs of read_types are read as well (see
+	CardFile.data).
+	Returns the CardFile of the MF.
+	"""
+	read_types = read_types if read_data else ()
+	rv = scc.select_file(['3f00'])
+	mf = CardFile('3f00', 'MF', ['3f00'], rv[-1])
+	_walk_df(scc, mf, mf_tree, read_types)
+
+	ef_dir = mf.find(ts_102_221.EF['DIR'])
+	if ef_dir is None:
+		return mf
+	if ef_dir.data is None and ef_dir.sw is None:
+		_read(scc, ef_dir)
+	for aid in _aids(ef_dir):
+		try:
+			fci, sw = scc.select_adf(aid)
+		except RuntimeError:
+			continue
+		adf = CardFile(ts_102_221.ADF_num.lower(), 'ADF', [ts_102_221.ADF_num.lower()], fci)
+		adf.type = 'adf'
+		adf.aid = aid
+		mf.children.append(adf)
+		for prefix, tree in adf_trees.items():
+			if aid.lower().startswith(prefix):
+				_walk_df(scc, adf, tree, read_types)
+	return mf
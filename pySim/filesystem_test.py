@@ -0,0 +1,146 @@
+#!/usr/bin/pyton
+
+import unittest
+from collections import OrderedDict
+
+from pySim.commands import SimCardCommands
+from pySim.filesystem import walk, MF_TREE
+from pySim.transport import LinkBase
+
+AID_USIM = 'a0000000871002ffffffff8907090000'
+
+def tlv(tag, value):
+	return tag + '%02x' % (len(value) // 2) + value
+
+def df_fcp(fid, aid=None):
+	fcp = tlv('82', '7821') + tlv('83', fid)
+	if aid:
+		fcp += tlv('84', aid) + tlv('a5', tlv('80', '00'))
+	return tlv('62', fcp)
+
+def ef_fcp(fid, size, rec_len=None):
+	if rec_len:
+		fd = '4221%04x%02x' % (rec_len, size // rec_len)
+	else:
+		fd = '4121'
+	return tlv('62', tlv('82', fd) + tlv('83', fid) + tlv('80', '%04x' % size))
+
+EF_DIR_REC = (tlv('61', tlv('4f', AID_USIM) + tlv('50', '5553494d')) + 'ff' * 38)[:76]
+
+# DF.MExE is below DF.GSM in 3GPP TS 51.011, so there is a DF which comes
+# before the EFs of its parent
+TREE = dict(MF_TREE)
+TREE[('3f00',)] = OrderedDict((fid, name) for fid, name in MF_TREE[('3f00',)].items() if fid != '5f3c')
+TREE[('3f00', '7f20')] = OrderedDict(sorted(list(MF_TREE[('3f00', '7f20')].items()) + [('5f3c', 'MExE')]))
+TREE[('3f00', '7f20', '5f3c')] = OrderedDict([('4f40', 'MExE-ST')])
+
+# path -> (FCP, contents)
+FILES = {
+	('3f00',): (df_fcp('3f00'), None),
+	('3f00', '2f00'): (ef_fcp('2f00', 76, 38), [EF_DIR_REC, 'ff' * 38]),
+	('3f00', '2fe2'): (ef_fcp('2fe2', 10), '98101430121181157002'),
+	('3f00', '7f20'): (df_fcp('7f20'), None),
+	('3f00', '7f20', '5f3c'): (df_fcp('5f3c'), None),
+	('3f00', '7f20', '5f3c', '4f40'): (ef_fcp('4f40', 2), '0102'),
+	('3f00', '7f20', '6f07'): (ef_fcp('6f07', 9), '080910101032547698'),
+	('7fff',): (df_fcp('7fff', AID_USIM), None),
+	('7fff', '6f07'): (ef_fcp('6f07', 9), '080910101032547698'),
+	('7fff', '6f3c'): (ef_fcp('6f3c', 352, 176), ['00' * 176, '01' * 176]),
+}
+
+class FakeUiccLink(LinkBase):
+	"""Minimal UICC which knows SELECT by FID and AID, READ BINARY and READ RECORD"""
+
+	def __init__(self):
+		self.apdus = []
+		self.reset_card()
+
+	def reset_card(self):
+		self.df = ('3f00',)
+		self.ef = None
+
+	def send_apdu_raw(self, pdu):
+		self.apdus.append(pdu)
+		ins = pdu[2:4]
+		if ins == 'a4' and pdu[4:6] == '04':
+			if pdu[10:] != AID_USIM:
+				return '', '6a82'
+			self.df, self.ef = ('7fff',), None
+			return FILES[self.df][0], '9000'
+		elif ins == 'a4':
+			fid = pdu[10:14].lower()
+			for path in [(fid,) if fid in ('3f00', '7fff') else None,
+				     self.df + (fid,), self.df[:-1], self.df[:-1] + (fid,)]:
+				if path and path[-1] == fid and path in FILES:
+					break
+			else:
+				return '', '6a82'
+			if FILES[path][1] is None:
+				self.df, self.ef = path, None
+			else:
+				self.ef = path
+			return FILES[path][0], '9000'
+		elif ins == 'b0':
+			return FILES[self.ef][1], '9000'
+		elif ins == 'b2':
+			return FILES[self.ef][1][int(pdu[4:6], 16) - 1], '9000'
+		return '', '6d00'
+
+	def selects(self):
+		return [pdu[10:].lower() for pdu in self.apdus if pdu[2:4] == 'a4']
+
+
+class WalkTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tp = FakeUiccLink()
+		self.scc = SimCardCommands(self.tp)
+		self.scc.sel_ctrl = '0004'
+		self.mf = walk(self.scc, mf_tree=TREE)
+
+	def testTree(self):
+		self.assertEqual([(f.path, f.type) for f in self.mf], [
+			(['3f00'], 'mf'),
+			(['3f00', '2f00'], 'linear'),
+			(['3f00', '2fe2'], 'transparent'),
+			(['3f00', '7f20'], 'df'),
+			(['3f00', '7f20', '5f3c'], 'df'),
+			(['3f00', '7f20', '5f3c', '4f40'], 'transparent'),
+			(['3f00', '7f20', '6f07'], 'transparent'),
+			(['7fff'], 'adf'),
+			(['7fff', '6f07'], 'transparent'),
+			(['7fff', '6f3c'], 'linear'),
+		])
+		self.assertEqual(self.mf.find(['7fff']).aid, AID_USIM)
+		self.assertEqual(self.mf.find(['3f00', '7f20', '6f07']).name, 'IMSI')
+
+	def testData(self):
+		self.assertEqual(self.mf.find(['3f00', '2fe2']).data, FILES[('3f00', '2fe2')][1])
+		ef = self.mf.find(['7fff', '6f3c'])
+		self.assertEqual((ef.size, ef.rec_len, ef.rec_count), (352, 176, 2))
+		self.assertEqual(ef.data, FILES[('7fff', '6f3c')][1])
+
+	def testSelects(self):
+		selects = self.tp.selects()
+		# Nothing is looked for below a DF which isn't there
+		self.assertFalse([s for s in selects if s == '6f3a'])
+		# Every file is selected only once
+		fids = [path[-1] for path in FILES if len(path) > 1]
+		for fid in fids:
+			self.assertEqual(selects.count(fid), fids.count(fid), fid)
+		self.assertEqual(selects.count(AID_USIM), 1)
+		# The EFs of a DF before the DFs below it
+		self.assertTrue(selects.index('6f07') < selects.index('5f3c'))
+
+	def testReadTypes(self):
+		tp = FakeUiccLink()
+		scc = SimCardCommands(tp)
+		scc.sel_ctrl = '0004'
+		mf = walk(scc, mf_tree=TREE, read_types=('transparent',))
+		self.assertEqual(mf.find(['7fff', '6f3c']).data, None)
+		self.assertEqual(mf.find(['7fff', '6f07']).data, FILES[('7fff', '6f07')][1])
+		# Only EF.DIR, for the AIDs
+		self.assertEqual(len([pdu for pdu in tp.apdus if pdu[2:4] == 'b2']), 2)
+
+if __name__ == "__main__":
+	unittest.main()
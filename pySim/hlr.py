@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Writing the subscribers of programmed cards to an OpenBSC HLR
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+import string
+import threading
+
+from pySim.utils import h2b
+
+
+def _dbi_binary_quote(s):
+	# Count usage of each char
+	cnt = {}
+	for c in s:
+		cnt[c] = cnt.get(c, 0) + 1
+
+	# Find best offset
+	e = 0
+	m = len(s)
+	for i in range(1, 256):
+		if i == 39:
+			continue
+		sum_ = cnt.get(i, 0) + cnt.get((i+1)&0xff, 0) + cnt.get((i+39)&0xff, 0)
+		if sum_ < m:
+			m = sum_
+			e = i
+			if m == 0:	# No overhead ? use this !
+				break;
+
+	# Generate output
+	out = []
+	out.append( chr(e) )	# Offset
+	for c in s:
+		x = (256 + ord(c) - e) % 256
+		if x in (0, 1, 39):
+			out.append('\x01')
+			out.append(chr(x+1))
+		else:
+			out.append(chr(x))
+
+	return ''.join(out)
+
+
+class HlrRejected(Exception):
+	"""The HLR didn't take some cards, rows has their (imsi, name,
+	extension, ki) and error the reason for each"""
+
+	def __init__(self, rows, errors):
+		Exception.__init__(self, 'HLR rejected %s: %s' % (', '.join([row[0] for row in rows]),
+			'; '.join([str(e) for e in errors])))
+		self.rows = rows
+		self.errors = errors
+
+
+class HlrWriter(object):
+	"""Writes the parameters of programmed cards into an OpenBSC HLR
+	sqlite3 database. One connection is kept for the whole batch, and the
+	cards are inserted in transactions of batch_size cards each. Anything
+	still pending is written by flush() and close().
+
+	If the HLR refuses a batch, its cards are tried one by one. Those it
+	refuses again (e.g. an IMSI or extension that is there already) are
+	appended to reject_file, FILE.rejected by default, and HlrRejected is
+	raised for them. The rows that went in stay in."""
+
+	def __init__(self, filename, batch_size=100, dry_run=False, reject_file=None):
+		self._filename = filename
+		self._batch_size = max(batch_size, 1)
+		self._dry_run = dry_run
+		self._reject_file = reject_file or filename + '.rejected'
+		self._lock = threading.Lock()
+		self._conn = None
+		self._rows = []
+
+	@staticmethod
+	def validate(params):
+		"""Raise ValueError if the HLR can't take params, returns the row
+		for it otherwise"""
+		if not params['imsi'].isdigit():
+			raise ValueError('IMSI must be digits only !')
+		if not params['iccid'].isdigit() or len(params['iccid']) < 5:
+			raise ValueError('ICCID must be digits only !')
+		ki = params['ki']
+		if len(ki) != 32 or not all([c in string.hexdigits for c in ki]):
+			raise ValueError('Ki needs to be 128 bits, in hex format')
+		return (params['imsi'], params['name'], '9' + params['iccid'][-5:-1], ki)
+
+	def write(self, params):
+		row = self.validate(params)
+		with self._lock:
+			self._rows.append(row)
+			if len(self._rows) >= self._batch_size:
+				self._flush()
+
+	def _insert(self, rows):
+		# Commits, or rolls back all of rows on error
+		with self._conn:
+			self._conn.executemany(
+				'INSERT INTO Subscriber ' +
+				'(imsi, name, extension, authorized, created, updated) ' +
+				'VALUES ' +
+				'(?,?,?,1,datetime(\'now\'),datetime(\'now\'));',
+				[ (imsi, name, ext) for (imsi, name, ext, ki) in rows ],
+			)
+			self._conn.executemany(
+				'INSERT INTO AuthKeys ' +
+				'(subscriber_id, algorithm_id, a3a8_ki) ' +
+				'SELECT id, ?, ? FROM Subscriber WHERE imsi = ?',
+				[ (2, sqlite3.Binary(_dbi_binary_quote(h2b(ki))), imsi)
+				  for (imsi, name, ext, ki) in rows ],
+			)
+
+	def _flush(self):
+		rows, self._rows = self._rows, []
+		if self._dry_run or not rows:
+			return
+
+		if self._conn is None:
+			self._conn = sqlite3.connect(self._filename, check_same_thread=False)
+			self._conn.execute('PRAGMA journal_mode=WAL')
+
+		try:
+			self._insert(rows)
+			return
+		except sqlite3.Error as e:
+			error = e
+
+		# One bad row must not hold up the others, nor the cards to come
+		if len(rows) == 1:
+			rejected, errors = rows, [error]
+		else:
+			rejected, errors = [], []
+			for row in rows:
+				try:
+					self._insert([row])
+				except sqlite3.Error as e:
+					rejected.append(row)
+					errors.append(e)
+		if rejected:
+			self._save_rejected(rejected, errors)
+			raise HlrRejected(rejected, errors)
+
+	def _save_rejected(self, rows, errors):
+		# The cards are programmed already, so their keys must not get lost
+		with open(self._reject_file, 'a') as f:
+			for (imsi, name, ext, ki), e in zip(rows, errors):
+				f.write('%s,%s,%s,%s,%s\n' % (imsi, name, ext, ki, e))
+
+	def flush(self):
+		with self._lock:
+			self._flush()
+
+	def close(self):
+		with self._lock:
+			try:
+				self._flush()
+			finally:
+				if self._conn is not None:
+					self._conn.close()
+					self._conn = None
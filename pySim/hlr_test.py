@@ -0,0 +1,93 @@
+#!/usr/bin/pyton
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from pySim.hlr import HlrWriter, HlrRejected
+
+# The parts of the OpenBSC HLR schema HlrWriter writes to
+SCHEMA = """
+CREATE TABLE Subscriber (id INTEGER PRIMARY KEY AUTOINCREMENT, created TIMESTAMP NOT NULL,
+	updated TIMESTAMP NOT NULL, imsi NUMERIC UNIQUE NOT NULL, name TEXT,
+	extension TEXT UNIQUE, authorized INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE AuthKeys (subscriber_id INTEGER PRIMARY KEY, algorithm_id INTEGER NOT NULL,
+	a3a8_ki BLOB);
+"""
+
+def params(n, iccid=None):
+	return {
+		'imsi': '90155%010d' % n,
+		'iccid': iccid or '89882%014d' % (n * 10),
+		'name': 'Test',
+		'ki': '%032x' % n,
+	}
+
+
+class HlrWriterTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.dir, 'hlr.sqlite3')
+		db = sqlite3.connect(self.filename)
+		db.executescript(SCHEMA)
+		db.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def imsis(self):
+		db = sqlite3.connect(self.filename)
+		try:
+			return [row[0] for row in db.execute('SELECT imsi FROM Subscriber JOIN AuthKeys ' +
+				'ON AuthKeys.subscriber_id = Subscriber.id ORDER BY imsi')]
+		finally:
+			db.close()
+
+	def testBatch(self):
+		w = HlrWriter(self.filename, batch_size=2)
+		w.write(params(1))
+		self.assertEqual(self.imsis(), [])
+		w.write(params(2))
+		w.write(params(3))
+		w.close()
+		self.assertEqual(len(self.imsis()), 3)
+
+	def testDuplicate(self):
+		w = HlrWriter(self.filename, batch_size=3)
+		w.write(params(1))
+		w.flush()
+		w.write(params(2))
+		w.write(params(1))
+		self.assertRaises(HlrRejected, w.write, params(3))
+		# The others of the batch went in, the duplicate in the rejects
+		self.assertEqual(self.imsis(), [int(params(n)['imsi']) for n in (1, 2, 3)])
+		with open(self.filename + '.rejected') as f:
+			self.assertEqual(f.read().split(',')[0], params(1)['imsi'])
+		# Nothing left behind for the cards to come
+		w.write(params(4))
+		w.close()
+		self.assertEqual(len(self.imsis()), 4)
+
+	def testSameExtension(self):
+		w = HlrWriter(self.filename, batch_size=1)
+		w.write(params(1, iccid='8988200000000012345'))
+		try:
+			w.write(params(2, iccid='8988200000000012345'))
+		except HlrRejected as e:
+			self.assertEqual([row[0] for row in e.rows], [params(2)['imsi']])
+		else:
+			self.fail('No HlrRejected')
+		w.write(params(3))
+		w.close()
+		self.assertEqual(len(self.imsis()), 2)
+
+	def testValidate(self):
+		self.assertRaises(ValueError, HlrWriter.validate, dict(params(1), ki='zz'))
+		self.assertRaises(ValueError, HlrWriter.validate, dict(params(1), imsi='9015x'))
+		self.assertEqual(HlrWriter.validate(params(1))[2], '90001')
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Storing the files read from a card as a profile
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+import mmap
+import os
+import re
+import struct
+
+from pySim.utils import h2b, b2h
+
+#
+# A profile file consists of a header, the EFs one after the other and an
+# index of the EFs at the end. All integers are big endian.
+#
+# header:  magic 'pSPF', version (u8), flags (u8), reserved (u16),
+#          offset of the index (u32), number of EFs (u32)
+# EF:      type (u8), kind of data (u8), length of the FCI (u16), FCI,
+#          then depending on the kind of data:
+#            DATA_NONE:    nothing, the file wasn't read
+#            DATA_BINARY:  length (u32), contents
+#            DATA_RECORDS: number of records (u16), length of a record
+#                          (u16), all records back to back
+#            DATA_VARIABLE_RECORDS: number of records (u16), then for
+#                          each record length (u16), record
+# index:   length of the names (u32), the names (DF name and EF name of
+#          each EF, all terminated by a zero byte), then for each EF
+#          offset (u32) and length (u32) of the EF
+#
+# FCI and contents are stored as binary, and are hex strings again when
+# loaded. Readers refuse files of a newer version than they know.
+#
+
+MAGIC = b'pSPF'
+VERSION = 1
+
+_HEADER = struct.Struct('>4sBBHII')
+_EF = struct.Struct('>BBH')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+_ENTRY = struct.Struct('>II')
+_RECORDS = struct.Struct('>HH')
+
+TYPES = ('transparent', 'linear', 'cyclic')
+
+DATA_NONE = 0
+DATA_BINARY = 1
+DATA_RECORDS = 2
+DATA_VARIABLE_RECORDS = 3
+
+# The DFs of a profile as saved by the read scripts, and the name of the
+# profile file in a profile folder
+DFS = ('mf', 'adf', 'gsm', 'telecom')
+PROFILE_NAME = 'card.profile'
+
+
+class ProfileEF(object):
+	"""An EF of a profile, with the same attributes as the EF of the scripts"""
+
+	__slots__ = ('name', 'tp', 'fci', 'data')
+
+	def __init__(self, name, tp="transparent", fci=None, data=None):
+		self.name = name
+		self.tp = tp
+		self.fci = fci
+		self.data = data
+
+	def __repr__(self):
+		return "\nName: {}\n Type: {} \n FCI: {} \n Data: {}\n".format(self.name, self.tp, self.fci, self.data)
+
+	def __eq__(self, other):
+		return (self.name, self.tp, self.fci, self.data) == \
+			(other.name, other.tp, other.fci, other.data)
+
+	def __ne__(self, other):
+		return not self == other
+
+
+def _hex(s):
+	if len(s) % 2:
+		raise ValueError('Odd length hex string %r' % s)
+	return h2b(s)
+
+
+def _encode_ef(ef):
+	fci = _hex(ef.fci or '')
+	if ef.data is None:
+		kind, body = DATA_NONE, [b'']
+	elif isinstance(ef.data, (list, tuple)):
+		recs = [_hex(rec) for rec in ef.data]
+		lengths = set(len(rec) for rec in recs)
+		if len(lengths) == 1:
+			kind, body = DATA_RECORDS, [_U16.pack(len(recs)), _U16.pack(lengths.pop())] + recs
+		else:
+			kind, body = DATA_VARIABLE_RECORDS, [_U16.pack(len(recs))]
+			for rec in recs:
+				body += [_U16.pack(len(rec)), rec]
+	else:
+		data = _hex(ef.data)
+		kind, body = DATA_BINARY, [_U32.pack(len(data)), data]
+	return b''.join([_EF.pack(TYPES.index(ef.tp), kind, len(fci)), fci] + body)
+
+
+class ProfileWriter(object):
+	"""
+	Write a profile EF by EF, e.g. while the EFs are written to a card.
+	The file only shows up under its name once close() is called, if
+	abort() is called instead, nothing is written.
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self._tmp = filename + '.tmp'
+		self._f = open(self._tmp, 'wb')
+		self._f.write(b'\0' * _HEADER.size)
+		self._ofs = _HEADER.size
+		self._index = []
+
+	def add(self, df, ef):
+		buf = _encode_ef(ef)
+		self._f.write(buf)
+		self._index.append((df.encode('ascii'), ef.name.encode('ascii'), self._ofs, len(buf)))
+		self._ofs += len(buf)
+
+	def close(self, filename=None):
+		"""Finish the profile, and save it as filename if given"""
+		f = self._f
+		names = b''.join(df + b'\0' + name + b'\0' for df, name, ef_ofs, ef_len in self._index)
+		f.write(_U32.pack(len(names)) + names)
+		f.write(b''.join(_ENTRY.pack(ef_ofs, ef_len) for df, name, ef_ofs, ef_len in self._index))
+		f.seek(0)
+		f.write(_HEADER.pack(MAGIC, VERSION, 0, 0, self._ofs, len(self._index)))
+		f.close()
+		os.rename(self._tmp, filename or self.filename)
+
+	def abort(self):
+		self._f.close()
+		os.unlink(self._tmp)
+
+
+def save_profile(filename, dfs):
+	"""
+	Write a profile, dfs is a list of (DF name, list of EFs), each EF
+	having name, tp, fci and data like ProfileEF. The file is replaced
+	atomically.
+	"""
+	w = ProfileWriter(filename)
+	try:
+		for df, efs in dfs:
+			for ef in efs:
+				w.add(df, ef)
+	except:
+		w.abort()
+		raise
+	w.close()
+
+
+class Profile(object):
+	"""
+	A profile file opened for reading. Only the index is read when
+	opening, an EF is decoded from the memory mapped file when it is
+	asked for.
+	"""
+
+	def __init__(self, filename):
+		self._f = open(filename, 'rb')
+		try:
+			self._map = self.__map()
+			self._index = self.__read_index()
+		except:
+			self.close()
+			raise
+
+	def __map(self):
+		if os.fstat(self._f.fileno()).st_size < _HEADER.size:
+			raise ValueError('%s is no profile' % self._f.name)
+		return mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __read_index(self):
+		magic, version, flags, _, ofs, count = _HEADER.unpack_from(self._map, 0)
+		if magic != MAGIC:
+			raise ValueError('%s is no profile' % self._f.name)
+		if version > VERSION:
+			raise ValueError('%s has profile version %d, only up to %d is supported' %
+				(self._f.name, version, VERSION))
+		m = self._map
+		l = _U32.unpack_from(m, ofs)[0]
+		names = m[ofs + 4:ofs + 4 + l].decode('ascii').split('\0')
+		ofs += 4 + l
+		entries = struct.unpack_from('>%dI' % (2 * count), m, ofs)
+		if len(names) != 2 * count + 1:
+			raise ValueError('%s has a corrupt index' % self._f.name)
+		index = OrderedDict()
+		for i in range(count):
+			index.setdefault(names[2 * i], []).append(
+				(names[2 * i + 1], entries[2 * i:2 * i + 2]))
+		return index
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		if getattr(self, '_map', None) is not None:
+			self._map.close()
+			self._map = None
+		self._f.close()
+
+	def dfs(self):
+		"""Names of the DFs in the profile"""
+		return list(self._index.keys())
+
+	def names(self, df):
+		"""Names of the EFs of a DF"""
+		return [name for name, entry in self._index.get(df, [])]
+
+	def get(self, df, name):
+		"""Decode a single EF, returns a ProfileEF"""
+		for ef_name, entry in self._index.get(df, []):
+			if ef_name == name:
+				return self.__decode(df, name, entry)
+		raise KeyError('%s/%s' % (df, name))
+
+	def __decode(self, df, name, entry):
+		ofs, length = entry
+		m = self._map
+		end = ofs + length
+		tp, kind, fci_len = _EF.unpack_from(m, ofs)
+		ofs += _EF.size
+		fci = b2h(m[ofs:ofs + fci_len])
+		ofs += fci_len
+		if kind == DATA_BINARY:
+			l = _U32.unpack_from(m, ofs)[0]
+			data = b2h(m[ofs + 4:ofs + 4 + l])
+			ofs += 4 + l
+		elif kind == DATA_RECORDS:
+			count, l = _RECORDS.unpack_from(m, ofs)
+			ofs += _RECORDS.size
+			recs = b2h(m[ofs:ofs + count * l])
+			l *= 2
+			data = [recs[i:i + l] for i in range(0, count * l, l)]
+			ofs += count * l // 2
+		elif kind == DATA_VARIABLE_RECORDS:
+			count = _U16.unpack_from(m, ofs)[0]
+			ofs += 2
+			data = []
+			for i in range(count):
+				l = _U16.unpack_from(m, ofs)[0]
+				data.append(b2h(m[ofs + 2:ofs + 2 + l]))
+				ofs += 2 + l
+		else:
+			data = None
+		if ofs != end:
+			raise ValueError('EF %s/%s of %s is corrupt' % (df, name, self._f.name))
+		return ProfileEF(name, TYPES[tp], fci, data)
+
+	def iter_efs(self, df):
+		"""Decode the EFs of a DF one after the other, yields ProfileEF"""
+		for name, entry in self._index.get(df, []):
+			yield self.__decode(df, name, entry)
+
+	def load(self, df):
+		"""Decode all EFs of a DF, returns a list of ProfileEF"""
+		return list(self.iter_efs(df))
+
+
+# The text dumps (DF.txt in a profile folder) older versions of the read
+# scripts wrote, i.e. str() of a list of EF. Every EF takes four lines.
+_TEXT_RECORD = re.compile(r"'([0-9a-fA-F]*)'")
+
+def iter_text_profile(lines):
+	"""
+	Parse a text dump of a list of EF given as lines, e.g. an open file.
+	Yields a ProfileEF as soon as its lines are read.
+	"""
+	ef = None
+	for line in lines:
+		line = line.strip()
+		if line.startswith('Name:'):
+			ef = ProfileEF(line[5:].strip())
+		elif ef is None:
+			continue
+		elif line.startswith('Type:'):
+			ef.tp = line[5:].strip()
+		elif line.startswith('FCI:'):
+			ef.fci = line[4:].strip()
+		elif line.startswith('Data:'):
+			data = line[5:].strip()
+			if data == 'None':
+				data = None
+			elif ef.tp != 'transparent':
+				data = _TEXT_RECORD.findall(data)
+			ef.data = data
+			yield ef
+			ef = None
+
+def parse_text_profile(s):
+	"""Parse a text dump of a list of EF, returns a list of ProfileEF"""
+	return list(iter_text_profile(s.splitlines()))
+
+
+def iter_profile(folder, df):
+	"""
+	Yield the EFs of the DF df (see DFS) of the profile in folder one by
+	one, from the binary profile file or, for folders written before there
+	was one, from the text dump of the DF.
+	"""
+	filename = os.path.join(folder, PROFILE_NAME)
+	if os.path.exists(filename):
+		with Profile(filename) as p:
+			for ef in p.iter_efs(df):
+				yield ef
+		return
+	with open(os.path.join(folder, df + ".txt"), "r") as f:
+		for ef in iter_text_profile(f):
+			yield ef
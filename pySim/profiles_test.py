@@ -0,0 +1,90 @@
+#!/usr/bin/pyton
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from pySim.profiles import *
+
+EFS = [
+	ProfileEF('2FE2', 'transparent', '621e8202412183022fe2a506c00100ca01808a01058b032f06048002000a8800', '98101430121181157002'),
+	ProfileEF('2F00', 'linear', '62228205422100260283022f00a506c00100ca01808a01058b032f06048002004c8801f0', ['61124f10a0000000871002ffffffff8907090000' + 'ff' * 18, 'ff' * 38]),
+	ProfileEF('6F3A', 'linear', '', ['00', '0102']),
+	ProfileEF('6F05', 'cyclic', '', []),
+	ProfileEF('6F06', 'transparent', '', None),
+	ProfileEF('6F07', 'transparent', '', ''),
+]
+
+class ProfileTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.dir, PROFILE_NAME)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def testRoundTrip(self):
+		save_profile(self.filename, [('mf', EFS[:2]), ('adf', EFS[2:])])
+		with Profile(self.filename) as p:
+			self.assertEqual(p.dfs(), ['mf', 'adf'])
+			self.assertEqual(p.names('adf'), ['6F3A', '6F05', '6F06', '6F07'])
+			self.assertEqual(p.load('mf'), EFS[:2])
+			self.assertEqual(p.load('adf'), EFS[2:])
+			self.assertEqual(p.load('gsm'), [])
+			self.assertEqual(p.get('mf', '2F00'), EFS[1])
+			self.assertRaises(KeyError, p.get, 'mf', '6F07')
+
+	def testWriter(self):
+		w = ProfileWriter(self.filename)
+		w.add('mf', EFS[0])
+		self.assertFalse(os.path.exists(self.filename))
+		w.add('adf', EFS[1])
+		w.close()
+		with Profile(self.filename) as p:
+			self.assertEqual(p.load('adf'), [EFS[1]])
+		w = ProfileWriter(self.filename + '2')
+		w.abort()
+		self.assertEqual(os.listdir(self.dir), [PROFILE_NAME])
+
+	def testStrIsUnchanged(self):
+		save_profile(self.filename, [('mf', EFS)])
+		with Profile(self.filename) as p:
+			self.assertEqual(str(p.load('mf')), str(EFS))
+
+	def testNoProfile(self):
+		with open(self.filename, 'wb') as f:
+			f.write(b'Name: 2FE2\n Type: transparent \n')
+		self.assertRaises(ValueError, Profile, self.filename)
+
+	def testNewerVersion(self):
+		save_profile(self.filename, [('mf', EFS)])
+		with open(self.filename, 'r+b') as f:
+			f.seek(4)
+			f.write(struct.pack('>B', VERSION + 1))
+		self.assertRaises(ValueError, Profile, self.filename)
+
+	def testOddHex(self):
+		self.assertRaises(ValueError, save_profile, self.filename, [('mf', [ProfileEF('2FE2', data='abc')])])
+
+	def testIter(self):
+		save_profile(self.filename, [('mf', EFS)])
+		with Profile(self.filename) as p:
+			efs = p.iter_efs('mf')
+			self.assertEqual(next(efs), EFS[0])
+			self.assertEqual(list(efs), EFS[1:])
+
+	def testTextProfile(self):
+		self.assertEqual(parse_text_profile(str(EFS)), EFS)
+
+	def testTextProfileIsStreamed(self):
+		def lines():
+			for line in str(EFS).splitlines()[:6]:
+				yield line
+			raise AssertionError('Read too far')
+		self.assertEqual(next(iter_text_profile(lines())), EFS[0])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Tracing of the APDUs exchanged with the card
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import atexit
+import collections
+import os
+import struct
+import threading
+
+from pySim.apdu import Apdu, Response
+
+#
+# A trace file starts with a header:
+#
+#   magic       4 bytes  'pSTR'
+#   version     u8
+#
+# followed by one record per APDU sent:
+#
+#   timestamp   f64      time.time() when the APDU was sent
+#   duration    f32      seconds until the response was there
+#   apdu_len    u16
+#   data_len    u16      length of the response data
+#   sw          u16      0 if there was no response
+#   apdu, data
+#
+# All numbers are big endian.
+#
+
+MAGIC = b'pSTR'
+VERSION = 1
+
+_HEADER = struct.Struct('>4sB')
+_RECORD = struct.Struct('>dfHHH')
+
+# Environment variable naming the file to trace the APDUs of all links to
+TRACE_ENV = 'PYSIM_TRACE'
+
+
+class ApduTracer(object):
+	"""
+	Keeps the APDUs recorded in a ring buffer in memory, from where a
+	background thread writes them to filename. Once the file grows beyond
+	max_bytes, it is renamed to filename.1 (and so on, up to backup_count
+	old files) and a new one is started. If the writer falls behind by
+	more than ring_size APDUs, the oldest ones are dropped.
+	"""
+
+	def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=3, ring_size=4096):
+		self.filename = filename
+		self.max_bytes = max_bytes
+		self.backup_count = backup_count
+		self.dropped = 0
+		self._ring = collections.deque(maxlen=ring_size)
+		self._cond = threading.Condition()
+		self._busy = False
+		self._closed = False
+		self._thread = None
+		self._f = None
+
+	def record(self, t, duration, apdu, rsp):
+		"""Queue an APDU sent at time t, which took duration seconds"""
+		with self._cond:
+			if self._closed:
+				return
+			if len(self._ring) == self._ring.maxlen:
+				self.dropped += 1
+			self._ring.append((t, duration, apdu, rsp))
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='pySim-trace')
+				self._thread.daemon = True
+				self._thread.start()
+			self._cond.notify()
+
+	def flush(self):
+		"""Wait until everything recorded so far is in the file"""
+		with self._cond:
+			while (self._ring or self._busy) and self._thread is not None:
+				self._cond.wait(0.1)
+
+	def close(self):
+		self.flush()
+		with self._cond:
+			self._closed = True
+			self._cond.notify()
+		if self._thread is not None:
+			self._thread.join()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._ring and not self._closed:
+					self._cond.wait()
+				if not self._ring:
+					break
+				batch = list(self._ring)
+				self._ring.clear()
+				self._busy = True
+			try:
+				self._write(batch)
+			finally:
+				with self._cond:
+					self._busy = False
+					self._cond.notify_all()
+		if self._f is not None:
+			self._f.close()
+			self._f = None
+
+	def _write(self, batch):
+		buf = _pack(batch)
+		if self._f is not None and self._f.tell() + len(buf) > self.max_bytes:
+			self._f.close()
+			self._f = None
+			self._rotate()
+		if self._f is None:
+			self._f = open(self.filename, 'ab')
+			if self._f.tell() == 0:
+				self._f.write(_HEADER.pack(MAGIC, VERSION))
+		self._f.write(buf)
+		self._f.flush()
+
+	# Same naming as logging.handlers.RotatingFileHandler
+	def _rotate(self):
+		for i in range(self.backup_count - 1, 0, -1):
+			src = '%s.%d' % (self.filename, i)
+			if os.path.exists(src):
+				os.rename(src, '%s.%d' % (self.filename, i + 1))
+		if self.backup_count > 0:
+			os.rename(self.filename, self.filename + '.1')
+		else:
+			os.remove(self.filename)
+
+
+def _pack(records):
+	buf = []
+	for t, duration, apdu, rsp in records:
+		buf.append(_RECORD.pack(t, duration, len(apdu.buf), len(rsp.data), rsp.sw or 0))
+		buf.append(apdu.buf)
+		buf.append(rsp.data)
+	return b''.join(buf)
+
+
+def write_trace(filename, records):
+	"""Write (timestamp, duration, Apdu, Response) records to a new trace"""
+	with open(filename, 'wb') as f:
+		f.write(_HEADER.pack(MAGIC, VERSION))
+		f.write(_pack(records))
+
+
+def read_trace(filename):
+	"""Yield (timestamp, duration, Apdu, Response) from a trace file"""
+	with open(filename, 'rb') as f:
+		hdr = f.read(_HEADER.size)
+		if len(hdr) < _HEADER.size:
+			raise ValueError('%s: not an APDU trace' % filename)
+		magic, version = _HEADER.unpack(hdr)
+		if magic != MAGIC:
+			raise ValueError('%s: not an APDU trace' % filename)
+		if version != VERSION:
+			raise ValueError('%s: unsupported trace version %d' % (filename, version))
+		while True:
+			rec = f.read(_RECORD.size)
+			if len(rec) < _RECORD.size:
+				# A trace may end in the middle of a record if the
+				# program was killed while writing it
+				return
+			t, duration, apdu_len, data_len, sw = _RECORD.unpack(rec)
+			body = f.read(apdu_len + data_len)
+			if len(body) < apdu_len + data_len:
+				return
+			if sw:
+				rsp = Response(body[apdu_len:], sw >> 8, sw & 0xff)
+			else:
+				rsp = Response(b'', None, None)
+			yield t, duration, Apdu(body[:apdu_len]), rsp
+
+
+_env_tracer = None
+
+def tracer_from_env():
+	"""The tracer shared by all links if PYSIM_TRACE names a file, or None"""
+	global _env_tracer
+	filename = os.environ.get(TRACE_ENV)
+	if not filename:
+		return None
+	if _env_tracer is None:
+		_env_tracer = ApduTracer(filename)
+		atexit.register(_env_tracer.close)
+	return _env_tracer
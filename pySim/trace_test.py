@@ -0,0 +1,69 @@
+#!/usr/bin/pyton
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pySim.apdu import Apdu, Response
+from pySim.trace import ApduTracer, read_trace
+from pySim.transport import LinkBase
+
+class EchoLink(LinkBase):
+	"""Answers every APDU with its header"""
+
+	def send_apdu_raw(self, pdu):
+		return pdu[0:8], '9000'
+
+class TraceTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.dir, 'apdu.trace')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def testLink(self):
+		link = EchoLink()
+		self.assertEqual(link.tracer, None)
+		link.tracer = ApduTracer(self.filename)
+		link.send_apdu('a0a40000023f00')
+		link.send_apdu('a0b0000005')
+		link.tracer.close()
+		recs = list(read_trace(self.filename))
+		self.assertEqual([(apdu.hex(), tuple(rsp)) for t, d, apdu, rsp in recs],
+			[('a0a40000023f00', ('a0a40000', '9000')), ('a0b0000005', ('a0b00000', '9000'))])
+		self.assertTrue(all(d >= 0 for t, d, apdu, rsp in recs))
+
+	def testNoResponse(self):
+		tracer = ApduTracer(self.filename)
+		tracer.record(1.5, 0.25, Apdu.from_hex('00b0000001'), Response(b'', None, None))
+		tracer.close()
+		(t, d, apdu, rsp), = read_trace(self.filename)
+		self.assertEqual((t, d, tuple(rsp)), (1.5, 0.25, (None, None)))
+
+	def testRotate(self):
+		tracer = ApduTracer(self.filename, max_bytes=200, backup_count=2)
+		for i in range(20):
+			tracer.record(i, 0, Apdu.from_hex('00b00000ff'), Response(b'\xff' * 20, 0x90, 0x00))
+			tracer.flush()
+		tracer.close()
+		self.assertEqual(sorted(os.listdir(self.dir)), ['apdu.trace', 'apdu.trace.1', 'apdu.trace.2'])
+		for name in os.listdir(self.dir):
+			self.assertTrue(os.path.getsize(os.path.join(self.dir, name)) <= 200)
+		times = [t for t, d, apdu, rsp in read_trace(self.filename)]
+		self.assertEqual(times[-1], 19)
+
+	def testRingDropsOldest(self):
+		tracer = ApduTracer(self.filename, ring_size=2)
+		# Hold back the writer thread
+		with tracer._cond:
+			for i in range(5):
+				tracer.record(i, 0, Apdu.from_hex('00b0000001'), Response(b'\x00', 0x90, 0x00))
+			self.assertEqual(tracer.dropped, 3)
+		tracer.close()
+		self.assertEqual([t for t, d, apdu, rsp in read_trace(self.filename)], [3, 4])
+
+if __name__ == "__main__":
+	unittest.main()
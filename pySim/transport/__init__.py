@@ -21,8 +21,24 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import contextlib
+import time
+
+from pySim.apdu import Apdu, Response
+from pySim.trace import tracer_from_env
+
+
 class LinkBase(object):
 
+	# Whether the reader passes on extended length APDUs (ISO 7816-4,
+	# chapter 5.1), the card has to support them as well
+	ext_apdu = False
+
+	# pySim.trace.ApduTracer to record the APDUs to, None to not trace
+	# them. By default all links trace to the file named by the PYSIM_TRACE
+	# environment variable, if any.
+	tracer = tracer_from_env()
+
 	def wait_for_card(self, timeout=None, newcardonly=False):
 		"""wait_for_card(): Wait for a card and connect to it
 
@@ -47,6 +63,34 @@ class LinkBase(object):
 		"""
 		pass
 
+	def get_atr(self):
+		"""get_atr(): Returns the ATR of the card as list of ints, or None
+		"""
+		return None
+
+	def begin_transaction(self):
+		"""begin_transaction(): Keep the card to ourselves until
+		   end_transaction(), on links where other applications can
+		   use it too. Calls nest.
+		"""
+		pass
+
+	def end_transaction(self):
+		"""end_transaction(): End what begin_transaction() started
+		"""
+		pass
+
+	@contextlib.contextmanager
+	def transaction(self):
+		"""transaction(): begin_transaction() and end_transaction() around
+		   a with block, e.g. a batch of APDUs
+		"""
+		self.begin_transaction()
+		try:
+			yield self
+		finally:
+			self.end_transaction()
+
 	def send_apdu_raw(self, pdu):
 		"""send_apdu_raw(pdu): Sends an APDU with minimal processing
 
@@ -57,20 +101,32 @@ class LinkBase(object):
 		"""
 		pass
 
+	def transceive(self, apdu):
+		"""transceive(apdu): Sends an APDU with minimal processing
+
+		   apdu   : pySim.apdu.Apdu
+		   return : pySim.apdu.Response
+
+		   Links which talk bytes to the card override this, the default
+		   goes through send_apdu_raw() and hex strings.
+		"""
+		data, sw = self.send_apdu_raw(apdu.hex())
+		return Response.from_hex(data, sw)
+
 	def send_apdu(self, pdu):
 		"""send_apdu(pdu): Sends an APDU and auto fetch response data
 
-		   pdu    : string of hexadecimal characters (ex. "A0A40000023F00")
-		   return : tuple(data, sw), where
+		   pdu    : string of hexadecimal characters (ex. "A0A40000023F00"),
+			    or pySim.apdu.Apdu
+		   return : pySim.apdu.Response, which is a tuple(data, sw) too, where
 			    data : string (in hex) of returned data (ex. "074F4EFFFF")
 			    sw   : string (in hex) of status word (ex. "9000")
 		"""
-                with open("/tmp/pdu.txt", "a+") as f:
-                        f.write(pdu+"\n")
-                data, sw = self.send_apdu_raw(pdu)
-                self.last_pdu = pdu
-                self.last_data = data
-                self.last_sw = sw
+		if not isinstance(pdu, Apdu):
+			pdu = Apdu.from_hex(pdu)
+		rsp = self.__transceive(pdu)
+		self.last_pdu = pdu
+		self.last_rsp = rsp
 		# When whe have sent the first APDU, the SW may indicate that there are response bytes
 		# available. There are two SWs commonly used for this 9fxx (sim) and 61xx (usim), where
 		# xx is the number of response bytes available.
@@ -78,33 +134,42 @@ class LinkBase(object):
 		# SW1=9F: 3GPP TS 51.011 9.4.1, Responses to commands which are correctly executed
 		# SW1=61: ISO/IEC 7816-4, Table 5 — General meaning of the interindustry values of SW1-SW2
 
-		if (sw is not None) and ((sw[0:2] == '9f') or (sw[0:2] == '61')):
-			pdu_gr = pdu[0:2] + 'c00000' + sw[2:4]
-			data, sw = self.send_apdu_raw(pdu_gr)
-                
-		return data, sw
-
-        def apdu_to_string(self):
-                def beautiful_print_apdu(s):
-                        cla = s[0:2]
-                        ins = s[2:4]
-                        p1 = s[4:6]
-                        p2 = s[6:8]
-                        length = s[8:10]
-                        data = s[10:]
-                        k = ("APDU SENT:")
-                        k += ("\nCLA: " + cla)
-                        k += ("\nINS: " + ins)
-                        k += ("\np1: " + p1)
-                        k += ("\np2: " + p2)
-                        k += ("\nlength: " + length)
-                        k += ("\ndata: " + data + '\n')
-                        return k
-                k = beautiful_print_apdu(self.last_pdu)
-                k += ("APDU Response code: " + self.last_sw)
-                k += ("APDU Response data : " + self.last_data)
-                return k
-        
+		if rsp.sw1 in (0x9f, 0x61):
+			rsp = self.__transceive(Apdu.build(pdu.cla, 0xc0, 0x00, 0x00, le=rsp.sw2 or 256))
+
+		return rsp
+
+	def __transceive(self, pdu):
+		tracer = self.tracer
+		if tracer is None:
+			return self.transceive(pdu)
+		t = time.time()
+		rsp = self.transceive(pdu)
+		tracer.record(t, time.time() - t, pdu, rsp)
+		return rsp
+
+	def apdu_to_string(self):
+		def beautiful_print_apdu(s):
+			cla = s[0:2]
+			ins = s[2:4]
+			p1 = s[4:6]
+			p2 = s[6:8]
+			length = s[8:10]
+			data = s[10:]
+			k = ("APDU SENT:")
+			k += ("\nCLA: " + cla)
+			k += ("\nINS: " + ins)
+			k += ("\np1: " + p1)
+			k += ("\np2: " + p2)
+			k += ("\nlength: " + length)
+			k += ("\ndata: " + data + '\n')
+			return k
+		data, sw = self.last_rsp
+		k = beautiful_print_apdu(self.last_pdu.hex())
+		k += ("APDU Response code: " + sw)
+		k += ("APDU Response data : " + data)
+		return k
+
 	def send_apdu_checksw(self, pdu, sw="9000"):
 		"""send_apdu_checksw(pdu,sw): Sends an APDU and check returned SW
 
@@ -112,12 +177,11 @@ class LinkBase(object):
 		   sw     : string of 4 hexadecimal characters (ex. "9000"). The
 			    user may mask out certain digits using a '?' to add some
 			    ambiguity if needed.
-		   return : tuple(data, sw), where
-			    data : string (in hex) of returned data (ex. "074F4EFFFF")
-			    sw   : string (in hex) of status word (ex. "9000")
+		   return : pySim.apdu.Response, see send_apdu()
 		"""
-              
+
 		rv = self.send_apdu(pdu)
+		rv_sw = rv.sw_hex()
 
 		# Create a masked version of the returned status word
 		sw_masked = ""
@@ -125,8 +189,8 @@ class LinkBase(object):
 			if sw.lower()[i] == '?':
 				sw_masked = sw_masked + '?'
 			else:
-				sw_masked = sw_masked + rv[1][i].lower()
+				sw_masked = sw_masked + rv_sw[i]
 
 		if sw.lower() != sw_masked:
-			raise RuntimeError("SW match failed! Expected %s and got %s." % (sw.lower(), rv[1]))
+			raise RuntimeError("SW match failed! Expected %s and got %s." % (sw.lower(), rv_sw))
 		return rv
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Non-blocking access to transport links, for many readers at once
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+
+import sys
+import threading
+
+try:
+	import queue
+except ImportError:
+	# Python 2
+	import Queue as queue
+
+from pySim.commands import SimCardCommands
+from pySim.exceptions import ReaderError
+
+# The links of pySim block until the card has answered: serial reads byte
+# by byte, Calypso waits in select(), PC/SC in SCardTransmit(). So each
+# AsyncLinkBase has a thread of its own doing the blocking calls, one by
+# one in the order they were made, and hands out a Future for each. The
+# caller goes on with other readers and collects the results when it
+# needs them.
+
+
+class Future(object):
+	"""The result of a call run by the worker of an AsyncLinkBase"""
+
+	def __init__(self):
+		self._done = threading.Event()
+		self._lock = threading.Lock()
+		self._result = None
+		self._exc = None
+		self._callbacks = []
+
+	def done(self):
+		return self._done.is_set()
+
+	def result(self, timeout=None):
+		"""Wait for the call to finish and return what it returned, or
+		raise what it raised"""
+		self.__wait(timeout)
+		if self._exc is not None:
+			raise self._exc
+		return self._result
+
+	def exception(self, timeout=None):
+		"""Wait for the call to finish and return what it raised, or None"""
+		self.__wait(timeout)
+		return self._exc
+
+	def add_done_callback(self, fn):
+		"""Call fn(future) once the call is finished, right away if it
+		already is. The callback runs in the thread finishing the call."""
+		with self._lock:
+			if not self._done.is_set():
+				self._callbacks.append(fn)
+				return
+		fn(self)
+
+	def set_result(self, result):
+		self.__finish(result, None)
+
+	def set_exception(self, exc):
+		self.__finish(None, exc)
+
+	def __wait(self, timeout):
+		# Event.wait() without timeout can't be interrupted on Python 2
+		while not self._done.wait(timeout if timeout is not None else 1.0):
+			if timeout is not None:
+				raise ReaderError("No result after %.1f s" % timeout)
+
+	def __finish(self, result, exc):
+		with self._lock:
+			self._result = result
+			self._exc = exc
+			self._done.set()
+			callbacks, self._callbacks = self._callbacks, []
+		for fn in callbacks:
+			fn(self)
+
+
+class AsyncLinkBase(object):
+	"""
+	Wraps a LinkBase, its calls return a Future instead of blocking. The
+	calls are run one after the other by a thread which is started with
+	the first call and runs until close().
+	"""
+
+	def __init__(self, link):
+		self.link = link
+		self._queue = queue.Queue()
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def submit(self, fn, *args, **kwargs):
+		"""Queue fn(*args, **kwargs) to be run by the worker of this link,
+		after all calls queued before. Returns a Future."""
+		f = Future()
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='pySim-link')
+				self._thread.daemon = True
+				self._thread.start()
+			self._queue.put((f, fn, args, kwargs))
+		return f
+
+	def close(self):
+		"""Wait for the calls queued so far and stop the worker"""
+		with self._lock:
+			thread, self._thread = self._thread, None
+			if thread is None:
+				return
+			self._queue.put(None)
+		thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _run(self):
+		while True:
+			job = self._queue.get()
+			if job is None:
+				return
+			f, fn, args, kwargs = job
+			try:
+				res = fn(*args, **kwargs)
+			except Exception:
+				f.set_exception(sys.exc_info()[1])
+			else:
+				f.set_result(res)
+
+	def wait_for_card(self, timeout=None, newcardonly=False):
+		return self.submit(self.link.wait_for_card, timeout, newcardonly)
+
+	def connect(self):
+		return self.submit(self.link.connect)
+
+	def disconnect(self):
+		return self.submit(self.link.disconnect)
+
+	def reset_card(self):
+		return self.submit(self.link.reset_card)
+
+	def get_atr(self):
+		return self.submit(self.link.get_atr)
+
+	def begin_transaction(self):
+		return self.submit(self.link.begin_transaction)
+
+	def end_transaction(self):
+		return self.submit(self.link.end_transaction)
+
+	def send_apdu_raw(self, pdu):
+		"""see LinkBase.send_apdu_raw"""
+		return self.submit(self.link.send_apdu_raw, pdu)
+
+	def send_apdu(self, pdu):
+		"""see LinkBase.send_apdu"""
+		return self.submit(self.link.send_apdu, pdu)
+
+	def send_apdu_checksw(self, pdu, sw="9000"):
+		"""see LinkBase.send_apdu_checksw"""
+		return self.submit(self.link.send_apdu_checksw, pdu, sw)
+
+
+class AsyncSerialSimLink(AsyncLinkBase):
+	"""A SerialSimLink (same arguments) behind an AsyncLinkBase"""
+
+	def __init__(self, *args, **kwargs):
+		from pySim.transport.serial import SerialSimLink
+		AsyncLinkBase.__init__(self, SerialSimLink(*args, **kwargs))
+
+
+class AsyncPcscSimLink(AsyncLinkBase):
+	"""A PcscSimLink (same arguments) behind an AsyncLinkBase"""
+
+	def __init__(self, *args, **kwargs):
+		from pySim.transport.pcsc import PcscSimLink
+		AsyncLinkBase.__init__(self, PcscSimLink(*args, **kwargs))
+
+
+class AsyncCalypsoSimLink(AsyncLinkBase):
+	"""A CalypsoSimLink (same arguments) behind an AsyncLinkBase"""
+
+	def __init__(self, *args, **kwargs):
+		from pySim.transport.calypso import CalypsoSimLink
+		AsyncLinkBase.__init__(self, CalypsoSimLink(*args, **kwargs))
+
+
+class AsyncSimCardCommands(object):
+	"""
+	SimCardCommands on an AsyncLinkBase: every method returns a Future of
+	what the SimCardCommands method returns, e.g.
+
+	  data, sw = AsyncSimCardCommands(alink).read_binary(['3f00', '2fe2']).result()
+
+	Attributes set (e.g. sel_ctrl) take effect in order with the calls,
+	attributes read are those of the SimCardCommands at that moment.
+	"""
+
+	def __init__(self, link):
+		self.__dict__['link'] = link
+		self.__dict__['scc'] = SimCardCommands(transport=link.link)
+
+	def __getattr__(self, name):
+		attr = getattr(self.scc, name)
+		if not callable(attr):
+			return attr
+		def call(*args, **kwargs):
+			return self.link.submit(attr, *args, **kwargs)
+		return call
+
+	def __setattr__(self, name, value):
+		self.link.submit(setattr, self.scc, name, value)
+
+
+def gather(futures, timeout=None):
+	"""The results of all futures, in their order. Raises what the first
+	failed one raised."""
+	return [f.result(timeout) for f in futures]
+
+
+def as_completed(futures, timeout=None):
+	"""Yield the futures as they finish"""
+	done = queue.Queue()
+	futures = list(futures)
+	for f in futures:
+		f.add_done_callback(done.put)
+	for i in range(len(futures)):
+		try:
+			yield done.get(timeout=timeout if timeout is not None else 1e9)
+		except queue.Empty:
+			raise ReaderError("No result after %.1f s" % timeout)
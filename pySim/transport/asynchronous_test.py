@@ -0,0 +1,75 @@
+#!/usr/bin/pyton
+
+import time
+import unittest
+
+from pySim.exceptions import ProtocolError, ReaderError
+from pySim.transport.asynchronous import *
+from pySim.transport.virtual import VirtualCard, VirtualCardLink, FCP_MF
+
+FCP_EF = '62168202412183026f998a01058b036f0603800200108800'
+
+
+class SlowLink(VirtualCardLink):
+
+	def transceive(self, apdu):
+		time.sleep(0.02)
+		return VirtualCardLink.transceive(self, apdu)
+
+
+class AsyncLinkTestCase(unittest.TestCase):
+
+	def testSendApdu(self):
+		with AsyncLinkBase(VirtualCardLink()) as alink:
+			f = alink.send_apdu('00a40004023f00')
+			self.assertEqual(f.result(), (FCP_MF, '9000'))
+			self.assertTrue(f.done())
+
+	def testInOrder(self):
+		with AsyncLinkBase(VirtualCardLink()) as alink:
+			alink.send_apdu('00e0000018' + FCP_EF)
+			alink.send_apdu('00d6000002abcd')
+			f = alink.send_apdu('00b0000002')
+			self.assertEqual(f.result(), ('abcd', '9000'))
+
+	def testException(self):
+		with AsyncLinkBase(VirtualCardLink()) as alink:
+			f = alink.send_apdu_checksw('00b0000002')
+			self.assertRaises(RuntimeError, f.result)
+			self.assertTrue(isinstance(f.exception(), RuntimeError))
+			# The worker goes on after a failed call
+			self.assertEqual(alink.send_apdu('00a4000c023f00').result(), ('', '9000'))
+
+	def testTimeout(self):
+		with AsyncLinkBase(VirtualCardLink()) as alink:
+			f = alink.submit(time.sleep, 0.2)
+			self.assertRaises(ReaderError, f.result, 0.01)
+			self.assertEqual(f.result(), None)
+
+	def testManyReaders(self):
+		alinks = [AsyncLinkBase(SlowLink(VirtualCard())) for i in range(20)]
+		t = time.time()
+		futures = []
+		for alink in alinks:
+			for i in range(5):
+				futures.append(alink.send_apdu('00a4000c023f00'))
+		self.assertEqual(gather(futures), [('', '9000')] * 100)
+		# One after the other, it would take 2 s
+		self.assertTrue(time.time() - t < 1.0)
+		self.assertEqual(len(list(as_completed(futures))), 100)
+		for alink in alinks:
+			alink.close()
+
+	def testCommands(self):
+		card = VirtualCard()
+		card.create(card.mf, FCP_EF)
+		with AsyncLinkBase(VirtualCardLink(card)) as alink:
+			acmd = AsyncSimCardCommands(alink)
+			acmd.sel_ctrl = "0004"
+			acmd.update_binary(['3f00', '6f99'], '0102')
+			self.assertEqual(acmd.read_binary(['3f00', '6f99'], 2).result(), ('0102', '9000'))
+			self.assertEqual(acmd.sel_ctrl, "0004")
+
+
+if __name__ == "__main__":
+	unittest.main()
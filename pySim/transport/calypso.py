@@ -28,9 +28,9 @@ import struct
 import socket
 import os
 
+from pySim.apdu import Apdu, Response
 from pySim.transport import LinkBase
 from pySim.exceptions import *
-from pySim.utils import h2b, b2h
 
 class L1CTLMessage(object):
 
@@ -123,9 +123,13 @@ class CalypsoSimLink(LinkBase):
 
 	def send_apdu_raw(self, pdu):
 		"""see LinkBase.send_apdu_raw"""
+		return tuple(self.transceive(Apdu.from_hex(pdu)))
+
+	def transceive(self, apdu):
+		"""see LinkBase.transceive"""
 
 		# Request FULL reset
-		req_msg = L1CTLMessageSIM(h2b(pdu))
+		req_msg = L1CTLMessageSIM(apdu.buf)
 		self.sock.send(req_msg.gen_msg())
 
 		# Read message length first
@@ -151,7 +155,4 @@ class CalypsoSimLink(LinkBase):
 		rsp = rsp[offset:]
 
 		# Unpack data and SW
-		data = rsp[:-2]
-		sw = rsp[-2:]
-
-		return b2h(data), b2h(sw)
+		return Response.from_bytes(rsp)
@@ -22,21 +22,34 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from smartcard.CardConnection import CardConnection
 from smartcard.CardRequest import CardRequest
 from smartcard.Exceptions import NoCardException, CardRequestTimeoutException
 from smartcard.System import readers
+from smartcard.scard import *
 
-from pySim.exceptions import NoCardError
+from pySim.apdu import Apdu, Response
+from pySim.exceptions import NoCardError, ReaderError
 from pySim.transport import LinkBase
-from pySim.utils import h2i, i2h
 
 
 class PcscSimLink(LinkBase):
-
-	def __init__(self, reader_number=0):
+	"""
+	A card in a PC/SC reader. The connection to the card stays open from
+	connect() to disconnect(): reset_card() resets the card through
+	SCardReconnect(), warm by default (the card keeps its power) or cold
+	with cold_reset. With exclusive, no other application can talk to the
+	card while we are connected. Within begin_transaction() and
+	end_transaction(), pcscd doesn't have to lock the card for every APDU.
+	"""
+
+	def __init__(self, reader_number=0, exclusive=False, cold_reset=False):
 		r = readers();
 		self._reader = r[reader_number]
 		self._con = self._reader.createConnection()
+		self._mode = SCARD_SHARE_EXCLUSIVE if exclusive else SCARD_SHARE_SHARED
+		self._reset = SCARD_UNPOWER_CARD if cold_reset else SCARD_RESET_CARD
+		self._transactions = 0
 
 	def __del__(self):
 		self._con.disconnect()
@@ -52,32 +65,78 @@ class PcscSimLink(LinkBase):
 
 	def connect(self):
 		try:
-			self._con.connect()
+			self._con.connect(mode=self._mode)
 		except NoCardException:
 			raise NoCardError()
+		self._transactions = 0
+
+	def _hcard(self):
+		# createConnection() wraps the PCSCCardConnection in a decorator
+		con = getattr(self._con, 'component', self._con)
+		return getattr(con, 'hcard', None)
+
+	def _check(self, hresult):
+		if hresult in (SCARD_E_NO_SMARTCARD, SCARD_W_REMOVED_CARD):
+			raise NoCardError()
+		if hresult != SCARD_S_SUCCESS:
+			raise ReaderError(SCardGetErrorMessage(hresult))
 
 	def get_atr(self):
 		return self._con.getATR()
 
+	@property
+	def ext_apdu(self):
+		# With T=0 the reader would have to split extended APDUs into
+		# ENVELOPEs, which not all of them do
+		return self._con.getProtocol() == CardConnection.T1_protocol
+
 	def disconnect(self):
+		self._transactions = 0
 		self._con.disconnect()
 
 	def reset_card(self):
-		self._con.disconnect()
-		try:
-			self._con.connect()
-		except NoCardException:
-			raise NoCardError()
+		hcard = self._hcard()
+		if hcard is None:
+			self.connect()
+			return 1
+		# A reset ends the transaction, take it again afterwards. If any of
+		# this fails (e.g. the card is gone), we are in no transaction and
+		# the end_transaction() calls still to come do nothing.
+		depth, self._transactions = self._transactions, 0
+		if depth:
+			self._check(SCardEndTransaction(hcard, SCARD_LEAVE_CARD))
+		hresult, protocol = SCardReconnect(hcard, self._mode,
+			SCARD_PROTOCOL_T0 | SCARD_PROTOCOL_T1, self._reset)
+		self._check(hresult)
+		# pyscard uses the PC/SC values for the protocols
+		self._con.setProtocol(protocol)
+		if depth:
+			self._check(SCardBeginTransaction(hcard))
+			self._transactions = depth
 		return 1
 
+	def begin_transaction(self):
+		"""see LinkBase.begin_transaction"""
+		if self._transactions == 0:
+			self._check(SCardBeginTransaction(self._hcard()))
+		self._transactions += 1
+
+	def end_transaction(self):
+		"""see LinkBase.end_transaction"""
+		if self._transactions == 0:
+			return
+		self._transactions -= 1
+		if self._transactions == 0:
+			self._check(SCardEndTransaction(self._hcard(), SCARD_LEAVE_CARD))
+
 	def send_apdu_raw(self, pdu):
 		"""see LinkBase.send_apdu_raw"""
+		return tuple(self.transceive(Apdu.from_hex(pdu)))
 
-		apdu = h2i(pdu)
-
-		data, sw1, sw2 = self._con.transmit(apdu)
+	def transceive(self, apdu):
+		"""see LinkBase.transceive"""
 
-		sw = [sw1, sw2]
+		# pyscard wants a list of ints
+		data, sw1, sw2 = self._con.transmit(list(bytearray(apdu.buf)))
 
-		# Return value
-		return i2h(data), i2h(sw)
+		return Response(bytearray(data), sw1, sw2)
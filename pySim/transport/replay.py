@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Transport link replaying recorded APDUs, no card needed
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import re
+import time
+
+from pySim.apdu import Apdu, Response
+from pySim.exceptions import ProtocolError
+from pySim.trace import MAGIC, read_trace, write_trace
+from pySim.transport import LinkBase
+
+
+class LatencyModel(object):
+	"""
+	Time it takes to exchange an APDU with a card: a fixed overhead per
+	exchange (reader, driver, USB), the bytes on the wire at the character
+	rate of the link, and the card processing the command, which mostly
+	depends on whether it writes to its EEPROM.
+	"""
+
+	def __init__(self, overhead, char_time, processing=None, default_processing=0.002):
+		self.overhead = overhead
+		self.char_time = char_time
+		self.processing = processing or {}
+		self.default_processing = default_processing
+
+	def delay(self, apdu, rsp):
+		# Header and data sent, response data and SW received
+		chars = len(apdu.buf) + len(rsp.data) + 2
+		return (self.overhead + chars * self.char_time +
+			self.processing.get(apdu.ins, self.default_processing))
+
+
+# Rough card processing times by INS, in seconds
+CARD_PROCESSING = {
+	0x20: 0.010,	# VERIFY
+	0x88: 0.050,	# RUN GSM ALGORITHM
+	0xa4: 0.003,	# SELECT
+	0xb0: 0.002,	# READ BINARY
+	0xb2: 0.002,	# READ RECORD
+	0xd6: 0.010,	# UPDATE BINARY
+	0xdc: 0.010,	# UPDATE RECORD
+	0xe0: 0.020,	# CREATE FILE
+}
+
+LATENCY_MODELS = {
+	'none': None,
+	# Durations as recorded in a binary trace
+	'recorded': 'recorded',
+	# SerialSimLink: T=0 at 9600 baud, 12 ETU per character, plus the
+	# procedure byte and the latency of the USB serial adapter
+	'serial': LatencyModel(0.005, 12.0 / 9600, CARD_PROCESSING),
+	# PC/SC: T=1 after PPS to Fi/Di 512/32 at 4 MHz (250 kbit/s), plus a
+	# USB CCID round trip
+	'pcsc': LatencyModel(0.001, 11.0 / 250000, CARD_PROCESSING),
+	# Calypso: the phone talks to the SIM at 9600 baud, osmocon and L1CTL
+	# add their round trip
+	'calypso': LatencyModel(0.020, 12.0 / 9600, CARD_PROCESSING),
+}
+
+
+def parse_log(lines):
+	"""
+	Get (duration, Apdu, Response) from the output of the scripts, i.e.
+	the APDUs they print as LinkBase.apdu_to_string() formats them. The
+	duration isn't known and is None.
+	"""
+	records = []
+	fields = {}
+	sw = None
+	for line in lines:
+		line = line.strip()
+		if line == 'APDU SENT:':
+			fields = {}
+			sw = None
+			continue
+		m = re.match(r'^(CLA|INS|p1|p2|length|data):\s*([0-9a-fA-F]*)$', line)
+		if m:
+			fields[m.group(1)] = m.group(2)
+			continue
+		m = re.match(r'^APDU Response code:\s*([0-9a-fA-F]{4})', line)
+		if m:
+			sw = m.group(1)
+			line = line[m.end():]
+		m = re.match(r'^APDU Response data\s*:\s*([0-9a-fA-F]*)$', line)
+		if m and sw is not None and 'CLA' in fields:
+			pdu = ''.join(fields.get(k, '') for k in ('CLA', 'INS', 'p1', 'p2', 'length', 'data'))
+			records.append((None, Apdu.from_hex(pdu), Response.from_hex(m.group(1), sw)))
+			fields = {}
+			sw = None
+	return records
+
+
+def load_records(filename):
+	"""Get (duration, Apdu, Response) from a binary trace (see
+	pySim.trace) or from the printed output of the scripts"""
+	with open(filename, 'rb') as f:
+		binary = f.read(len(MAGIC)) == MAGIC
+	if binary:
+		return [(duration, apdu, rsp) for t, duration, apdu, rsp in read_trace(filename)]
+	with open(filename, 'r') as f:
+		return parse_log(f)
+
+
+class ReplaySimLink(LinkBase):
+	"""
+	Answers APDUs with the responses recorded for them. If the same APDU
+	was recorded several times, its responses are given in the recorded
+	order, the last one is repeated once they run out. APDUs not found in
+	the recording are answered with 6a82 (SELECT) or 6d00, or raise a
+	ProtocolError if strict is set.
+
+	latency is a LatencyModel or the name of one in LATENCY_MODELS. The
+	modelled time of all APDUs adds up in elapsed, and is spent sleeping
+	as well, unless sleep is False.
+	"""
+
+	def __init__(self, records, latency=None, atr=None, strict=False, sleep=True):
+		if isinstance(records, str):
+			records = load_records(records)
+		if isinstance(latency, str):
+			latency = LATENCY_MODELS[latency]
+		self.latency = latency
+		self.atr = atr
+		self.strict = strict
+		self.sleep = sleep
+		self.elapsed = 0.0
+		self.misses = 0
+		self._responses = {}
+		self._next = {}
+		for duration, apdu, rsp in records:
+			self._responses.setdefault(apdu.buf, []).append((duration, rsp))
+
+	def wait_for_card(self, timeout=None, newcardonly=False):
+		pass
+
+	def connect(self):
+		pass
+
+	def disconnect(self):
+		pass
+
+	def reset_card(self):
+		return 1
+
+	def get_atr(self):
+		return self.atr
+
+	def send_apdu_raw(self, pdu):
+		"""see LinkBase.send_apdu_raw"""
+		return tuple(self.transceive(Apdu.from_hex(pdu)))
+
+	def transceive(self, apdu):
+		"""see LinkBase.transceive"""
+		responses = self._responses.get(apdu.buf)
+		if responses:
+			i = self._next.get(apdu.buf, 0)
+			duration, rsp = responses[min(i, len(responses) - 1)]
+			self._next[apdu.buf] = i + 1
+		else:
+			self.misses += 1
+			if self.strict:
+				raise ProtocolError("APDU %s was not recorded" % apdu.hex())
+			duration = None
+			rsp = Response(b'', 0x6a, 0x82) if apdu.ins == 0xa4 else Response(b'', 0x6d, 0x00)
+
+		if self.latency == 'recorded':
+			delay = duration or 0.0
+		elif self.latency is not None:
+			delay = self.latency.delay(apdu, rsp)
+		else:
+			delay = 0.0
+		self.elapsed += delay
+		if self.sleep and delay:
+			time.sleep(delay)
+		return rsp
+
+
+class RecordingLink(LinkBase):
+	"""
+	Passes everything on to link, and keeps the APDUs exchanged along with
+	the responses in records, ready for ReplaySimLink or save()
+	"""
+
+	def __init__(self, link):
+		self.link = link
+		self.records = []
+
+	@property
+	def ext_apdu(self):
+		return self.link.ext_apdu
+
+	def wait_for_card(self, timeout=None, newcardonly=False):
+		return self.link.wait_for_card(timeout, newcardonly)
+
+	def connect(self):
+		return self.link.connect()
+
+	def disconnect(self):
+		return self.link.disconnect()
+
+	def reset_card(self):
+		return self.link.reset_card()
+
+	def get_atr(self):
+		return self.link.get_atr()
+
+	def begin_transaction(self):
+		return self.link.begin_transaction()
+
+	def end_transaction(self):
+		return self.link.end_transaction()
+
+	def send_apdu_raw(self, pdu):
+		"""see LinkBase.send_apdu_raw"""
+		return tuple(self.transceive(Apdu.from_hex(pdu)))
+
+	def transceive(self, apdu):
+		"""see LinkBase.transceive"""
+		t = time.time()
+		rsp = self.link.transceive(apdu)
+		self.records.append((t, time.time() - t, apdu, rsp))
+		return rsp
+
+	def replay_records(self):
+		"""The records in the form ReplaySimLink takes them"""
+		return [(duration, apdu, rsp) for t, duration, apdu, rsp in self.records]
+
+	def save(self, filename):
+		"""Write the records to a binary trace, see pySim.trace"""
+		write_trace(filename, self.records)
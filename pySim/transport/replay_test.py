@@ -0,0 +1,110 @@
+#!/usr/bin/pyton
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pySim.apdu import Apdu, Response
+from pySim.commands import SimCardCommands
+from pySim.commands_test import FakeSimLink
+from pySim.exceptions import ProtocolError
+from pySim.transport.replay import *
+
+LOG = """Reading ...
+APDU SENT:
+CLA: 00
+INS: a4
+p1: 00
+p2: 04
+length: 02
+data: 3F00
+APDU Response code: 9000
+APDU Response data : 622d8202782183023f00
+('622d8202782183023f00', '9000')
+APDU SENT:
+CLA: 00
+INS: b2
+p1: 01
+p2: 04
+length: 26
+data: 
+APDU Response code: 6a83APDU Response data : 
+============================
+"""
+
+class ReplayTestCase(unittest.TestCase):
+
+	def testParseLog(self):
+		records = parse_log(LOG.splitlines())
+		self.assertEqual([(d, a.hex(), tuple(r)) for d, a, r in records], [
+			(None, '00a40004023f00', ('622d8202782183023f00', '9000')),
+			(None, '00b2010426', ('', '6a83')),
+		])
+
+	def testReplay(self):
+		sl = ReplaySimLink(parse_log(LOG.splitlines()))
+		self.assertEqual(sl.send_apdu('00a40004023F00'), ('622d8202782183023f00', '9000'))
+		self.assertEqual(sl.send_apdu('00b2010426'), ('', '6a83'))
+		self.assertEqual(sl.send_apdu('00a40004022fe2'), ('', '6a82'))
+		self.assertEqual(sl.send_apdu('00b0000001'), ('', '6d00'))
+		self.assertEqual(sl.misses, 2)
+
+	def testStrict(self):
+		sl = ReplaySimLink([], strict=True)
+		self.assertRaises(ProtocolError, sl.send_apdu, '00b0000001')
+
+	def testResponsesInOrder(self):
+		apdu = Apdu.from_hex('00b0000001')
+		sl = ReplaySimLink([(None, apdu, Response(b'\x01', 0x90, 0)), (None, apdu, Response(b'\x02', 0x90, 0))])
+		self.assertEqual([sl.send_apdu('00b0000001')[0] for i in range(3)], ['01', '02', '02'])
+
+	def testLatency(self):
+		sl = ReplaySimLink(parse_log(LOG.splitlines()), latency='serial', sleep=False)
+		sl.send_apdu('00a40004023f00')
+		# 7 bytes sent, 10 + 2 received at 1.25 ms each, 5 ms overhead, 3 ms SELECT
+		self.assertAlmostEqual(sl.elapsed, 0.005 + 19 * 0.00125 + 0.003)
+		sl = ReplaySimLink([(0.5, Apdu.from_hex('00b0000001'), Response(b'', 0x90, 0))],
+			latency='recorded', sleep=False)
+		sl.send_apdu('00b0000001')
+		self.assertEqual(sl.elapsed, 0.5)
+
+
+class RecordTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def read(self, link):
+		scc = SimCardCommands(link)
+		scc.cla_byte = 'a0'
+		return [scc.read_binary(['3f00', '7f20', '6f07']), scc.read_record(['3f00', '7f10', '6f42'], 1)]
+
+	def testRecordAndReplay(self):
+		rl = RecordingLink(FakeSimLink())
+		recorded = self.read(rl)
+		self.assertEqual(len(rl.records), 8)
+		self.assertEqual(self.read(ReplaySimLink(rl.replay_records(), strict=True)), recorded)
+		filename = os.path.join(self.dir, 'apdu.trace')
+		rl.save(filename)
+		self.assertEqual(self.read(ReplaySimLink(filename, strict=True)), recorded)
+
+	def testTransaction(self):
+		calls = []
+		link = FakeSimLink()
+		link.begin_transaction = lambda: calls.append('begin')
+		link.end_transaction = lambda: calls.append('end')
+		scc = SimCardCommands(RecordingLink(link))
+		try:
+			with scc.transaction():
+				calls.append('read')
+				raise ProtocolError('card gone')
+		except ProtocolError:
+			pass
+		self.assertEqual(calls, ['begin', 'read', 'end'])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -23,17 +23,157 @@
 
 from __future__ import absolute_import
 
+import errno
 import serial
 import time
 
+try:
+	import fcntl
+	import termios
+except ImportError:
+	fcntl = termios = None
+
+from pySim.apdu import Apdu, Response
+from pySim.atr import Atr, FI, DI
 from pySim.exceptions import NoCardError, ProtocolError
 from pySim.transport import LinkBase
-from pySim.utils import h2b, b2h
+from pySim.utils import b2h
+
+# NULL procedure byte: the card needs more time (ISO 7816-3, chapter
+# 10.3.3)
+T0_NULL = 0x60
+
+# Time RST is held low, ISO 7816-3 asks for at least 400 clock cycles
+RESET_HOLD = 0.01
+
+# Added to the waiting times of ISO 7816-3 for the serial adapter (USB
+# round trip, latency timer), on every read
+LATENCY = 0.05
+
+# Least time the first byte of the ATR is waited for, whatever the clock
+ATR_TIMEOUT = 1.0
+
+# How often a presence line is looked at where it can't be waited on, or
+# a reset is tried without one
+PRESENCE_POLL = 0.02
+RESET_POLL = 0.1
+
+# Modem lines that may tell whether a card is in the reader
+PRESENCE_LINES = {
+	'cd': 'getCD',
+	'dsr': 'getDSR',
+	'cts': 'getCTS',
+	'ri': 'getRI',
+}
+
+
+class T0Receiver(object):
+	"""
+	Takes apart what a card sends after the header of a T=0 command:
+	procedure bytes, response data and SW1 SW2 (ISO 7816-3, chapter
+	10.3.3). It is fed the bytes in blocks of any size, as they come in.
+
+	rx_len is the number of data bytes expected from the card, tx_len the
+	number of command data bytes still to go to the card. When the card
+	asks for them, tx_request tells how many and feeding stops until
+	sent() was called.
+	"""
+
+	def __init__(self, ins, rx_len=0, tx_len=0):
+		self.ins = ins
+		self.rx_left = rx_len
+		self.tx_left = tx_len
+		self.tx_request = 0
+		self.data = bytearray()
+		self.sw = bytearray()
+		self._xfer = 0	# data bytes the last procedure byte announced
+
+	@property
+	def done(self):
+		return len(self.sw) == 2
+
+	def wanted(self):
+		"""The number of bytes the card is still going to send for sure"""
+		if self.sw:
+			return 2 - len(self.sw)
+		if self._xfer:
+			# Rest of the data, followed by at least SW1 SW2
+			return self.rx_left + 2
+		if self.tx_left:
+			# An ACK and then the card waits for the data
+			return 1
+		return 2
+
+	def feed(self, buf):
+		"""Take the bytes of buf (a memoryview, or anything to make one
+		of) as far as they are part of the response. Returns the number
+		of bytes taken."""
+		if not isinstance(buf, memoryview):
+			buf = memoryview(buf)
+		i, n = 0, len(buf)
+		while i < n and not self.done and not self.tx_request:
+			if self._xfer:
+				chunk = buf[i:i + self._xfer].tobytes()
+				self.data += chunk
+				self._xfer -= len(chunk)
+				self.rx_left -= len(chunk)
+				i += len(chunk)
+				continue
+			b = buf[i]
+			if not isinstance(b, int):
+				# Python 2 memoryviews index to strings
+				b = ord(b)
+			i += 1
+			if self.sw:
+				self.sw.append(b)
+			elif b == T0_NULL:
+				continue
+			elif b == self.ins:
+				# ACK: all of the remaining data
+				if self.tx_left:
+					self.tx_request = self.tx_left
+				else:
+					self._xfer = self.rx_left
+			elif b == self.ins ^ 0xff:
+				# ACK for the next data byte only
+				if self.tx_left:
+					self.tx_request = 1
+				else:
+					self._xfer = min(1, self.rx_left)
+			elif b & 0xf0 in (0x60, 0x90):
+				self.sw.append(b)
+			else:
+				raise ProtocolError("Unexpected procedure byte %02x" % b)
+		return i
 
+	def sent(self, n):
+		"""n bytes of the command data went out to the card"""
+		self.tx_left -= n
+		self.tx_request = 0
+
+
+def pps_request(t, fi, di):
+	"""The PPS request (ISO 7816-3, chapter 9.2) for protocol T=t and the
+	codes of Fi and Di, as bytes"""
+	req = bytearray([0xff, 0x10 | t, fi << 4 | di])
+	req.append(req[0] ^ req[1] ^ req[2])
+	return bytes(req)
 
-class SerialSimLink(LinkBase):
 
-	def __init__(self, device='/dev/ttyUSB0', baudrate=9600, rst='-rts', debug=False):
+class SerialSimLink(LinkBase):
+	"""
+	A card in a serial reader with TX and RX tied. baudrate is the rate
+	the card talks at after reset, i.e. at the default Fd/Dd. With pps,
+	the fastest rate the card offers in its ATR (Fi, lower Di as needed)
+	that is not above max_baudrate is negotiated after each reset.
+
+	presence names the modem line the card switch of the reader is on, if
+	any ('cd', 'dsr', 'cts' or 'ri', with a leading '-' if it is low with
+	a card in). wait_for_card() then waits for it instead of trying resets.
+	"""
+
+	def __init__(self, device='/dev/ttyUSB0', baudrate=9600, rst='-rts', debug=False,
+			pps=True, max_baudrate=115200, presence=None):
 		self._sl = serial.Serial(
 				port = device,
 				parity = serial.PARITY_EVEN,
@@ -47,15 +187,28 @@ class SerialSimLink(LinkBase):
 		self._rst_pin = rst
 		self._debug = debug
 		self._atr = None
+		self._baudrate = baudrate
+		self._pps = pps
+		self._max_baudrate = max_baudrate
+		# ATRs of the cards which offered a faster rate but then failed
+		# the PPS, they are left at the default rate
+		self._pps_failed = set()
+		self._presence = presence
+		if presence is not None and presence.lstrip('-') not in PRESENCE_LINES:
+			raise ValueError('Invalid presence line %s' % presence)
+		self._fi = 1
+		self._guard = 0.0
 
 	def __del__(self):
 		self._sl.close()
 
 	def wait_for_card(self, timeout=None, newcardonly=False):
-		# Direct try
+		# Direct try, unless the presence line says there is no card
 		existing = False
 
 		try:
+			if self._card_present() is False:
+				raise NoCardError()
 			self.reset_card()
 			if not newcardonly:
 				return
@@ -70,7 +223,9 @@ class SerialSimLink(LinkBase):
 
 		while (mt is None) or (time.time() < mt):
 			try:
-				time.sleep(0.5)
+				if not self._wait_presence(existing, mt):
+					existing = False
+					continue
 				self.reset_card()
 				if not existing:
 					return
@@ -89,6 +244,45 @@ class SerialSimLink(LinkBase):
 		# Timed out ...
 		raise NoCardError()
 
+	def _card_present(self):
+		"""Whether the presence line shows a card, None without one"""
+		if self._presence is None:
+			return None
+		level = getattr(self._sl, PRESENCE_LINES[self._presence.lstrip('-')])()
+		return bool(level) != self._presence.startswith('-')
+
+	def _wait_line(self, mt):
+		"""Wait for the presence line to change, or until mt"""
+		line = self._presence.lstrip('-')
+		mask = getattr(termios, 'TIOCM_' + line.upper(), None) if termios else None
+		if mt is None and mask is not None and hasattr(termios, 'TIOCMIWAIT'):
+			# Linux: sleep in the kernel until the line changes
+			while True:
+				try:
+					fcntl.ioctl(self._sl.fileno(), termios.TIOCMIWAIT, mask)
+					return
+				except (IOError, OSError) as e:
+					if e.errno != errno.EINTR:
+						break
+				except AttributeError:
+					break
+		present = self._card_present()
+		while self._card_present() == present and (mt is None or time.time() < mt):
+			time.sleep(PRESENCE_POLL)
+
+	def _wait_presence(self, existing, mt):
+		"""Wait until a reset is worth trying: a card came in if there is a
+		presence line, otherwise a little while. Returns False if the card
+		that was there went away."""
+		present = self._card_present()
+		if present is None:
+			time.sleep(RESET_POLL)
+			return True
+		if present and not existing:
+			return True
+		self._wait_line(mt)
+		return bool(self._card_present()) and not existing
+
 	def connect(self):
 		self.reset_card()
 
@@ -104,9 +298,100 @@ class SerialSimLink(LinkBase):
 			raise NoCardError()
 		elif rv < 0:
 			raise ProtocolError()
+		if self._pps and tuple(self._atr) not in self._pps_failed and not self._negotiate():
+			# The card wants a reset after a failed PPS, and then stays
+			# at the default rate, also on later resets
+			self._dbg_print("PPS failed, staying at %d baud" % self._baudrate)
+			self._pps_failed.add(tuple(self._atr))
+			rv = self._reset_card()
+			if rv == 0:
+				raise NoCardError()
+			elif rv < 0:
+				raise ProtocolError()
+
+	def _rate(self, fi, di):
+		# The card clock is what gives baudrate at Fd = 372, Dd = 1
+		return int(round(self._baudrate * 372.0 * DI[di] / FI[fi]))
+
+	def _pps_params(self, atr):
+		"""The codes of Fi and Di to ask the card for, None to not do PPS"""
+		fi, di = atr.fi_di()
+		if fi not in FI or di not in DI or atr.specific_mode():
+			return None
+		# Fi as offered, the largest Di up to the offered one which the
+		# UART can do
+		for d in sorted(DI, key=lambda d: DI[d], reverse=True):
+			if DI[d] > DI[di] or self._rate(fi, d) > self._max_baudrate:
+				continue
+			if self._rate(fi, d) <= self._baudrate:
+				return None
+			return fi, d
+		return None
+
+	def _negotiate(self):
+		"""Do the PPS exchange right after the ATR and switch to the new
+		rate. Returns False if the card has to be reset."""
+		try:
+			atr = Atr(self._atr)
+		except ValueError:
+			return True
+		params = self._pps_params(atr)
+		if params is None:
+			return True
+
+		req = pps_request(atr.protocol(), *params)
+		self._tx_string(req)
+		req = bytearray(req)
+
+		# PPSS, PPS0, then PPS1..3 as PPS0 tells, and PCK
+		rsp = bytearray(self._sl.read(2))
+		if len(rsp) < 2 or rsp[0] != 0xff or rsp[1] & 0x0f != req[1] & 0x0f:
+			return False
+		n = bin(rsp[1] & 0x70).count('1') + 1
+		rsp += bytearray(self._sl.read(n))
+		pck = 0
+		for b in rsp:
+			pck ^= b
+		if len(rsp) < 2 + n or pck:
+			return False
+		if not rsp[1] & 0x10:
+			# The card stays at Fd/Dd (ISO 7816-3, chapter 9.3)
+			return True
+		if rsp[2] != req[2]:
+			return False
+
+		baudrate = self._rate(*params)
+		try:
+			self._sl.baudrate = baudrate
+		except (ValueError, serial.SerialException):
+			return False
+		self._fi = params[0]
+		self._set_timing(atr)
+		self._dbg_print("PPS: %d baud" % baudrate)
+		return True
+
+	def _set_timing(self, atr):
+		"""
+		Timeouts and guard time as the interface bytes of the ATR ask for,
+		see ISO 7816-3, chapters 8.3 and 10.2. Reads wait the work waiting
+		time 960 * WI * Fi / f (WI from TC2, 10 by default) longer than the
+		bytes take to come at the current rate, bytes sent are apart by the
+		extra guard time of TC1.
+		"""
+		etu = 1.0 / self._sl.baudrate
+		clock = self._baudrate * 372.0
+		wi = atr.interface.get('TC2') or 10 if atr is not None else 10
+		self._wwt = 960.0 * wi * FI[self._fi] / clock
+		# Largest block read: 256 bytes, procedure byte and SW, 12 etu each
+		self._sl.timeout = self._wwt + 259 * 12 * etu + LATENCY
+		n = atr.interface.get('TC1', 0) if atr is not None else 0
+		self._guard = n * etu if 0 < n < 255 else 0.0
 
 	def _reset_card(self):
 		self._atr = None
+		# Back at the default rate after reset
+		if self._sl.baudrate != self._baudrate:
+			self._sl.baudrate = self._baudrate
 		rst_meth_map = {
 			'rts': self._sl.setRTS,
 			'dtr': self._sl.setDTR,
@@ -119,11 +404,16 @@ class SerialSimLink(LinkBase):
 		except:
 			raise ValueError('Invalid reset pin %s' % self._rst_pin);
 
+		self._fi = 1
+		self._guard = 0.0
 		rst_meth(rst_val)
-		time.sleep(0.1)  # 100 ms
+		time.sleep(RESET_HOLD)
 		self._sl.flushInput()
 		rst_meth(rst_val ^ 1)
 
+		# The ATR starts within 40000 clock cycles (ISO 7816-3, chapter
+		# 8.1), which is only some ms, so not less than ATR_TIMEOUT
+		self._sl.timeout = max(40000.0 / (self._baudrate * 372), ATR_TIMEOUT) + LATENCY
 		b = self._rx_byte()
 		if not b:
 			return 0
@@ -132,34 +422,55 @@ class SerialSimLink(LinkBase):
 		self._dbg_print("TS: 0x%x Direct convention" % ord(b))
 
 		while ord(b) == 0x3b:
-			b = self._rx_byte()
+			b = self._rx_atr(1)
 
 		if not b:
 			return -1
 		t0 = ord(b)
 		self._dbg_print("T0: 0x%x" % t0)
-		self._atr = [0x3b, ord(b)]
-
-		for i in range(4):
-			if t0 & (0x10 << i):
-				b = self._rx_byte()
-				self._atr.append(ord(b))
-				self._dbg_print("T%si = %x" % (chr(ord('A')+i), ord(b)))
-
-		for i in range(0, t0 & 0xf):
-			b = self._rx_byte()
-			self._atr.append(ord(b))
-			self._dbg_print("Historical = %x" % ord(b))
-
-		while True:
-			x = self._rx_byte()
-			if not x:
+		atr = bytearray([0x3b, t0])
+
+		# The interface bytes come in groups, each TDi tells which bytes
+		# the next group has (ISO 7816-3, chapter 8.2.3). TCK follows the
+		# historical bytes unless only T=0 is offered.
+		y, tck = t0 >> 4, 0
+		while y:
+			n = bin(y).count('1')
+			grp = bytearray(self._rx_atr(n))
+			if len(grp) < n:
+				return -1
+			atr += grp
+			if not y & 0x8:
 				break
-			self._atr.append(ord(x))
-			self._dbg_print("Extra: %x" % ord(x))
+			y = grp[-1] >> 4
+			if grp[-1] & 0x0f:
+				tck = 1
+
+		n = (t0 & 0x0f) + tck
+		rest = bytearray(self._rx_atr(n))
+		if len(rest) < n:
+			return -1
+		atr += rest
+
+		# Whatever else there is, without waiting for more
+		extra = self._sl.read(self._in_waiting())
+		if extra:
+			self._dbg_print("Extra: %s" % b2h(extra))
 
+		self._atr = list(atr)
+		self._dbg_print("ATR: %s" % b2h(atr))
+		try:
+			self._set_timing(Atr(self._atr))
+		except ValueError:
+			self._set_timing(None)
 		return 1
 
+	def _rx_atr(self, n):
+		"""Read n more bytes of the ATR, they come at most 9600 etu apart
+		(ISO 7816-3, chapter 8.2)"""
+		self._sl.timeout = n * 9600.0 / self._baudrate + LATENCY
+		return self._sl.read(n)
+
 	def _dbg_print(self, s):
 		if self._debug:
 			print (s)
@@ -173,7 +484,12 @@ class SerialSimLink(LinkBase):
 	def _tx_string(self, s):
 		"""This is only safe if it's guaranteed the card won't send any data
 		during the time of tx of the string !!!"""
-		self._sl.write(s)
+		if self._guard:
+			for i in range(len(s)):
+				self._sl.write(s[i:i + 1])
+				time.sleep(self._guard)
+		else:
+			self._sl.write(s)
 		r = self._sl.read(len(s))
 		if r != s:	# TX and RX are tied, so we must clear the echo
 			raise ProtocolError("Bad echo value (Expected: %s, got %s)" % (b2h(s), b2h(r)))
@@ -181,55 +497,57 @@ class SerialSimLink(LinkBase):
 	def _rx_byte(self):
 		return self._sl.read()
 
-	def send_apdu_raw(self, pdu):
-		"""see LinkBase.send_apdu_raw"""
+	def _in_waiting(self):
+		# pySerial 3 has in_waiting, older ones inWaiting()
+		n = getattr(self._sl, 'in_waiting', None)
+		if n is None:
+			n = self._sl.inWaiting()
+		return n
 
-		pdu = h2b(pdu)
-		data_len = ord(pdu[4])	# P3
+	def _rx_block(self, n):
+		"""Read at least n bytes (unless timing out) and whatever else
+		has arrived already"""
+		return self._sl.read(max(n, self._in_waiting()))
 
-		# Send first CLASS,INS,P1,P2,P3
-		self._tx_string(pdu[0:5])
+	def send_apdu_raw(self, pdu):
+		"""see LinkBase.send_apdu_raw"""
+		return tuple(self.transceive(Apdu.from_hex(pdu)))
 
-		# Wait ack which can be
-		#  - INS: Command acked -> go ahead
-		#  - 0x60: NULL, just wait some more
-		#  - SW1: The card can apparently proceed ...
-		while True:
-			b = self._rx_byte()
-			if b == pdu[1]:
-				break
-			elif b != '\x60':
-				# Ok, it 'could' be SW1
-				sw1 = b
-				sw2 = self._rx_byte()
-				nil = self._rx_byte()
-				if (sw2 and not nil):
-					return '', b2h(sw1+sw2)
+	def transceive(self, apdu):
+		"""see LinkBase.transceive"""
 
-				raise ProtocolError()
+		pdu = apdu.buf
+		case1 = len(pdu) == 4
+		if case1:
+			pdu += b'\x00'
+		ins, p3 = bytearray(pdu[1:5:3])
 
-		# Send data (if any)
-		if len(pdu) > 5:
-			self._tx_string(pdu[5:])
+		# Command data (case 3), or the number of bytes expected (case 2,
+		# P3 '00' means 256)
+		tx = pdu[5:]
+		rx = T0Receiver(ins, 0 if tx or case1 else p3 or 256, len(tx))
 
-		# Receive data (including SW !)
-		#  length = [P3 - tx_data (=len(pdu)-len(hdr)) + 2 (SW1/2) ]
-		to_recv = data_len - len(pdu) + 5 + 2
+		# Send first CLASS,INS,P1,P2,P3
+		self._tx_string(pdu[0:5])
 
-		data = ''
-		while (len(data) < to_recv):
-			b = self._rx_byte()
-			if (to_recv == 2) and (b == '\x60'): # Ignore NIL if we have no RX data (hack ?)
+		# Then take in what the card sends, as much at a time as there is
+		# or is due, and send the data once the card asks for it
+		sent = 0
+		buf = memoryview(b'')
+		while not rx.done:
+			if rx.tx_request:
+				n = rx.tx_request
+				self._tx_string(tx[sent:sent + n])
+				sent += n
+				rx.sent(n)
 				continue
-			if not b:
-				break;
-			data += b
-
-		# Split datafield from SW
-		if len(data) < 2:
-			return None, None
-		sw = data[-2:]
-		data = data[0:-2]
-
-		# Return value
-		return b2h(data), b2h(sw)
+			if not len(buf):
+				buf = memoryview(self._rx_block(rx.wanted()))
+				if not len(buf):
+					break
+			buf = buf[rx.feed(buf):]
+
+		if not rx.done:
+			# Timed out, there is no SW
+			return Response(b'', None, None)
+		return Response(rx.data, rx.sw[0], rx.sw[1])
@@ -0,0 +1,267 @@
+#!/usr/bin/pyton
+
+import errno
+import time
+import unittest
+
+from pySim.exceptions import ProtocolError
+from pySim.transport.serial import *
+from pySim.utils import h2b, b2h
+
+ATR = '3b9f96801fc78031a073be21136743200718000001a5'
+
+
+class FakeSerial(object):
+	"""
+	A serial port with TX and RX tied, as in the readers SerialSimLink is
+	for: everything written comes back as echo, followed by what the card
+	answers. answers has what the card sends after each write, in order.
+	"""
+
+	def __init__(self, answers=(), atr=ATR):
+		self.answers = [h2b(a) for a in answers]
+		self.atr = h2b(atr)
+		self.rx = b''
+		self.written = []
+		self.reads = 0
+		self.timeouts = []
+		self.baudrate = 9600
+		self.timeout = 1
+		self.cd = True
+
+	def close(self):
+		pass
+
+	def write(self, data):
+		self.written.append(b2h(data))
+		self.rx += data
+		if self.answers:
+			self.rx += self.answers.pop(0)
+
+	def read(self, n=1):
+		# Never blocks, fewer bytes than asked for is a timeout
+		self.reads += 1
+		self.timeouts.append(self.timeout)
+		data, self.rx = self.rx[:n], self.rx[n:]
+		return data
+
+	@property
+	def in_waiting(self):
+		return len(self.rx)
+
+	def flushInput(self):
+		self.rx = b''
+
+	def setRTS(self, level):
+		if not level and self.cd:
+			self.rx += self.atr
+
+	setDTR = setRTS
+
+	def getCD(self):
+		return self.cd
+
+
+def fake_link(sl, pps=False, presence=None):
+	link = SerialSimLink.__new__(SerialSimLink)
+	link._sl = sl
+	link._rst_pin = '-rts'
+	link._debug = False
+	link._atr = None
+	link._baudrate = 9600
+	link._pps = pps
+	link._max_baudrate = 115200
+	link._pps_failed = set()
+	link._presence = presence
+	link._fi = 1
+	link._guard = 0.0
+	return link
+
+
+class T0ReceiverTestCase(unittest.TestCase):
+
+	def testStatusOnly(self):
+		rx = T0Receiver(0xa4, 0, 2)
+		self.assertEqual(rx.feed(h2b('606a82ff')), 3)
+		self.assertTrue(rx.done)
+		self.assertEqual(b2h(rx.sw), '6a82')
+
+	def testData(self):
+		rx = T0Receiver(0xb0, 4)
+		self.assertEqual(rx.wanted(), 2)
+		rx.feed(memoryview(h2b('b00102')))
+		self.assertEqual(rx.wanted(), 4)
+		rx.feed(h2b('0304'))
+		rx.feed(h2b('90'))
+		self.assertFalse(rx.done)
+		rx.feed(h2b('00'))
+		self.assertEqual((b2h(rx.data), b2h(rx.sw)), ('01020304', '9000'))
+
+	def testSingleByteAck(self):
+		rx = T0Receiver(0xb0, 2)
+		rx.feed(h2b('4f01604f029000'))
+		self.assertEqual((b2h(rx.data), b2h(rx.sw)), ('0102', '9000'))
+
+	def testTxRequest(self):
+		rx = T0Receiver(0xd6, 0, 2)
+		self.assertEqual(rx.wanted(), 1)
+		self.assertEqual(rx.feed(h2b('29')), 1)
+		self.assertEqual(rx.tx_request, 1)
+		rx.sent(1)
+		self.assertEqual(rx.feed(h2b('d6')), 1)
+		self.assertEqual(rx.tx_request, 1)
+
+	def testBadProcedureByte(self):
+		rx = T0Receiver(0xb0, 2)
+		self.assertRaises(ProtocolError, rx.feed, h2b('12'))
+
+
+class SerialSimLinkTestCase(unittest.TestCase):
+
+	def testReset(self):
+		sl = FakeSerial()
+		link = fake_link(sl)
+		link.reset_card()
+		self.assertEqual(link.get_atr(), list(bytearray(h2b(ATR))))
+		# TS, T0, then one read per group of interface bytes and one for
+		# the rest
+		self.assertTrue(sl.reads <= 7)
+
+	def testPps(self):
+		# TA1 96: Fi 512, Di 32, i.e. 223200 baud, Di 16 is as fast as
+		# the UART goes
+		sl = FakeSerial(['ff10957a'])
+		link = fake_link(sl, pps=True)
+		link.reset_card()
+		self.assertEqual(sl.written, ['ff10957a'])
+		self.assertEqual(sl.baudrate, 111600)
+
+	def testPpsDefault(self):
+		# The card answers without PPS1, it stays at Fd/Dd
+		sl = FakeSerial(['ff00ff'])
+		link = fake_link(sl, pps=True)
+		link.reset_card()
+		self.assertEqual(sl.baudrate, 9600)
+
+	def testPpsFailed(self):
+		# No answer, the card gets reset and stays at the default rate
+		sl = FakeSerial()
+		link = fake_link(sl, pps=True)
+		link.reset_card()
+		self.assertEqual(sl.written, ['ff10957a'])
+		self.assertEqual(sl.baudrate, 9600)
+		self.assertEqual(link.get_atr(), list(bytearray(h2b(ATR))))
+		# Not tried again with the same card
+		link.reset_card()
+		self.assertEqual(sl.written, ['ff10957a'])
+		self.assertEqual(link.get_atr(), list(bytearray(h2b(ATR))))
+
+	def testNoPpsNeeded(self):
+		sl = FakeSerial(atr='3b00')
+		link = fake_link(sl, pps=True)
+		link.reset_card()
+		self.assertEqual(sl.written, [])
+
+	def testTiming(self):
+		sl = FakeSerial(['ff10957a'])
+		link = fake_link(sl, pps=True)
+		t = time.time()
+		link.reset_card()
+		self.assertTrue(time.time() - t < 0.1)
+		# WI 10, Fi 512 at 3.5712 MHz
+		self.assertAlmostEqual(link._wwt, 1.376, 3)
+		self.assertAlmostEqual(sl.timeout, 1.376 + 259 * 12 / 111600.0 + 0.05, 3)
+		self.assertEqual(link._guard, 0.0)
+
+	def testAtrTimeouts(self):
+		sl = FakeSerial()
+		link = fake_link(sl)
+		link.reset_card()
+		# Not just the 40000 clock cycles for the first byte, then 9600
+		# etu for each byte of a read and the latency on top
+		self.assertAlmostEqual(sl.timeouts[0], ATR_TIMEOUT + LATENCY)
+		self.assertAlmostEqual(sl.timeouts[1], 1.0 + LATENCY)
+		self.assertAlmostEqual(sl.timeouts[2], 2.0 + LATENCY)
+
+	def testGuardTime(self):
+		# TC1 = 2: two etu more between the bytes sent
+		sl = FakeSerial(atr='3b400200')
+		link = fake_link(sl)
+		link.reset_card()
+		self.assertAlmostEqual(link._guard, 2 / 9600.0)
+		self.assertAlmostEqual(link._wwt, 1.0)
+		link._tx_string(b'\x01\x02')
+		self.assertEqual(sl.written, ['01', '02'])
+
+	def testPresence(self):
+		sl = FakeSerial()
+		sl.cd = False
+		link = fake_link(sl, presence='cd')
+		self.assertEqual(link._card_present(), False)
+		self.assertRaises(NoCardError, link.wait_for_card, 0.1)
+		# No resets tried while the line says there is no card
+		self.assertEqual(sl.reads, 0)
+		sl.cd = True
+		link.wait_for_card(0.1)
+		self.assertEqual(link.get_atr(), list(bytearray(h2b(ATR))))
+		link._presence = '-cd'
+		self.assertEqual(link._card_present(), False)
+
+	def testWaitLineInterrupted(self):
+		import pySim.transport.serial as serial_mod
+		if not hasattr(serial_mod.termios, 'TIOCMIWAIT'):
+			self.skipTest('Linux only')
+		calls = []
+		class FakeFcntl(object):
+			@staticmethod
+			def ioctl(fd, req, arg):
+				calls.append(req)
+				if len(calls) == 1:
+					raise IOError(errno.EINTR, 'Interrupted system call')
+		sl = FakeSerial()
+		sl.fileno = lambda: 3
+		link = fake_link(sl, presence='cd')
+		fcntl, serial_mod.fcntl = serial_mod.fcntl, FakeFcntl
+		try:
+			link._wait_line(None)
+		finally:
+			serial_mod.fcntl = fcntl
+		self.assertEqual(len(calls), 2)
+
+	def testNoCard(self):
+		link = fake_link(FakeSerial(atr=''))
+		self.assertRaises(NoCardError, link.reset_card)
+
+	def testReadBinary(self):
+		sl = FakeSerial(['b0' + 'ab' * 256 + '9000'])
+		link = fake_link(sl)
+		self.assertEqual(link.send_apdu_raw('00b0000000'), ('ab' * 256, '9000'))
+		# Echo, then all of the response in one go
+		self.assertEqual(sl.reads, 2)
+
+	def testUpdateBinary(self):
+		sl = FakeSerial(['d6', '609000'])
+		link = fake_link(sl)
+		self.assertEqual(link.send_apdu_raw('00d60000020102'), ('', '9000'))
+		self.assertEqual(sl.written, ['00d6000002', '0102'])
+
+	def testUpdateByteByByte(self):
+		sl = FakeSerial(['29', '29', '9000'])
+		link = fake_link(sl)
+		self.assertEqual(link.send_apdu_raw('00d60000020102'), ('', '9000'))
+		self.assertEqual(sl.written, ['00d6000002', '01', '02'])
+
+	def testStatusWithoutAck(self):
+		sl = FakeSerial(['6a82'])
+		link = fake_link(sl)
+		self.assertEqual(link.send_apdu_raw('00a40004022fe2'), ('', '6a82'))
+		self.assertEqual(sl.written, ['00a4000402'])
+
+	def testTimeout(self):
+		sl = FakeSerial(['b00102'])
+		link = fake_link(sl)
+		self.assertEqual(link.send_apdu_raw('00b0000004'), (None, None))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Transport link to a UICC simulated in memory
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+
+from pySim.apdu import Apdu, Response
+from pySim.fcp import decode_fcp
+from pySim.profiles import iter_profile
+from pySim.transport import LinkBase
+from pySim.utils import h2b, b2h, rpad
+
+# SELECT responses of the DFs a profile goes to, the same JCSIM-write.py
+# creates them with
+FCP_MF = '62108202782183023f008a01058b032f0601'
+FCP_DF = {
+	'7f20': '62308202782183027f20a51683027fffcb0d00000000000000000000000000ca01828a01058b032f0601c606900100830101',
+	'7f10': '62308202782183027f10a51683027fffcb0d00000000000000000000000000ca01828a01058b032f0601c606900100830101',
+}
+AID_USIM = 'a0000000871002ffffffff8907090000'
+FCP_ADF_USIM = ('62578202782183027fff8410' + AID_USIM + 'a51683027fffcb0d00000000000000000000000000'
+		'ca01808a0105ab15800101a40683010a95010880014097008001069000c609900140830101830181')
+
+# Where the DFs of a profile (see pySim.profiles.DFS) are
+PROFILE_DFS = (('mf', ('3f00',)), ('gsm', ('3f00', '7f20')), ('telecom', ('3f00', '7f10')),
+	('adf', ('7fff',)))
+
+# ATR of the simulated card, T=0 only
+ATR = [0x3b, 0x9f, 0x96, 0x80, 0x1f, 0xc7, 0x80, 0x31, 0xa0, 0x73, 0xbe, 0x21, 0x13, 0x67,
+	0x43, 0x20, 0x07, 0x18, 0x00, 0x00, 0x01, 0xa5]
+
+
+def _sw(sw):
+	return Response(b'', sw >> 8, sw & 0xff)
+
+
+class VirtualFile(object):
+	"""A DF or EF of a VirtualCard, its layout is taken from its FCP"""
+
+	__slots__ = ('fid', 'fcp', 'type', 'aid', 'parent', 'children', 'data', 'rec_len')
+
+	def __init__(self, fid, fcp, parent=None):
+		self.fid = fid.lower()
+		self.fcp = fcp.lower()
+		self.parent = parent
+		self.children = OrderedDict()
+		self.aid = None
+		self.data = None	# bytearray, or list of bytearray for records
+		self.rec_len = None
+		parsed = decode_fcp(fcp)
+		if parsed is None or '82' not in parsed:
+			raise ValueError('No file descriptor in FCP %s' % fcp)
+		fd = int(parsed['82'][0:2], 16)
+		if fd & 0x38 == 0x38:
+			self.type = 'df'
+			self.aid = parsed.get('84')
+			return
+		self.type = {1: 'transparent', 2: 'linear', 6: 'cyclic'}.get(fd & 0x07)
+		if self.type is None:
+			raise ValueError('Unsupported file descriptor in FCP %s' % fcp)
+		size = int(parsed.get('80', parsed.get('81', '0')), 16)
+		if self.type == 'transparent':
+			self.data = bytearray(b'\xff' * size)
+		else:
+			self.rec_len = int(parsed['82'][4:8], 16)
+			count = int(parsed['82'][8:10], 16) if len(parsed['82']) >= 10 else size // self.rec_len
+			self.data = [bytearray(b'\xff' * self.rec_len) for i in range(count)]
+
+	def is_df(self):
+		return self.type == 'df'
+
+	def add(self, f):
+		f.parent = self
+		self.children[f.fid] = f
+		return f
+
+	def copy(self, parent=None):
+		f = VirtualFile.__new__(VirtualFile)
+		f.fid, f.fcp, f.type, f.aid, f.rec_len = self.fid, self.fcp, self.type, self.aid, self.rec_len
+		f.parent = parent
+		if self.data is None:
+			f.data = None
+		elif self.type == 'transparent':
+			f.data = bytearray(self.data)
+		else:
+			f.data = [bytearray(rec) for rec in self.data]
+		f.children = OrderedDict((fid, child.copy(f)) for fid, child in self.children.items())
+		return f
+
+	def size(self):
+		if self.type == 'transparent':
+			return len(self.data)
+		if self.data is not None:
+			return len(self.data) * self.rec_len
+		return 0
+
+	# SELECT response as described in GSM 11.11, chapter 9.2.1
+	def gsm_response(self):
+		if self.is_df():
+			ftype = '01' if self.fid == '3f00' else '02'
+			return '0000ffff' + self.fid + ftype + '0000000000' + '09' + '13' + '00' * 8
+		structure = {'transparent': '00', 'linear': '01', 'cyclic': '03'}[self.type]
+		return ('0000%04x' % self.size() + self.fid + '04' + '00' + 'ffffff' + '01' + '02' +
+			structure + '%02x' % (self.rec_len or 0))
+
+
+class VirtualCard(object):
+	"""
+	The file system and PIN state of a simulated UICC. mf is the MF, adfs
+	are the ADFs, which are found by their AID (SELECT by DF name) or as
+	7fff once selected.
+	"""
+
+	def __init__(self, mf=None, adfs=None, pins=None):
+		self.mf = mf or VirtualFile('3f00', FCP_MF)
+		self.adfs = adfs or []
+		# CHV number to PIN, e.g. 0x0a for ADM1
+		self.pins = pins if pins is not None else {0x01: '1234', 0x0a: '12345678'}
+		self.tries = dict((chv, 3) for chv in self.pins)
+
+	@classmethod
+	def from_profile(cls, folder, pins=None):
+		"""Build a card with the EFs of a profile as saved by the read scripts"""
+		card = cls(pins=pins)
+		adf = VirtualFile('7fff', FCP_ADF_USIM)
+		card.adfs.append(adf)
+		for df, path in PROFILE_DFS:
+			parent = card.mf if path[0] == '3f00' else adf
+			for fid in path[1:]:
+				if fid not in parent.children:
+					parent.add(VirtualFile(fid, FCP_DF[fid]))
+				parent = parent.children[fid]
+			for ef in iter_profile(folder, df):
+				f = card.create(parent, ef.fci)
+				if f is None or ef.data is None or f.type != ef.tp:
+					continue
+				if f.type == 'transparent':
+					data = h2b(ef.data)
+					f.data[0:len(data)] = data
+				else:
+					for i, rec in enumerate(ef.data[:len(f.data)]):
+						rec = h2b(rec)
+						f.data[i][0:len(rec)] = rec
+		return card
+
+	def create(self, parent, fcp):
+		"""Create a file from its FCP below parent, None if there already
+		is one with its FID"""
+		fid = decode_fcp(fcp).get('83')
+		if fid is None or fid.lower() in parent.children:
+			return None
+		return parent.add(VirtualFile(fid, fcp))
+
+	def copy(self):
+		"""A fresh card with the same files and PINs"""
+		mf = self.mf.copy()
+		return VirtualCard(mf, [adf.copy() for adf in self.adfs], dict(self.pins))
+
+
+class VirtualCardLink(LinkBase):
+	"""
+	Talks to a VirtualCard. It knows SELECT (by FID, DF name or path),
+	READ/UPDATE BINARY, READ/UPDATE RECORD, VERIFY, CREATE FILE and GET
+	RESPONSE, for both CLA a0 (GSM 11.11 SELECT responses) and 00 (FCP
+	templates). Like a T=0 card, responses to SELECT have to be fetched by
+	GET RESPONSE. Access conditions are not checked.
+	"""
+
+	def __init__(self, card=None):
+		self.card = card or VirtualCard()
+		self.apdu_count = 0
+		self.reset_card()
+
+	def wait_for_card(self, timeout=None, newcardonly=False):
+		pass
+
+	def connect(self):
+		pass
+
+	def disconnect(self):
+		pass
+
+	def reset_card(self):
+		self._df = self.card.mf
+		self._ef = None
+		self._adf = None
+		self._rec = None
+		self._pending = None
+		self._verified = set()
+		return 1
+
+	def get_atr(self):
+		return ATR
+
+	def send_apdu_raw(self, pdu):
+		"""see LinkBase.send_apdu_raw"""
+		return tuple(self.transceive(Apdu.from_hex(pdu)))
+
+	def transceive(self, apdu):
+		"""see LinkBase.transceive"""
+		self.apdu_count += 1
+		if len(apdu) < 4:
+			return _sw(0x6700)
+		handler = self.__handlers.get(apdu.ins)
+		pending, self._pending = self._pending, None
+		if handler is None:
+			return _sw(0x6d00)
+		if apdu.ins == 0xc0:
+			return self.__get_response(apdu, pending)
+		return handler(self, apdu)
+
+	def __respond(self, apdu, data):
+		# Keep the data for GET RESPONSE, see GSM 11.11, chapter 9.4.1
+		# and ETSI TS 102 221, chapter 7.3.1.1.4
+		self._pending = h2b(data)
+		return _sw((0x9f00 if apdu.cla == 0xa0 else 0x6100) | (len(self._pending) & 0xff))
+
+	def __get_response(self, apdu, pending):
+		if pending is None:
+			return _sw(0x6985)
+		le = apdu.le or 256
+		if le > len(pending):
+			return _sw(0x6700)
+		return Response(pending[:le], 0x90, 0x00)
+
+	def __find(self, fid):
+		# Search order of ETSI TS 102 221, chapter 8.4.1
+		df = self._df
+		if fid == '3f00':
+			return self.card.mf
+		if fid == '7fff':
+			return self._adf
+		if fid == df.fid:
+			return df
+		if fid in df.children:
+			return df.children[fid]
+		parent = df.parent
+		if parent is not None:
+			if fid == parent.fid:
+				return parent
+			if fid in parent.children:
+				return parent.children[fid]
+		return None
+
+	def __select(self, apdu):
+		p1, p2 = apdu.p1, apdu.p2
+		data = b2h(apdu.data.tobytes())
+		if p1 == 0x04:
+			f = None
+			for adf in self.card.adfs:
+				if data and adf.aid.startswith(data):
+					f = adf
+					break
+			if f is not None:
+				self._adf = f
+		elif p1 == 0x08:
+			f = self.card.mf
+			for i in range(0, len(data), 4):
+				f = f.children.get(data[i:i + 4]) if f is not None else None
+		elif p1 == 0x00 and len(data) == 4:
+			f = self.__find(data)
+		else:
+			return _sw(0x6a86)
+		if f is None:
+			return _sw(0x6a82)
+		if f.is_df():
+			self._df = f
+			self._ef = None
+		else:
+			self._df = f.parent
+			self._ef = f
+		self._rec = None
+		if p2 & 0x0c == 0x0c:
+			return _sw(0x9000)
+		if apdu.cla == 0xa0 or p2 == 0x00:
+			return self.__respond(apdu, f.gsm_response())
+		return self.__respond(apdu, f.fcp)
+
+	def __current_ef(self, types):
+		if self._ef is None:
+			return None, _sw(0x6986)
+		if self._ef.type not in types:
+			return None, _sw(0x6981)
+		return self._ef, None
+
+	def __read_binary(self, apdu):
+		ef, err = self.__current_ef(('transparent',))
+		if err:
+			return err
+		ofs = apdu.p1 << 8 | apdu.p2
+		le = apdu.le or 256
+		if apdu.p1 & 0x80 or ofs > len(ef.data):
+			return _sw(0x6b00)
+		data = ef.data[ofs:ofs + le]
+		if len(data) < le and apdu.le not in (256, 65536):
+			return Response(data, 0x62, 0x82)
+		return Response(data, 0x90, 0x00)
+
+	def __update_binary(self, apdu):
+		ef, err = self.__current_ef(('transparent',))
+		if err:
+			return err
+		ofs = apdu.p1 << 8 | apdu.p2
+		data = apdu.data
+		if apdu.p1 & 0x80 or ofs > len(ef.data):
+			return _sw(0x6b00)
+		if ofs + len(data) > len(ef.data):
+			return _sw(0x6700)
+		ef.data[ofs:ofs + len(data)] = data.tobytes()
+		return _sw(0x9000)
+
+	# Record number addressed by P1/P2 (ISO 7816-4, chapter 7.3.3), None
+	# if there is no such record
+	def __record(self, ef, apdu):
+		n = len(ef.data)
+		mode = apdu.p2 & 0x07
+		if mode == 0x04:
+			rec = apdu.p1 - 1 if apdu.p1 else self._rec
+		elif mode == 0x02:
+			rec = 0 if self._rec is None else self._rec + 1
+		elif mode == 0x03:
+			rec = n - 1 if self._rec is None else self._rec - 1
+		else:
+			return None
+		if rec is None or rec < 0 or rec >= n:
+			return None
+		return rec
+
+	def __read_record(self, apdu):
+		ef, err = self.__current_ef(('linear', 'cyclic'))
+		if err:
+			return err
+		rec = self.__record(ef, apdu)
+		if rec is None:
+			return _sw(0x6a83)
+		if apdu.le not in (256, ef.rec_len):
+			return _sw(0x6c00 | ef.rec_len)
+		# Absolute addressing leaves the record pointer alone
+		if apdu.p2 & 0x07 != 0x04 or apdu.p1 == 0:
+			self._rec = rec
+		return Response(ef.data[rec], 0x90, 0x00)
+
+	def __update_record(self, apdu):
+		ef, err = self.__current_ef(('linear', 'cyclic'))
+		if err:
+			return err
+		data = apdu.data.tobytes()
+		if len(data) != ef.rec_len:
+			return _sw(0x6700)
+		if ef.type == 'cyclic':
+			# Always goes to the oldest record, which then becomes record
+			# 1 (ETSI TS 102 221, chapter 11.1.6)
+			ef.data.insert(0, ef.data.pop())
+			rec = 0
+		else:
+			rec = self.__record(ef, apdu)
+			if rec is None:
+				return _sw(0x6a83)
+		ef.data[rec][:] = data
+		if ef.type == 'cyclic' or apdu.p2 & 0x07 != 0x04 or apdu.p1 == 0:
+			self._rec = rec
+		return _sw(0x9000)
+
+	def __verify(self, apdu):
+		chv = apdu.p2
+		if chv not in self.card.pins:
+			return _sw(0x6a88)
+		tries = self.card.tries[chv]
+		if not len(apdu.data):
+			# Number of tries left
+			return _sw(0x63c0 | tries)
+		if tries == 0:
+			return _sw(0x6983)
+		if b2h(apdu.data.tobytes()) != rpad(b2h(self.card.pins[chv]), 16):
+			self.card.tries[chv] = tries - 1
+			return _sw(0x63c0 | (tries - 1))
+		self.card.tries[chv] = 3
+		self._verified.add(chv)
+		return _sw(0x9000)
+
+	def __create_file(self, apdu):
+		# ETSI TS 102 222, chapter 6.3: the new file is created in the
+		# current DF and becomes the current file
+		fcp = b2h(apdu.data.tobytes())
+		try:
+			f = self.card.create(self._df, fcp)
+		except (ValueError, KeyError):
+			return _sw(0x6a80)
+		if f is None:
+			return _sw(0x6a89)
+		if f.is_df():
+			self._df = f
+			self._ef = None
+		else:
+			self._ef = f
+		self._rec = None
+		return _sw(0x9000)
+
+	__handlers = {
+		0xa4: __select,
+		0xb0: __read_binary,
+		0xd6: __update_binary,
+		0xb2: __read_record,
+		0xdc: __update_record,
+		0x20: __verify,
+		0xe0: __create_file,
+		0xc0: __get_response,
+	}
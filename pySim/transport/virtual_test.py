@@ -0,0 +1,88 @@
+#!/usr/bin/pyton
+
+import os
+import unittest
+
+from pySim.commands import SimCardCommands
+from pySim.filesystem import walk
+from pySim.profiles import iter_profile
+from pySim.transport.virtual import *
+
+PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'profile')
+
+FCP_EF = '62168202412183026f998a01058b036f0603800200108800'
+FCP_REC = '62198205422100080283026f608a01058b036f0602800200108800'
+
+
+class VirtualCardTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.card = VirtualCard()
+		self.sl = VirtualCardLink(self.card)
+		self.scc = SimCardCommands(transport=self.sl)
+		self.scc.sel_ctrl = "0004"
+
+	def testCreateReadUpdate(self):
+		self.assertEqual(self.sl.send_apdu('00e0000018' + FCP_EF), ('', '9000'))
+		self.assertEqual(self.sl.send_apdu('00e0000018' + FCP_EF), ('', '6a89'))
+		self.assertEqual(self.scc.read_binary(['3f00', '6f99']), ('ffff' * 8, '9000'))
+		self.scc.update_binary(['3f00', '6f99'], '0102', 14)
+		self.assertEqual(self.scc.read_binary(['3f00', '6f99'], 2, 14), ('0102', '9000'))
+		self.assertEqual(self.sl.send_apdu('00d6000f020102'), ('', '6700'))
+		self.assertEqual(self.sl.send_apdu('00b0001101'), ('', '6b00'))
+
+	def testRecords(self):
+		self.sl.send_apdu('00e000001b' + FCP_REC)
+		self.assertEqual(self.scc.record_count(['3f00', '6f60']), 2)
+		self.scc.update_record(['3f00', '6f60'], 2, '11' * 8)
+		self.assertEqual(self.scc.read_record(['3f00', '6f60'], 2), ('11' * 8, '9000'))
+		self.assertEqual(self.sl.send_apdu('00b2030408'), ('', '6a83'))
+		self.assertEqual(self.sl.send_apdu('00dc010404' + '22' * 4), ('', '6700'))
+		# Next/previous
+		self.assertEqual(self.sl.send_apdu('00b2000208')[0], 'ff' * 8)
+		self.assertEqual(self.sl.send_apdu('00b2000208')[0], '11' * 8)
+
+	def testVerify(self):
+		self.assertEqual(self.sl.send_apdu('0020000108' + '31323335ffffffff'), ('', '63c2'))
+		self.assertEqual(self.sl.send_apdu('0020000100'), ('', '63c2'))
+		self.assertEqual(self.scc.verify_chv(1, '1234'), ('', '9000'))
+		for i in range(3):
+			self.sl.send_apdu('0020000108' + '31323335ffffffff')
+		self.assertEqual(self.sl.send_apdu('0020000108' + '31323334ffffffff'), ('', '6983'))
+
+	def testGetResponse(self):
+		self.assertEqual(self.sl.send_apdu_raw('00a40004023f00'), ('', '6112'))
+		self.assertEqual(self.sl.send_apdu_raw('00c0000012'), (FCP_MF, '9000'))
+		self.assertEqual(self.sl.send_apdu_raw('00c0000012'), ('', '6985'))
+
+	def testGsmSelect(self):
+		self.sl.send_apdu('00e0000018' + FCP_EF)
+		self.scc.cla_byte = "a0"
+		self.scc.sel_ctrl = "0000"
+		self.assertEqual(self.sl.send_apdu_raw('a0a40000026f99'), ('', '9f0f'))
+		self.assertEqual(self.scc.read_binary(['3f00', '6f99']), ('ffff' * 8, '9000'))
+
+	def testCopy(self):
+		self.sl.send_apdu('00e0000018' + FCP_EF)
+		copy = VirtualCardLink(self.card.copy())
+		self.scc.update_binary(['3f00', '6f99'], '00')
+		self.assertEqual(copy.send_apdu('00a4000c026f99'), ('', '9000'))
+		self.assertEqual(copy.send_apdu('00b0000001'), ('ff', '9000'))
+
+
+class ProfileTestCase(unittest.TestCase):
+
+	def testSeedFromProfile(self):
+		card = VirtualCard.from_profile(PROFILE)
+		scc = SimCardCommands(transport=VirtualCardLink(card))
+		scc.sel_ctrl = "0004"
+		tree = walk(scc)
+		for df, path in PROFILE_DFS:
+			files = dict((f.fid, f) for f in tree.find(list(path)).children)
+			for ef in iter_profile(PROFILE, df):
+				f = files[ef.name.lower()]
+				self.assertEqual((f.type, f.data), (ef.tp, ef.data), ef.name)
+
+
+if __name__ == "__main__":
+	unittest.main()
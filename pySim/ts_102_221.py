@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Various constants from ETSI TS 102 221
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pySim.ts_51_011 import MF_num
+
+# Chapter 13: Application independent files
+EF_num = {
+'DIR': '2F00',
+'ICCID': '2FE2',
+'PL': '2F05',
+'ARR': '2F06',
+'UMPC': '2F08',
+}
+
+EF = {
+'DIR':    [MF_num, EF_num['DIR']],
+'ICCID':  [MF_num, EF_num['ICCID']],
+'PL':     [MF_num, EF_num['PL']],
+'ARR':    [MF_num, EF_num['ARR']],
+'UMPC':   [MF_num, EF_num['UMPC']],
+}
+
+# Chapter 8.3: The FID of the currently selected ADF
+ADF_num = '7FFF'
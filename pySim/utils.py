@@ -21,18 +21,51 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import binascii
+
+# The hex codecs below sit on the path of every single APDU, so they are
+# done by binascii instead of character by character. Like before, a
+# trailing odd nibble is ignored and anything that isn't hex raises a
+# ValueError.
 
 def h2b(s):
-	return ''.join([chr((int(x,16)<<4)+int(y,16)) for x,y in zip(s[0::2], s[1::2])])
+	try:
+		return binascii.unhexlify(s[0:len(s) & ~1])
+	except (TypeError, binascii.Error) as e:
+		raise ValueError(str(e))
 
 def b2h(s):
-	return ''.join(['%02x'%ord(x) for x in s])
+	h = binascii.hexlify(s)
+	return h if isinstance(h, str) else h.decode('ascii')
 
 def h2i(s):
-	return [(int(x,16)<<4)+int(y,16) for x,y in zip(s[0::2], s[1::2])]
+	return list(bytearray(h2b(s)))
 
 def i2h(s):
-	return ''.join(['%02x'%(x) for x in s])
+	return b2h(bytearray(s))
+
+def diff_hex(old, new, max_gap=8):
+	"""
+	Find the parts of the hex string new which differ from old. Returns a
+	list of (offset in bytes, hex string). Parts less than max_gap bytes
+	apart are returned as one, as sending a command costs more than
+	sending a few bytes. Anything beyond the end of old differs.
+	"""
+	old = bytearray(h2b(old))
+	new = bytearray(h2b(new))
+	parts = []
+	start = end = None
+	for i in range(len(new)):
+		if i < len(old) and old[i] == new[i]:
+			continue
+		if start is None or i - end >= max_gap:
+			if start is not None:
+				parts.append((start, end))
+			start = i
+		end = i + 1
+	if start is not None:
+		parts.append((start, end))
+	return [(start, b2h(new[start:end])) for start, end in parts]
 
 def h2s(s):
 	return ''.join([chr((int(x,16)<<4)+int(y,16)) for x,y in zip(s[0::2], s[1::2]) if not (x == 'f' and y == 'f') ])
@@ -195,10 +228,30 @@ def derive_milenage_opc(ki_hex, op_hex):
 	from pySim.utils import b2h
 
 	# We pass in hex string and now need to work on bytes
-	aes = AES.new(h2b(ki_hex))
+	aes = AES.new(h2b(ki_hex), AES.MODE_ECB)
 	opc_bytes = aes.encrypt(h2b(op_hex))
 	return b2h(strxor(opc_bytes, h2b(op_hex)))
 
+def derive_milenage_opcs(kis, op):
+	"""
+	Run the milenage algorithm to calculate OPC for many Ki and one OP.
+	kis is either a sequence of 16 byte Ki values, or one buffer of all Ki
+	values back to back; op is 16 bytes. Returns a list of 16 byte OPC
+	values.
+	"""
+	from Crypto.Cipher import AES
+	from Crypto.Util.strxor import strxor
+
+	# The Ki is the key, so there is one AES context per Ki, but
+	# everything else is set up only once
+	if isinstance(kis, (bytes, bytearray, memoryview)):
+		kis = bytes(kis)
+		kis = [kis[i:i+16] for i in range(0, len(kis), 16)]
+	op = bytes(op)
+	new = AES.new
+	ecb = AES.MODE_ECB
+	return [strxor(new(bytes(ki), ecb).encrypt(op), op) for ki in kis]
+
 def calculate_luhn(cc):
 	"""
 	Calculate Luhn checksum used in e.g. ICCID and IMEI
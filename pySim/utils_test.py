@@ -3,6 +3,46 @@
 import unittest
 import utils 
 
+class CodecTestCase(unittest.TestCase):
+
+	def testH2b(self):
+		self.assertEqual(utils.h2b("00a4Ff"), "\x00\xa4\xff")
+		self.assertEqual(utils.h2b(""), "")
+
+	def testH2b_oddLength(self):
+		self.assertEqual(utils.h2b("3f0"), "\x3f")
+
+	def testH2b_notHex(self):
+		self.assertRaises(ValueError, utils.h2b, "3g00")
+
+	def testB2h(self):
+		self.assertEqual(utils.b2h("\x00\xa4\xff"), "00a4ff")
+		self.assertEqual(utils.b2h(bytearray([0x3f, 0x00])), "3f00")
+
+	def testH2i(self):
+		self.assertEqual(utils.h2i("00A4ff"), [0x00, 0xa4, 0xff])
+
+	def testI2h(self):
+		self.assertEqual(utils.i2h([0x00, 0xa4, 0xff]), "00a4ff")
+		self.assertEqual(utils.i2h([]), "")
+
+class DiffTestCase(unittest.TestCase):
+
+	def testSame(self):
+		self.assertEqual(utils.diff_hex("00112233", "00112233"), [])
+
+	def testParts(self):
+		old = "00" * 32
+		new = "01" + "00" * 20 + "0203" + "00" * 9
+		self.assertEqual(utils.diff_hex(old, new), [(0, "01"), (21, "0203")])
+
+	def testSmallGap(self):
+		self.assertEqual(utils.diff_hex("00000000", "01000002"), [(0, "01000002")])
+		self.assertEqual(utils.diff_hex("00000000", "01000002", max_gap=2), [(0, "01"), (3, "02")])
+
+	def testLonger(self):
+		self.assertEqual(utils.diff_hex("0011", "00112233"), [(2, "2233")])
+
 class DecTestCase(unittest.TestCase):
 
 	def testSplitHexStringToListOf5ByteEntries(self):
@@ -72,5 +112,32 @@ ffffff0000 # unused
 '''
 		self.assertEqual(utils.format_xplmn_w_act(input_str), expected)
 
+try:
+	import Crypto
+	have_crypto = True
+except ImportError:
+	have_crypto = False
+
+@unittest.skipUnless(have_crypto, "needs pycrypto")
+class MilenageTestCase(unittest.TestCase):
+
+	# 3GPP TS 35.207, test set 1
+	ki = "465b5ce8b199b49faa5f0a2ee238a6bc"
+	op = "cdc202d5123e20f62b6d676ac72cb318"
+	opc = "cd63cb71954a9f4e48a5994e37a02baf"
+
+	def testDeriveMilenageOpc(self):
+		self.assertEqual(utils.derive_milenage_opc(self.ki, self.op), self.opc)
+
+	def testDeriveMilenageOpcs_list(self):
+		opcs = utils.derive_milenage_opcs([utils.h2b(self.ki)] * 3, utils.h2b(self.op))
+		self.assertEqual([utils.b2h(x) for x in opcs], [self.opc] * 3)
+
+	def testDeriveMilenageOpcs_buffer(self):
+		kis = bytearray(utils.h2b(self.ki + "00" * 16))
+		opcs = utils.derive_milenage_opcs(kis, utils.h2b(self.op))
+		self.assertEqual(utils.b2h(opcs[0]), self.opc)
+		self.assertEqual(utils.b2h(opcs[1]), utils.derive_milenage_opc("00" * 16, self.op))
+
 if __name__ == "__main__":
 	unittest.main()